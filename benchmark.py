@@ -0,0 +1,508 @@
+"""
+Benchmarks for simple-pytorrent.
+
+Run all benchmarks with:
+
+    python benchmark.py
+
+or a selection of them by name:
+
+    python benchmark.py known_peer_memory swarm_download
+
+The swarm_download benchmark downloads a synthetic torrent from seeders on
+localhost, see loopback.py. Its size can be changed with the --size,
+--piece-length and --seeders options, which also apply to stream_start,
+dht_download and magnet_download.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import argparse
+import contextlib
+import gc
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import timeit
+
+import dht
+import loopback
+import metainfo
+import metrics
+import peerstore
+import peerwire
+import socketthread
+import torrent
+import tracker
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+
+def _peer_addresses(n):
+    """
+    Generates n distinct tracker.PeerAddress objects.
+    """
+    for i in range(n):
+        ip = "10.{}.{}.{}".format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+        yield tracker.PeerAddress(ip, 6881 + (i >> 24))
+
+
+def _measure_memory(function):
+    """
+    Measures how many bytes stay allocated after calling function. Uses
+    tracemalloc when available, otherwise the change in peak RSS which is much
+    less precise.
+
+    :return: (result of function, allocated bytes) tuple
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return result, after - before
+
+    # ru_maxrss is in kilobytes on Linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = function()
+    gc.collect()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result, (after - before) * 1024
+
+
+def bench_known_peer_memory(n=100000):
+    """
+    Memory used per known but unconnected peer in a PeerStore.
+    """
+    addresses = list(_peer_addresses(n))
+
+    def fill_store():
+        store = peerstore.PeerStore()
+        store.add_all(addresses, peerstore.SOURCE_TRACKER)
+        return store
+
+    store, allocated = _measure_memory(fill_store)
+    assert len(store) == n
+
+    print("known_peer_memory: {} peers, {:.0f} bytes per known peer".format(
+        n, allocated / n))
+
+
+def _report_timeit(name, statement, number):
+    """
+    Runs statement number times and prints the time per call.
+    """
+    seconds = min(timeit.repeat(statement, number=number, repeat=3))
+    print("{}: {:.2f} us per call".format(name, seconds / number * 1e6))
+
+
+def bench_decode_handshake():
+    handshake = peerwire.generate_handshake(b"i" * 20, b"p" * 20)
+    _report_timeit("decode_handshake",
+                   lambda: peerwire.decode_handshake(handshake), 20000)
+
+
+def bench_bitfield(piece_count=10000):
+    """
+    Construction of a Bitfield from the bitfield message of a seeder.
+    """
+    payload = b"\xff" * (piece_count // 8)
+    _report_timeit("bitfield_{}_pieces".format(piece_count),
+                   lambda: peerwire.Bitfield(payload), 200)
+
+
+def bench_binary_peer_extract(peer_count=200):
+    peers = b"".join(tracker.COMPACT_PEER.pack(
+        socket.inet_aton(address.ip), address.port)
+        for address in _peer_addresses(peer_count))
+    _report_timeit("binary_peer_extract_{}_peers".format(peer_count),
+                   lambda: tracker.binary_peer_extract(peers), 5000)
+
+
+def bench_receive_all(block_size=metainfo.BLOCK_SIZE, count=4096):
+    """
+    Throughput of receive_all over a local socket pair, receiving block sized
+    chunks as when downloading.
+    """
+    reader, writer = socket.socketpair()
+    data = b"x" * (block_size * 64)
+
+    def write():
+        for _ in range(count // 64):
+            writer.sendall(data)
+
+    thread = threading.Thread(target=write)
+    thread.daemon = True
+    thread.start()
+
+    start = time.time()
+    for _ in range(count):
+        socketthread.receive_all(reader, block_size)
+    elapsed = time.time() - start
+    thread.join()
+    reader.close()
+    writer.close()
+
+    print("receive_all: {:.2f} us per {} byte block, {:.1f} MB/s".format(
+        elapsed / count * 1e6, block_size, block_size * count / elapsed / 1e6))
+
+
+@contextlib.contextmanager
+def _quiet():
+    """
+    Silences anything printed to stdout, such as the client's debug output.
+    """
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]  # user + system time of all threads
+
+
+def bench_tracker_requests(count=500, torrents=20):
+    """
+    Announces and scrapes against a local tracker, as for many torrents on the
+    same tracker, once with pooled keep-alive connections and once with a new
+    connection for every request.
+    """
+    stub = loopback.TrackerStub([("127.0.0.1", port)
+                                 for port in range(6881, 6931)])
+    stub.start()
+    info_hashes = [os.urandom(20) for _ in range(torrents)]
+    default_client = tracker.HTTP_CLIENT
+    try:
+        for name, pool_size in (("pooled", tracker.POOL_SIZE),
+                                ("unpooled", 0)):
+            client = tracker.HTTPClient(pool_size=pool_size)
+            tracker.HTTP_CLIENT = client
+            connections = stub.connections
+            start = time.time()
+            for number in range(count):
+                info_hash = info_hashes[number % torrents]
+                if number % 10:
+                    tracker.query_announcer(stub.announce_url, info_hash,
+                                            torrent.PEER_ID)
+                else:
+                    tracker.scrape(stub.announce_url, info_hash)
+            elapsed = time.time() - start
+            client.close()
+            print("tracker_requests_{}: {:.0f} requests/s, {} connections, "
+                  "{} DNS lookups".format(name, count / elapsed,
+                                          stub.connections - connections,
+                                          client.dns_lookups))
+    finally:
+        tracker.HTTP_CLIENT = default_client
+        stub.stop()
+
+
+def bench_swarm_download(size=32 * 2 ** 20, piece_length=2 ** 18, seeders=4,
+                         timeout=300):
+    """
+    Times a complete download of a synthetic torrent from local seeders.
+    """
+    with loopback.LoopbackSwarm(size, piece_length, seeders) as swarm:
+        client = torrent.Torrent(swarm.torrent_path, swarm.download_dir)
+
+        with _quiet():
+            start_wall = time.time()
+            start_cpu = _cpu_time()
+            client.start()
+            while not client.is_complete():
+                if time.time() - start_wall > timeout:
+                    break
+                client.step()
+            wall = time.time() - start_wall
+            cpu = _cpu_time() - start_cpu
+            client.stop()
+
+        complete = client.is_complete() and swarm.verify()
+        messages = sum(seeder.blocks_served for seeder in swarm.seeders)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("swarm_download: {} MiB, {} KiB pieces, {} seeders".format(
+        size // 2 ** 20, piece_length // 2 ** 10, seeders))
+    if not complete:
+        print("  download did not complete within {} seconds".format(timeout))
+        return
+    print("  {:.2f} MB/s, {:.2f} s wall, {:.2f} s CPU, peak RSS {} KiB".format(
+        size / wall / 1e6, wall, cpu, peak_rss))
+    print("  {} block messages, {:.1f} us CPU per message".format(
+        messages, cpu / max(messages, 1) * 1e6))
+
+    if metrics.REGISTRY.enabled:
+        snapshot = metrics.REGISTRY.snapshot()
+        for latency in snapshot.get("request_latency_seconds", {}).values():
+            print("  request latency: {:.2f} ms mean over {} requests".format(
+                latency['sum'] / max(latency['count'], 1) * 1e3,
+                latency['count']))
+
+
+def bench_stream_start(size=32 * 2 ** 20, piece_length=2 ** 18, seeders=4,
+                       timeout=300):
+    """
+    Time until the first byte of the second half of a torrent can be read in
+    streaming mode, compared to the time of the whole download.
+    """
+    with loopback.LoopbackSwarm(size, piece_length, seeders,
+                                file_count=2) as swarm:
+        client = torrent.Torrent(swarm.torrent_path, swarm.download_dir)
+        stream = client.open_stream(size // 10, file_index=1, timeout=timeout)
+        result = {}
+
+        def consume():
+            start = time.time()
+            first = stream.read(metainfo.BLOCK_SIZE)
+            result['first_byte'] = time.time() - start
+            result['correct'] = first == swarm.data[size // 2:size // 2 +
+                                                    len(first)]
+
+        reader = threading.Thread(target=consume)
+        reader.daemon = True
+        reader.start()
+        with _quiet():
+            start = time.time()
+            client.start()
+            while not client.is_complete():
+                if time.time() - start > timeout:
+                    break
+                client.step()
+            wall = time.time() - start
+            reader.join(timeout)
+            client.stop()
+
+    print("stream_start: {} MiB, {} KiB pieces, {} seeders".format(
+        size // 2 ** 20, piece_length // 2 ** 10, seeders))
+    if not result.get('correct'):
+        print("  no correct data was streamed")
+        return
+    print("  first byte after {:.3f} s, whole download {:.2f} s".format(
+        result['first_byte'], wall))
+
+
+def bench_web_seed_download(size=32 * 2 ** 20, piece_length=2 ** 18,
+                            web_seeds=1, file_count=3, timeout=300):
+    """
+    Times a complete download of a multi file torrent from local HTTP web
+    seeds only.
+    """
+    with loopback.LoopbackSwarm(size, piece_length, 0, file_count,
+                                web_seeds=web_seeds) as swarm:
+        client = torrent.Torrent(swarm.torrent_path, swarm.download_dir)
+        with _quiet():
+            start = time.time()
+            client.start()
+            while not client.is_complete():
+                if time.time() - start > timeout:
+                    break
+                client.step()
+            wall = time.time() - start
+            client.stop()
+
+        complete = client.is_complete() and swarm.verify()
+        requests = sum(server.requests for server in swarm.web_seeds)
+        connections = sum(server.connections for server in swarm.web_seeds)
+
+    print("web_seed_download: {} MiB, {} KiB pieces, {} files, {} web "
+          "seeds".format(size // 2 ** 20, piece_length // 2 ** 10, file_count,
+                         web_seeds))
+    if not complete:
+        print("  download did not complete within {} seconds".format(timeout))
+        return
+    print("  {:.2f} MB/s, {} range requests over {} connections".format(
+        size / wall / 1e6, requests, connections))
+
+
+def bench_dht_download(size=32 * 2 ** 20, piece_length=2 ** 18, seeders=4,
+                       nodes=32, timeout=300):
+    """
+    Times a complete download of a trackerless torrent whose seeders are found
+    through a cluster of local DHT nodes.
+    """
+    with loopback.LoopbackSwarm(size, piece_length, seeders,
+                                dht_nodes=nodes) as swarm:
+        node = dht.DHTNode(ip="127.0.0.1")
+        client = torrent.Torrent(swarm.torrent_path, swarm.download_dir,
+                                 dht=node)
+        with _quiet():
+            start = time.time()
+            joined = []
+            node.bootstrap(swarm.dht.addresses[:1], joined.append)
+            while not joined:
+                node.poll()
+                time.sleep(torrent.IDLE_SLEEP)
+            client.start()
+            first_peer = None
+            while not client.is_complete():
+                if time.time() - start > timeout:
+                    break
+                if first_peer is None and len(client.known_peers):
+                    first_peer = time.time() - start
+                client.step()
+            wall = time.time() - start
+            client.stop()
+            node.close()
+
+        complete = client.is_complete() and swarm.verify()
+
+    print("dht_download: {} MiB, {} KiB pieces, {} seeders, {} DHT "
+          "nodes".format(size // 2 ** 20, piece_length // 2 ** 10, seeders,
+                         nodes))
+    if not complete:
+        print("  download did not complete within {} seconds".format(timeout))
+        return
+    print("  first peer after {:.3f} s, {:.2f} MB/s, {} nodes in the routing "
+          "table".format(first_peer, size / wall / 1e6, len(node.table)))
+
+
+def bench_magnet_download(size=32 * 2 ** 20, piece_length=2 ** 18, seeders=4,
+                          timeout=300):
+    """
+    Times a complete download started from a magnet link, whose info dict is
+    first fetched from the seeders through ut_metadata.
+    """
+    with loopback.LoopbackSwarm(size, piece_length, seeders) as swarm:
+        client = torrent.Torrent(swarm.magnet_link, swarm.download_dir)
+        with _quiet():
+            start = time.time()
+            client.start()
+            got_metadata = None
+            while not client.is_complete():
+                if time.time() - start > timeout:
+                    break
+                if got_metadata is None and client.metadata is not None:
+                    got_metadata = time.time() - start
+                client.step()
+            wall = time.time() - start
+            client.stop()
+
+        complete = client.is_complete() and swarm.verify()
+        raw_info = client.metadata_exchange.raw_info
+
+    print("magnet_download: {} MiB, {} KiB pieces, {} seeders".format(
+        size // 2 ** 20, piece_length // 2 ** 10, seeders))
+    if not complete:
+        print("  download did not complete within {} seconds".format(timeout))
+        return
+    print("  {} KiB of metadata after {:.3f} s, {:.2f} MB/s".format(
+        len(raw_info) // 2 ** 10, got_metadata, size / wall / 1e6))
+
+
+def bench_first_piece(size=8 * 2 ** 20, piece_length=2 ** 18, seeders=2,
+                      unchoke_delay=2.0, timeout=60):
+    """
+    Time until the first piece of a new download is verified when the seeders
+    keep new peers choked for a while, with and without the Fast extension.
+    """
+    print("first_piece: {} MiB, {} KiB pieces, {} seeders unchoking after "
+          "{} s".format(size // 2 ** 20, piece_length // 2 ** 10, seeders,
+                        unchoke_delay))
+    for fast in (False, True):
+        with loopback.LoopbackSwarm(size, piece_length, seeders, fast=fast,
+                                    unchoke_delay=unchoke_delay) as swarm:
+            client = torrent.Torrent(swarm.torrent_path, swarm.download_dir)
+            first_piece = None
+            with _quiet():
+                start = time.time()
+                client.start()
+                while not client.is_complete():
+                    if time.time() - start > timeout:
+                        break
+                    if first_piece is None and client.download.have_count:
+                        first_piece = time.time() - start
+                    client.step()
+                wall = time.time() - start
+                client.stop()
+            complete = client.is_complete() and swarm.verify()
+
+        name = "fast extension" if fast else "no fast extension"
+        if not complete:
+            print("  {}: download did not complete within {} seconds".format(
+                name, timeout))
+            continue
+        print("  {}: first piece after {:.3f} s, whole download {:.2f} "
+              "s".format(name, first_piece, wall))
+
+
+BENCHMARKS = {
+    "known_peer_memory": bench_known_peer_memory,
+    "decode_handshake": bench_decode_handshake,
+    "bitfield": bench_bitfield,
+    "binary_peer_extract": bench_binary_peer_extract,
+    "receive_all": bench_receive_all,
+    "tracker_requests": bench_tracker_requests,
+    "swarm_download": bench_swarm_download,
+    "stream_start": bench_stream_start,
+    "web_seed_download": bench_web_seed_download,
+    "dht_download": bench_dht_download,
+    "magnet_download": bench_magnet_download,
+    "first_piece": bench_first_piece,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="simple-pytorrent benchmarks")
+    parser.add_argument("names", nargs="*",
+                        help="Benchmarks to run, all if none are given. One "
+                             "of: " + ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument("--size", type=int, default=32,
+                        help="Size of the swarm_download torrent in MiB")
+    parser.add_argument("--piece-length", type=int, default=256,
+                        help="Piece length of the swarm_download torrent in "
+                             "KiB")
+    parser.add_argument("--seeders", type=int, default=4,
+                        help="Number of seeders in swarm_download")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Collect metrics during swarm_download to measure "
+                             "their overhead")
+    args = parser.parse_args(argv[1:])
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(repr(name)))
+
+    if args.metrics:
+        metrics.enable()
+
+    for name in args.names or sorted(BENCHMARKS):
+        if name in ("swarm_download", "stream_start", "dht_download",
+                    "magnet_download"):
+            BENCHMARKS[name](args.size * 2 ** 20, args.piece_length * 2 ** 10,
+                             args.seeders)
+        elif name == "web_seed_download":
+            bench_web_seed_download(args.size * 2 ** 20,
+                                    args.piece_length * 2 ** 10)
+        else:
+            BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
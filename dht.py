@@ -0,0 +1,817 @@
+"""
+Mainline DHT node (BEP 5).
+
+The DHT is a Kademlia network of UDP nodes that stores which peers are in
+which swarm, so torrents can find peers without a tracker. Every node has a
+random 160 bit ID and the distance between two IDs is their XOR. Peers of a
+torrent are stored on the nodes whose IDs are closest to its info hash.
+
+The routing table keeps up to K nodes per bucket. It starts with a single
+bucket covering the whole ID space and only the bucket holding our own ID is
+split when full, so the table holds many nodes close to us and few far away.
+
+A lookup asks the closest nodes it knows of for nodes even closer to the
+target, with up to ALPHA queries in flight, until the K closest nodes it has
+heard of have all answered. A get_peers lookup also collects the peers those
+nodes return and can announce us to the closest ones with the tokens they gave
+us.
+
+Messages are bencoded KRPC dicts sent over a non-blocking UDP socket. Like
+diskio.DiskIO the node does nothing on its own: its owner calls poll() from its
+main loop, which handles the received packets and the expired query timeouts,
+and runs the callbacks of lookups.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import binascii
+import bisect
+import errno
+import hashlib
+import heapq
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+import bencode
+import lazybencode
+import metrics
+import timers
+import tracker
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+# Nodes per bucket and nodes a lookup converges on
+K = 8
+# Queries a lookup has in flight at the same time
+ALPHA = 3
+ID_LENGTH = 20
+ID_BITS = ID_LENGTH * 8
+# Seconds before an unanswered query fails
+QUERY_TIMEOUT = 4
+# Failed queries in a row after which a node is removed from the table
+NODE_MAX_FAILURES = 2
+# Seconds after which a bucket nothing has changed in is refreshed with a
+# lookup of a random ID in it, and how often the buckets are checked
+REFRESH_INTERVAL = 15 * 60
+REFRESH_CHECK = 60
+# Seconds between changes of the secret tokens are made from. Tokens made with
+# the previous secret are still accepted.
+TOKEN_INTERVAL = 5 * 60
+TOKEN_LENGTH = 8
+# Seconds an announced peer is stored, and most peers stored per info hash
+PEER_TTL = 30 * 60
+MAX_PEERS_PER_INFO_HASH = 2000
+# Most peers in a get_peers response, so it fits in a single UDP packet
+MAX_VALUES = 50
+MAX_PACKET = 65536
+
+# Well known nodes to join the DHT through when the routing table is empty
+BOOTSTRAP_NODES = [
+    ("router.bittorrent.com", 6881),
+    ("dht.transmissionbt.com", 6881),
+    ("router.utorrent.com", 6881),
+]
+
+# Compact node info: node ID, IPv4 address and port in network notation
+COMPACT_NODE = struct.Struct(b"!20s4sH")
+
+# KRPC error codes
+ERROR_GENERIC = 201
+ERROR_SERVER = 202
+ERROR_PROTOCOL = 203
+ERROR_METHOD_UNKNOWN = 204
+
+
+def id_to_int(node_id):
+    return int(binascii.hexlify(node_id), 16)
+
+
+def int_to_id(number):
+    return binascii.unhexlify("{:040x}".format(number).encode("ascii"))
+
+
+def encode_nodes(nodes):
+    """
+    :param nodes: Iterable of Node
+    :return: The nodes in compact node info form
+    """
+    return b"".join(COMPACT_NODE.pack(node.id, socket.inet_aton(node.ip),
+                                      node.port)
+                    for node in nodes)
+
+
+def decode_nodes(data):
+    """
+    :param data: Nodes in compact node info form
+    :return: List of (node_id, (ip, port)) tuples
+    """
+    if not isinstance(data, bytes):
+        return []
+    inet_ntoa = socket.inet_ntoa
+    return [(node_id, (inet_ntoa(ip), port))
+            for node_id, ip, port in tracker._iter_unpack(COMPACT_NODE, data)
+            if port]
+
+
+def decode_values(values):
+    """
+    :param values: The values list of a get_peers response, compact peers
+    :return: List of tracker.PeerAddress
+    """
+    if not isinstance(values, list):
+        return []
+    peers = []
+    for value in values:
+        if isinstance(value, bytes):
+            peers.extend(peer for peer in tracker.binary_peer_extract(value)
+                         if peer.port)
+    return peers
+
+
+def _is_id(value):
+    return isinstance(value, bytes) and len(value) == ID_LENGTH
+
+
+class KRPCError(Exception):
+    """
+    Raised by the handler of a query to answer it with a KRPC error.
+    """
+
+    def __init__(self, code, error_string):
+        self.code = code
+        self.error_string = error_string
+
+    def __str__(self):
+        return "KRPC error {}: {}".format(self.code, self.error_string)
+
+
+class Node(object):
+    """
+    A DHT node in the routing table.
+
+    last_seen: Unix time we last heard from the node, 0 if never.
+    failures: Queries to the node that failed in a row.
+    """
+
+    __slots__ = ("id", "number", "ip", "port", "last_seen", "failures")
+
+    def __init__(self, node_id, ip, port, last_seen=None):
+        self.id = node_id
+        self.number = id_to_int(node_id)
+        self.ip = ip
+        self.port = port
+        self.last_seen = time.time() if last_seen is None else last_seen
+        self.failures = 0
+
+    @property
+    def address(self):
+        return self.ip, self.port
+
+    def __repr__(self):
+        return "Node({}, {}:{})".format(binascii.hexlify(self.id)[:8],
+                                        self.ip, self.port)
+
+
+class Bucket(object):
+    """
+    The nodes with IDs in [low, high), least recently seen first.
+    """
+
+    __slots__ = ("low", "high", "nodes", "last_changed")
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.nodes = []
+        self.last_changed = time.time()
+
+    def covers(self, number):
+        return self.low <= number < self.high
+
+
+class RoutingTable(object):
+    def __init__(self, node_id, bucket_size=K):
+        """
+        :param node_id: Our own node ID
+        :param bucket_size: Most nodes per bucket
+        """
+        self.node_id = node_id
+        self.number = id_to_int(node_id)
+        self.bucket_size = bucket_size
+        self.buckets = [Bucket(0, 2 ** ID_BITS)]
+        self.lows = [0]  # The low of every bucket, for bisect
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            for node in bucket.nodes:
+                yield node
+
+    def bucket_for(self, number):
+        return self.buckets[bisect.bisect_right(self.lows, number) - 1]
+
+    def get(self, node_id):
+        for node in self.bucket_for(id_to_int(node_id)).nodes:
+            if node.id == node_id:
+                return node
+        return None
+
+    def add(self, node_id, address, last_seen=None):
+        """
+        Adds a node we heard from or marks it as seen if it is already known.
+        A full bucket is split if it holds our own ID. Otherwise the new node
+        replaces a node that failed to answer, or is dropped as Kademlia
+        prefers nodes that have been around for long.
+
+        :param address: (ip, port) tuple of the node
+        :param last_seen: Unix time the node was seen, now if None
+        :return: The Node or None if it was not added
+        """
+        if node_id == self.node_id:
+            return None
+        now = time.time() if last_seen is None else last_seen
+        node = self.get(node_id)
+        bucket = self.bucket_for(id_to_int(node_id))
+        if node is not None:
+            node.ip, node.port = address
+            node.last_seen = max(node.last_seen, now)
+            node.failures = 0
+            bucket.nodes.remove(node)
+            bucket.nodes.append(node)
+            bucket.last_changed = time.time()
+            return node
+
+        node = Node(node_id, address[0], address[1], now)
+        while len(bucket.nodes) >= self.bucket_size:
+            if bucket.covers(self.number) and bucket.high - bucket.low > 1:
+                self._split(bucket)
+                bucket = self.bucket_for(node.number)
+                continue
+            failed = [other for other in bucket.nodes if other.failures]
+            if not failed:
+                return None
+            bucket.nodes.remove(max(failed, key=lambda other: other.failures))
+        bucket.nodes.append(node)
+        bucket.last_changed = time.time()
+        return node
+
+    def _split(self, bucket):
+        middle = (bucket.low + bucket.high) // 2
+        upper = Bucket(middle, bucket.high)
+        upper.nodes = [node for node in bucket.nodes if node.number >= middle]
+        bucket.nodes = [node for node in bucket.nodes if node.number < middle]
+        bucket.high = middle
+        position = self.buckets.index(bucket) + 1
+        self.buckets.insert(position, upper)
+        self.lows.insert(position, middle)
+
+    def failed(self, node_id):
+        """
+        Counts a query to a node that was not answered. The node is removed
+        after NODE_MAX_FAILURES failures in a row.
+        """
+        node = self.get(node_id)
+        if node is None:
+            return
+        node.failures += 1
+        if node.failures >= NODE_MAX_FAILURES:
+            self.bucket_for(node.number).nodes.remove(node)
+
+    def closest(self, number, count=K):
+        """
+        :param number: Target ID as an int
+        :return: Up to count nodes, closest to the target first
+        """
+        return heapq.nsmallest(count, self,
+                               key=lambda node: node.number ^ number)
+
+    def stale_buckets(self, age):
+        """
+        :return: Buckets nothing has changed in for age seconds
+        """
+        now = time.time()
+        return [bucket for bucket in self.buckets
+                if now - bucket.last_changed >= age]
+
+
+class Query(object):
+    """
+    A query we sent that has not been answered yet.
+    """
+
+    __slots__ = ("method", "address", "node_id", "callback", "timer")
+
+    def __init__(self, method, address, node_id, callback):
+        self.method = method
+        self.address = address
+        self.node_id = node_id  # None if not known, such as bootstrap nodes
+        self.callback = callback
+        self.timer = None
+
+
+class Lookup(object):
+    def __init__(self, dht, target, method, on_peers=None, on_done=None,
+                 announce_port=None, seeds=()):
+        """
+        An iterative find_node or get_peers lookup, see DHTNode.find_node and
+        DHTNode.get_peers.
+
+        :param dht: The DHTNode the queries are sent from
+        :param target: ID or info hash looked up
+        :param method: b"find_node" or b"get_peers"
+        :param on_peers: Called with a list of tracker.PeerAddress whenever
+        new peers are found
+        :param on_done: Called with the closest nodes that answered, as a list
+        of (node_id, (ip, port)) tuples, when the lookup has finished
+        :param announce_port: Port announced to the closest nodes once a
+        get_peers lookup has finished, no announce if None
+        :param seeds: (ip, port) addresses of nodes with unknown IDs that are
+        queried as well, such as bootstrap nodes
+        """
+        self.dht = dht
+        self.target = target
+        self.number = id_to_int(target)
+        self.method = method
+        self.on_peers = on_peers
+        self.on_done = on_done
+        self.announce_port = announce_port
+        self.seeds = seeds
+
+        self.candidates = {}  # Node ID mapped to (ip, port)
+        self.queried = set()  # IDs of the candidates queried
+        self.responded = {}  # Node ID mapped to ((ip, port), token)
+        self.peers = set()
+        self.in_flight = 0
+        self.done = False
+
+    def _distance(self, node_id):
+        return id_to_int(node_id) ^ self.number
+
+    def start(self):
+        for node in self.dht.table.closest(self.number):
+            self.candidates[node.id] = node.address
+        for address in self.seeds:
+            self._query(None, address)
+        self._step()
+
+    def _query(self, node_id, address):
+        if node_id is not None:
+            self.queried.add(node_id)
+        if self.method == b"get_peers":
+            args = {b"info_hash": self.target}
+        else:
+            args = {b"target": self.target}
+        self.in_flight += 1
+        self.dht.send_query(address, self.method, args, self._on_reply,
+                            node_id)
+
+    def _step(self):
+        if self.done:
+            return
+        closest = heapq.nsmallest(K, self.candidates, key=self._distance)
+        for node_id in closest:
+            if self.in_flight >= ALPHA:
+                break
+            if node_id not in self.queried:
+                self._query(node_id, self.candidates[node_id])
+        if not self.in_flight:
+            self._finish()
+
+    def _on_reply(self, query, reply):
+        self.in_flight -= 1
+        if reply is None:
+            if query.node_id is not None:
+                self.candidates.pop(query.node_id, None)
+            self._step()
+            return
+
+        node_id = reply[b"id"]
+        if node_id == self.dht.node_id:
+            self._step()
+            return
+        self.candidates[node_id] = query.address
+        self.queried.add(node_id)
+        self.responded[node_id] = (query.address, reply.get(b"token"))
+        for other_id, address in decode_nodes(reply.get(b"nodes")):
+            if other_id != self.dht.node_id and other_id not in self.candidates:
+                self.candidates[other_id] = address
+
+        new_peers = [peer for peer in decode_values(reply.get(b"values"))
+                     if peer not in self.peers]
+        if new_peers:
+            self.peers.update(new_peers)
+            if self.on_peers is not None:
+                self.on_peers(new_peers)
+        self._step()
+
+    def _finish(self):
+        self.done = True
+        closest = heapq.nsmallest(K, self.responded, key=self._distance)
+        if self.announce_port is not None:
+            for node_id in closest:
+                address, token = self.responded[node_id]
+                if isinstance(token, bytes):
+                    self.dht.send_query(address, b"announce_peer", {
+                        b"info_hash": self.target,
+                        b"port": self.announce_port,
+                        b"token": token,
+                        b"implied_port": 0,
+                    }, None, node_id)
+        if self.on_done is not None:
+            self.on_done([(node_id, self.responded[node_id][0])
+                          for node_id in closest])
+
+
+class DHTNode(object):
+    def __init__(self, port=0, node_id=None, ip="0.0.0.0", state_path=None):
+        """
+        :param port: UDP port to listen on, any free port if 0
+        :param node_id: Our node ID, random if None
+        :param ip: Address to listen on
+        :param state_path: File the node ID and routing table are saved to by
+        save() and loaded from if it exists, so a restarted node can join the
+        DHT without the bootstrap nodes
+        """
+        nodes = []
+        if state_path is not None and os.path.exists(state_path):
+            node_id, nodes = self._load(state_path, node_id)
+        self.node_id = node_id or os.urandom(ID_LENGTH)
+        self.state_path = state_path
+        self.table = RoutingTable(self.node_id)
+        for other_id, address in nodes:
+            # Not heard from yet, so the first failure counts against them
+            self.table.add(other_id, address, last_seen=0)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((ip, port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+
+        self.timer_wheel = timers.TimerWheel()
+        self.transactions = {}  # Transaction ID mapped to Query
+        self.next_transaction = random.randrange(2 ** 16)
+        # Info hash mapped to {(ip, port): unix time announced}
+        self.peers = {}
+        self.secrets = [os.urandom(ID_LENGTH), os.urandom(ID_LENGTH)]
+        self.timer_wheel.schedule(TOKEN_INTERVAL, self._rotate_secret)
+        self.timer_wheel.schedule(REFRESH_CHECK, self._refresh)
+
+        self.handlers = {
+            b"ping": self._handle_ping,
+            b"find_node": self._handle_find_node,
+            b"get_peers": self._handle_get_peers,
+            b"announce_peer": self._handle_announce_peer,
+        }
+
+        label = str(self.port)
+        registry = metrics.REGISTRY
+        registry.gauge("dht_nodes", "Nodes in the DHT routing table",
+                       function=lambda: len(self.table), node=label)
+        registry.gauge("dht_stored_peers", "Peers announced to this node",
+                       function=lambda: sum(len(peers) for peers in
+                                            self.peers.values()),
+                       node=label)
+        self.queries_sent = registry.counter(
+            "dht_queries_sent", "KRPC queries sent", node=label)
+        self.queries_received = registry.counter(
+            "dht_queries_received", "KRPC queries received", node=label)
+        self.query_timeouts = registry.counter(
+            "dht_query_timeouts", "KRPC queries that were not answered",
+            node=label)
+
+    def __str__(self):
+        return "DHTNode: {}".format(self.port)
+
+    @property
+    def address(self):
+        ip = self.sock.getsockname()[0]
+        if ip == "0.0.0.0":
+            ip = "127.0.0.1"
+        return ip, self.port
+
+    @staticmethod
+    def _load(path, node_id):
+        """
+        :return: (node_id, nodes) from a saved state. node_id is kept if it
+        was given. A corrupt state is ignored.
+        """
+        try:
+            with open(path, "rb") as f:
+                state = lazybencode.decode(f.read())
+            saved_id = state.get(b"id")
+            if _is_id(saved_id) and node_id is None:
+                node_id = saved_id
+            return node_id, decode_nodes(state.get(b"nodes"))
+        except (EnvironmentError, ValueError, AttributeError) as e:
+            print("Could not load DHT state {}: {}".format(path, e))
+            return node_id, []
+
+    def save(self, path=None):
+        """
+        Saves the node ID and the nodes of the routing table.
+
+        :param path: File to save to, state_path if None
+        """
+        path = path or self.state_path
+        state = {
+            b"id": self.node_id,
+            b"nodes": encode_nodes(node for node in self.table
+                                   if not node.failures),
+        }
+        # Write to a temporary file first so a crash never leaves a truncated
+        # state behind
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(bencode.encode(state))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary, path)
+
+    def close(self):
+        if self.state_path is not None:
+            self.save()
+        self.sock.close()
+
+    def _send(self, message, address):
+        try:
+            self.sock.sendto(bencode.encode(message), address)
+            return True
+        except socket.error:
+            return False
+
+    def send_query(self, address, method, args, callback, node_id=None):
+        """
+        Sends a query. callback is called as callback(query, reply) with the
+        arguments dict of the response, or None if the query failed or timed
+        out.
+
+        :param address: (ip, port) tuple of the node
+        :param method: KRPC method such as b"ping"
+        :param args: Dict of the query arguments, without our ID
+        :param callback: Called once the query completes, or None
+        :param node_id: ID of the node if known, to track its failures
+        :return: The Query
+        """
+        transaction = struct.pack(b"!H", self.next_transaction)
+        self.next_transaction = (self.next_transaction + 1) % 2 ** 16
+
+        args[b"id"] = self.node_id
+        query = Query(method, address, node_id, callback)
+        self.transactions[transaction] = query
+        sent = self._send({b"t": transaction, b"y": b"q", b"q": method,
+                           b"a": args}, address)
+        self.queries_sent.inc()
+        # A query that could not be sent fails on the next poll
+        query.timer = self.timer_wheel.schedule(
+            QUERY_TIMEOUT if sent else 0, self._on_timeout, transaction)
+        return query
+
+    def _on_timeout(self, transaction):
+        query = self.transactions.pop(transaction, None)
+        if query is None:
+            return
+        self.query_timeouts.inc()
+        if query.node_id is not None:
+            self.table.failed(query.node_id)
+        if query.callback is not None:
+            query.callback(query, None)
+
+    def poll(self):
+        """
+        Handles the packets received and the queries timed out since the last
+        call.
+
+        :return: Number of packets handled
+        """
+        self.timer_wheel.advance()
+        handled = 0
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_PACKET)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return handled
+                # Such as an ICMP error for an earlier packet
+                continue
+            handled += 1
+            try:
+                self.handle_packet(data, address)
+            except Exception as e:
+                # A malformed packet from any host must never stop the node
+                print("Bad DHT packet from {}: {}".format(address, e))
+
+    def handle_packet(self, data, address):
+        try:
+            message = lazybencode.decode(data)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+
+        kind = message.get(b"y")
+        transaction = message.get(b"t")
+        if not isinstance(transaction, bytes):
+            return
+        if kind == b"q":
+            self.handle_query(message, transaction, address)
+        elif kind in (b"r", b"e"):
+            self.handle_response(message, transaction, address)
+
+    def handle_response(self, message, transaction, address):
+        query = self.transactions.get(transaction)
+        if query is None or query.address != address:
+            return
+        del self.transactions[transaction]
+        self.timer_wheel.cancel(query.timer)
+
+        reply = message.get(b"r")
+        if (message.get(b"y") == b"r" and isinstance(reply, dict) and
+                _is_id(reply.get(b"id"))):
+            self.table.add(reply[b"id"], address)
+        else:
+            reply = None
+            if query.node_id is not None:
+                self.table.failed(query.node_id)
+        if query.callback is not None:
+            query.callback(query, reply)
+
+    def handle_query(self, message, transaction, address):
+        self.queries_received.inc()
+        args = message.get(b"a")
+        method = message.get(b"q")
+        handler = None
+        if isinstance(method, bytes):
+            handler = self.handlers.get(method)
+        try:
+            if not isinstance(args, dict) or not _is_id(args.get(b"id")):
+                raise KRPCError(ERROR_PROTOCOL, "Missing node ID")
+            if handler is None:
+                raise KRPCError(ERROR_METHOD_UNKNOWN, "Method Unknown")
+            self.table.add(args[b"id"], address)
+            reply = handler(args, address)
+        except KRPCError as e:
+            self._send({b"t": transaction, b"y": b"e",
+                        b"e": [e.code, e.error_string]}, address)
+            return
+        reply[b"id"] = self.node_id
+        self._send({b"t": transaction, b"y": b"r", b"r": reply}, address)
+
+    def _closest_nodes(self, target):
+        return encode_nodes(self.table.closest(id_to_int(target)))
+
+    def _handle_ping(self, args, address):
+        return {}
+
+    def _handle_find_node(self, args, address):
+        target = args.get(b"target")
+        if not _is_id(target):
+            raise KRPCError(ERROR_PROTOCOL, "Invalid target")
+        return {b"nodes": self._closest_nodes(target)}
+
+    def _handle_get_peers(self, args, address):
+        info_hash = args.get(b"info_hash")
+        if not _is_id(info_hash):
+            raise KRPCError(ERROR_PROTOCOL, "Invalid info_hash")
+        reply = {b"token": self.make_token(address[0])}
+        peers = self.stored_peers(info_hash)
+        if peers:
+            reply[b"values"] = [socket.inet_aton(ip) + struct.pack(b"!H", port)
+                                for ip, port in peers]
+        else:
+            reply[b"nodes"] = self._closest_nodes(info_hash)
+        return reply
+
+    def _handle_announce_peer(self, args, address):
+        info_hash = args.get(b"info_hash")
+        if not _is_id(info_hash):
+            raise KRPCError(ERROR_PROTOCOL, "Invalid info_hash")
+        if not self.is_valid_token(args.get(b"token"), address[0]):
+            raise KRPCError(ERROR_PROTOCOL, "Bad token")
+        port = args.get(b"port")
+        if args.get(b"implied_port"):
+            port = address[1]
+        if not isinstance(port, int) or not 0 < port < 2 ** 16:
+            raise KRPCError(ERROR_PROTOCOL, "Invalid port")
+
+        peers = self.peers.setdefault(info_hash, {})
+        if (address[0], port) in peers or len(peers) < MAX_PEERS_PER_INFO_HASH:
+            peers[(address[0], port)] = time.time()
+        return {}
+
+    def stored_peers(self, info_hash):
+        """
+        :return: Up to MAX_VALUES (ip, port) tuples of the peers announced
+        for the info hash within PEER_TTL seconds
+        """
+        peers = self.peers.get(info_hash)
+        if not peers:
+            return []
+        expired = time.time() - PEER_TTL
+        for address, announced in list(peers.items()):
+            if announced < expired:
+                del peers[address]
+        if not peers:
+            del self.peers[info_hash]
+            return []
+        addresses = list(peers)
+        if len(addresses) > MAX_VALUES:
+            addresses = random.sample(addresses, MAX_VALUES)
+        return addresses
+
+    def make_token(self, ip, secret=None):
+        """
+        A token proves to us that a node announcing a peer did a get_peers
+        from the same IP address before. It is a hash of the IP and a secret
+        so nothing has to be remembered per node.
+        """
+        if secret is None:
+            secret = self.secrets[0]
+        return hashlib.sha1(secret + socket.inet_aton(ip)).digest()[
+            :TOKEN_LENGTH]
+
+    def is_valid_token(self, token, ip):
+        return isinstance(token, bytes) and any(
+            token == self.make_token(ip, secret) for secret in self.secrets)
+
+    def _rotate_secret(self):
+        self.secrets = [os.urandom(ID_LENGTH), self.secrets[0]]
+        self.timer_wheel.schedule(TOKEN_INTERVAL, self._rotate_secret)
+
+    def _refresh(self):
+        for bucket in self.table.stale_buckets(REFRESH_INTERVAL):
+            bucket.last_changed = time.time()
+            self.find_node(int_to_id(random.randrange(bucket.low,
+                                                      bucket.high)))
+        for info_hash in list(self.peers):
+            self.stored_peers(info_hash)  # Drops the expired peers
+        self.timer_wheel.schedule(REFRESH_CHECK, self._refresh)
+
+    def ping(self, address, callback=None):
+        return self.send_query(address, b"ping", {}, callback)
+
+    def find_node(self, target, on_done=None, seeds=()):
+        """
+        Looks up the nodes closest to target, adding the nodes that answer to
+        the routing table.
+
+        :param on_done: Called with the closest nodes, see Lookup
+        :param seeds: Addresses of nodes with unknown IDs to query as well
+        :return: The started Lookup
+        """
+        lookup = Lookup(self, target, b"find_node", on_done=on_done,
+                        seeds=seeds)
+        lookup.start()
+        return lookup
+
+    def get_peers(self, info_hash, on_peers, announce_port=None,
+                  on_done=None):
+        """
+        Looks up the peers of a torrent.
+
+        :param on_peers: Called with a list of tracker.PeerAddress whenever
+        new peers are found
+        :param announce_port: Port we accept peer connections on. If given we
+        are announced as a peer to the closest nodes.
+        :param on_done: Called once the lookup has finished, see Lookup
+        :return: The started Lookup
+        """
+        lookup = Lookup(self, info_hash, b"get_peers", on_peers, on_done,
+                        announce_port)
+        lookup.start()
+        return lookup
+
+    def bootstrap(self, addresses=BOOTSTRAP_NODES, on_done=None):
+        """
+        Joins the DHT by looking up our own ID. The nodes in the routing table
+        are asked first, and the bootstrap nodes as well if the table holds
+        fewer than K nodes.
+
+        :param addresses: (host, port) tuples of the bootstrap nodes
+        :param on_done: Called once the lookup has finished, see Lookup
+        :return: The started Lookup
+        """
+        seeds = []
+        if len(self.table) < K:
+            for host, port in addresses:
+                try:
+                    seeds.append((socket.gethostbyname(host), port))
+                except socket.error as e:
+                    print("Could not resolve DHT node {}: {}".format(host, e))
+        return self.find_node(self.node_id, on_done, seeds)
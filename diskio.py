@@ -0,0 +1,234 @@
+"""
+Disk I/O off the network loop.
+
+DiskIO runs the reads, writes and preallocation of a storage.Storage on a small
+pool of threads, so a slow disk does not stall every peer. Operations are
+queued by the owner and picked up by the threads in batches, which are sorted
+by their offset in the torrent before they are run to keep the disk access
+mostly sequential.
+
+Completed operations are put in a completion queue and their callbacks are run
+by the owner thread from poll(), the same way replies from a
+socketthread.SocketThread are picked up, so callbacks never need any locking.
+
+The bytes of queued writes are counted. Once they pass a high water mark the
+disk is congested and the download stops requesting blocks until the queue has
+drained below a low water mark, which bounds the memory held by pieces waiting
+to be written.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import collections
+import hashlib
+import sys
+import threading
+
+import metrics
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+    import Queue as queue
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+    import queue
+
+# Number of threads doing disk I/O per torrent
+THREAD_COUNT = 4
+# Most operations a thread takes from the queue at once
+BATCH_SIZE = 32
+# Bytes of queued writes at which the disk is congested, and below which it is
+# no longer congested
+HIGH_WATER = 64 * 2 ** 20
+LOW_WATER = 16 * 2 ** 20
+
+DiskOperation = collections.namedtuple(
+    "DiskOperation", ["offset", "size", "function", "args", "callback"])
+
+
+def _verify_and_write(storage, index, data, piece_hash):
+    """
+    :return: True if the piece matched its hash and was written
+    """
+    if hashlib.sha1(data).digest() != piece_hash:
+        return False
+    storage.write_piece(index, data)
+    return True
+
+
+class DiskIO(object):
+    def __init__(self, storage, label="", thread_count=THREAD_COUNT,
+                 high_water=HIGH_WATER, low_water=LOW_WATER):
+        """
+        :param storage: storage.Storage the operations are run on
+        :param label: Name of the torrent used to label metrics
+        :param thread_count: Number of threads
+        :param high_water: Bytes of queued writes at which the disk becomes
+        congested
+        :param low_water: Bytes of queued writes below which the disk is no
+        longer congested
+        """
+        self.storage = storage
+        self.high_water = high_water
+        self.low_water = low_water
+
+        self.condition = threading.Condition()
+        self.operations = collections.deque()  # Guarded by condition
+        self.running = True
+        self.completions = queue.Queue()  # (operation, result, error)
+
+        # Only used by the owner thread
+        self.outstanding = 0  # Operations queued and not completed
+        self.queued_bytes = 0  # Bytes of writes queued and not completed
+        self.congested = False
+
+        registry = metrics.REGISTRY
+        registry.gauge("disk_queue_operations",
+                       "Disk operations queued or running",
+                       function=lambda: self.outstanding, torrent=label)
+        registry.gauge("disk_queue_bytes",
+                       "Bytes of disk writes queued or running",
+                       function=lambda: self.queued_bytes, torrent=label)
+        self.congestions = registry.counter(
+            "disk_congestions",
+            "Times block requests were paused because of the disk queue",
+            torrent=label)
+
+        self.threads = []
+        for _ in range(thread_count):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _submit(self, offset, size, function, args, callback):
+        self.outstanding += 1
+        self.queued_bytes += size
+        with self.condition:
+            self.operations.append(DiskOperation(offset, size, function, args,
+                                                 callback))
+            self.condition.notify()
+
+    def write(self, offset, data, callback=None):
+        """
+        Queues a write of data at the given offset of the torrent.
+
+        :param callback: Called as callback(None, error) once written, where
+        error is None or the EnvironmentError raised
+        """
+        self._submit(offset, len(data), self.storage.write, (offset, data),
+                     callback)
+
+    def write_piece(self, index, data, piece_hash, callback=None):
+        """
+        Queues hashing a complete piece and writing it if it matches its hash.
+
+        :param callback: Called as callback(verified, error)
+        """
+        offset = index * self.storage.metadata.piece_length
+        self._submit(offset, len(data), _verify_and_write,
+                     (self.storage, index, data, piece_hash), callback)
+
+    def read(self, offset, length, callback):
+        """
+        Queues a read of length bytes at the given offset of the torrent.
+
+        :param callback: Called as callback(data, error)
+        """
+        self._submit(offset, 0, self.storage.read, (offset, length), callback)
+
+    def read_piece(self, index, callback):
+        metadata = self.storage.metadata
+        self.read(index * metadata.piece_length, metadata.piece_size(index),
+                  callback)
+
+    def allocate(self, indexes=None, callback=None):
+        """
+        Queues the preallocation of files, see storage.Storage.allocate.
+        """
+        self._submit(0, 0, self.storage.allocate, (indexes,), callback)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.operations:
+                    self.condition.wait()
+                if not self.operations:
+                    return
+                batch = [self.operations.popleft() for _ in
+                         range(min(BATCH_SIZE, len(self.operations)))]
+
+            batch.sort(key=lambda operation: operation.offset)
+            for operation in batch:
+                try:
+                    result = operation.function(*operation.args)
+                    error = None
+                except Exception as e:
+                    # Reported like an I/O error so the operation still
+                    # completes and drain never waits for it forever
+                    result = None
+                    error = e
+                self.completions.put((operation, result, error))
+
+    def _complete(self, completion):
+        operation, result, error = completion
+        self.outstanding -= 1
+        self.queued_bytes -= operation.size
+        if error is not None:
+            print("Disk error: {}".format(error))
+        if operation.callback is not None:
+            operation.callback(result, error)
+
+    def poll(self):
+        """
+        Runs the callbacks of the operations completed since the last call.
+
+        :return: Number of operations completed
+        """
+        completed = 0
+        while True:
+            try:
+                completion = self.completions.get(block=False)
+            except queue.Empty:
+                return completed
+            self._complete(completion)
+            completed += 1
+
+    def drain(self):
+        """
+        Blocks until every queued operation has completed and its callback has
+        been run.
+        """
+        while self.outstanding:
+            self._complete(self.completions.get())
+
+    def is_congested(self):
+        """
+        :return: True while new block requests should not be made because too
+        many bytes are waiting to be written
+        """
+        if self.congested:
+            if self.queued_bytes <= self.low_water:
+                self.congested = False
+        elif self.queued_bytes >= self.high_water:
+            self.congested = True
+            self.congestions.inc()
+        return self.congested
+
+    def close(self):
+        """
+        Completes every queued operation and stops the threads.
+        """
+        self.drain()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,803 @@
+"""
+Downloading of pieces.
+
+Pieces are picked rarest first among the pieces a peer has. Each piece is split
+into blocks of metainfo.BLOCK_SIZE bytes which are requested from the peer,
+keeping up to PIPELINE_DEPTH requests outstanding per peer. Once all blocks of
+a piece have arrived the piece is handed to the disk threads, which verify it
+against its sha1 hash and write it, see diskio.py. No new blocks are requested
+while the disk queue is congested.
+
+Every request is given REQUEST_TIMEOUT seconds to be answered. A request that
+times out is made available to other peers again and the peer is considered
+snubbed, keeping only a single request outstanding with it until it sends a
+block again.
+
+Every file has a priority. A piece gets the highest priority of the files it
+overlaps, so a piece straddling a skipped and a wanted file is still
+downloaded. Pieces are picked by priority first and rarity second, and pieces
+that only hold skipped files are never requested.
+
+In streaming mode a playback offset and rate are set, and the offset is kept up
+to date by the reader. The pieces inside a window ahead of the offset get a
+deadline from the time playback reaches them at that rate and are requested in
+deadline order, from the fastest peers first, before anything else. The rest
+of the torrent is still picked rarest first.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import functools
+import heapq
+import math
+import struct
+import sys
+import threading
+import time
+
+import metainfo
+import metrics
+import peerwire
+import timers
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+# Number of block requests we keep outstanding per unchoked peer
+PIPELINE_DEPTH = 16
+# Number of block requests outstanding with a peer that has snubbed us
+SNUBBED_PIPELINE_DEPTH = 1
+# Seconds a peer has to answer a block request
+REQUEST_TIMEOUT = 30
+
+# Seconds of playback ahead of the playback position whose pieces have a
+# deadline in streaming mode, but at least STREAM_MIN_PIECES pieces
+STREAM_WINDOW = 20
+STREAM_MIN_PIECES = 4
+# Number of fastest peers that deadline pieces are requested from. Slower
+# peers only get a deadline piece once its deadline has passed.
+STREAM_FAST_PEERS = 4
+# Seconds the download rate of a peer is averaged over
+RATE_WINDOW = 10
+
+# File and piece priorities
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 2
+PRIORITY_HIGH = 3
+
+
+class PieceBuffer(object):
+    """
+    Collects the blocks of a single piece until it is complete.
+    """
+
+    def __init__(self, index, size):
+        self.index = index
+        self.size = size
+        self.data = bytearray(size)
+        # Offsets of blocks that have not been requested yet
+        self.pending = list(range(0, size, metainfo.BLOCK_SIZE))
+        self.pending.reverse()  # Request from the start of the piece
+        self.requested = set()  # Offsets of requested blocks
+        self.received = 0  # Number of bytes received
+
+    def block_length(self, begin):
+        return min(metainfo.BLOCK_SIZE, self.size - begin)
+
+    def next_block(self):
+        """
+        :return: (begin, length) of the next block to request or None
+        """
+        if not self.pending:
+            return None
+        begin = self.pending.pop()
+        self.requested.add(begin)
+        return begin, self.block_length(begin)
+
+    def claim_all(self):
+        """
+        Marks every block as requested, for a source that fetches the whole
+        piece at once.
+        """
+        self.requested.update(self.pending)
+        self.pending = []
+
+    def release(self, begin):
+        """
+        Makes a requested block available to be requested again.
+        """
+        if begin in self.requested:
+            self.requested.discard(begin)
+            self.pending.append(begin)
+
+    def add_block(self, begin, block):
+        """
+        :return: True if the block was expected and stored
+        """
+        if begin not in self.requested or len(block) != self.block_length(
+                begin):
+            return False
+        self.requested.discard(begin)
+        self.data[begin:begin + len(block)] = block
+        self.received += len(block)
+        return True
+
+    def is_complete(self):
+        return self.received == self.size
+
+
+class RateMeter(object):
+    """
+    Exponentially decaying average of a byte rate.
+    """
+
+    __slots__ = ("rate", "last")
+
+    def __init__(self):
+        self.rate = 0.0
+        self.last = time.time()
+
+    def _decay(self, now):
+        elapsed = now - self.last
+        if elapsed > 0:
+            self.rate *= math.exp(-elapsed / RATE_WINDOW)
+            self.last = now
+
+    def update(self, amount):
+        self._decay(time.time())
+        self.rate += amount / RATE_WINDOW
+
+    def current(self):
+        """
+        :return: Bytes per second
+        """
+        self._decay(time.time())
+        return self.rate
+
+
+class Download(object):
+    def __init__(self, metadata, disk, label="", timer_wheel=None,
+                 rate_limiter=None):
+        """
+        :param metadata: metainfo.Metadata of the torrent
+        :param disk: diskio.DiskIO the pieces are verified and written by
+        :param label: Name of the torrent used to label metrics
+        :param timer_wheel: timers.TimerWheel the request timeouts are
+        scheduled on. The owner is responsible for advancing it. A new wheel
+        is created if None.
+        :param rate_limiter: If given its take(amount) method is called with
+        the length of every block before it is requested and no more blocks
+        are requested while it returns False.
+        """
+        self.metadata = metadata
+        self.disk = disk
+        if timer_wheel is None:
+            timer_wheel = timers.TimerWheel()
+        self.timer_wheel = timer_wheel
+        self.rate_limiter = rate_limiter
+
+        piece_count = metadata.piece_count
+        self.have = [False] * piece_count  # Verified and written pieces
+        self.have_count = 0
+        self.availability = [0] * piece_count  # Number of peers with a piece
+        # Peer mapped to the Bitfield of its pieces counted in availability
+        self.counted = {}
+        self.active = {}  # Piece index mapped to its PieceBuffer
+        # Complete pieces queued to be hashed and written
+        self.verifying = set()
+        # Peer mapped to a dict of its outstanding (index, begin) requests
+        # mapped to a (time the request was sent, timeout timer) tuple
+        self.requests = {}
+
+        # Pieces verified since the owner last emptied the list
+        self.completed_pieces = []
+        # Notified whenever a piece has been verified, see wait_for_piece
+        self.piece_verified = threading.Condition()
+
+        # (offset, rate, time set) of streaming mode or None, see set_playback
+        self.playback = None
+        self.rates = {}  # Peer mapped to the RateMeter of its blocks
+        # Lowest rate of the STREAM_FAST_PEERS fastest peers and when it was
+        # computed
+        self.fast_rate = 0.0
+        self.fast_rate_time = 0
+
+        self.file_priorities = [PRIORITY_NORMAL] * len(metadata.files)
+        self.piece_priorities = [PRIORITY_NORMAL] * piece_count
+        # Bytes of each piece that belong to files that are not skipped
+        self.wanted_bytes = [metadata.piece_size(index)
+                             for index in range(piece_count)]
+        self.wanted_left = piece_count  # Wanted pieces we do not have yet
+
+        self.downloaded = 0  # Bytes of verified pieces
+        self.left = metadata.total_length  # Bytes of wanted files still missing
+
+        registry = metrics.REGISTRY
+        self.request_latency = registry.histogram(
+            "request_latency_seconds",
+            "Time from sending a block request to receiving the block",
+            torrent=label)
+        registry.gauge("pieces_in_progress",
+                       "Pieces with blocks requested but not yet verified",
+                       function=lambda: len(self.active), torrent=label)
+        registry.gauge("pieces_complete", "Pieces verified and written",
+                       function=lambda: self.have_count, torrent=label)
+        registry.gauge("pieces_verifying",
+                       "Complete pieces waiting to be hashed and written",
+                       function=lambda: len(self.verifying), torrent=label)
+        registry.gauge("requests_outstanding",
+                       "Block requests sent but not yet answered",
+                       function=lambda: sum(len(requests) for requests in
+                                            list(self.requests.values())),
+                       torrent=label)
+        self.requests_timed_out = registry.counter(
+            "requests_timed_out", "Block requests that were not answered in "
+                                  "time and were given to other peers",
+            torrent=label)
+        self.requests_rejected = registry.counter(
+            "requests_rejected", "Block requests rejected by peers using the "
+                                 "Fast extension", torrent=label)
+
+    def is_complete(self):
+        """
+        :return: True once every piece of the files not skipped is verified
+        """
+        return self.wanted_left == 0
+
+    def wanted_files(self):
+        """
+        :return: Indexes of the files that are not skipped
+        """
+        return [index for index, priority in enumerate(self.file_priorities)
+                if priority != PRIORITY_SKIP]
+
+    def _file_pieces(self, file_index):
+        """
+        :return: range of the pieces overlapping a file, empty for an empty
+        file
+        """
+        entry = self.metadata.files[file_index]
+        if not entry.length:
+            return range(0)
+        piece_length = self.metadata.piece_length
+        return range(entry.offset // piece_length,
+                     (entry.offset + entry.length - 1) // piece_length + 1)
+
+    def set_file_priorities(self, priorities):
+        """
+        Sets the priority of every file and derives the piece priorities from
+        them. Pieces we have that overlap a file that was skipped are
+        downloaded again when the file is no longer skipped, as the part of
+        the piece in that file was never written.
+
+        :param priorities: One of the PRIORITY_* constants per file
+        """
+        metadata = self.metadata
+        if len(priorities) != len(metadata.files):
+            raise ValueError("Expected {} priorities but got {}".format(
+                len(metadata.files), len(priorities)))
+
+        piece_length = metadata.piece_length
+        piece_priorities = [PRIORITY_SKIP] * metadata.piece_count
+        wanted_bytes = [0] * metadata.piece_count
+        for file_index, priority in enumerate(priorities):
+            if priority == PRIORITY_SKIP:
+                continue
+            entry = metadata.files[file_index]
+            end = entry.offset + entry.length
+            for index in self._file_pieces(file_index):
+                piece_priorities[index] = max(piece_priorities[index],
+                                              priority)
+                piece_start = index * piece_length
+                wanted_bytes[index] += (
+                    min(end, piece_start + metadata.piece_size(index)) -
+                    max(entry.offset, piece_start))
+
+            if self.file_priorities[file_index] == PRIORITY_SKIP:
+                for index in self._file_pieces(file_index):
+                    if self.have[index]:
+                        self.have[index] = False
+                        self.have_count -= 1
+                        self.downloaded -= metadata.piece_size(index)
+
+        self.file_priorities = list(priorities)
+        with self.piece_verified:
+            self.piece_priorities = piece_priorities
+            # Waiters for pieces that are skipped now give up
+            self.piece_verified.notify_all()
+        self.wanted_bytes = wanted_bytes
+        self.left = sum(wanted for index, wanted in enumerate(wanted_bytes)
+                        if not self.have[index])
+        self.wanted_left = sum(
+            1 for index, priority in enumerate(piece_priorities)
+            if priority != PRIORITY_SKIP and not self.have[index])
+        # Pieces being downloaded that are skipped now are dropped, blocks
+        # still arriving for them are ignored
+        for index in list(self.active):
+            if piece_priorities[index] == PRIORITY_SKIP:
+                del self.active[index]
+
+    def add_peer(self, peer):
+        """
+        Called once a peer has shook hands. Registers the message handlers of
+        the download with the peer and tells the peer we are interested. The
+        pieces the peer announced before, such as while the metadata of a
+        magnet link was downloaded, count towards availability.
+        """
+        self.counted[peer] = peerwire.Bitfield()
+        self._recount(peer, b"")
+        peer.register_handler(peerwire.CHOKE, self._on_choke)
+        peer.register_handler(peerwire.HAVE, self._on_have)
+        peer.register_handler(peerwire.BITFIELD, self._recount)
+        peer.register_handler(peerwire.HAVE_ALL, self._recount)
+        peer.register_handler(peerwire.HAVE_NONE, self._recount)
+        peer.register_handler(peerwire.PIECE, self._on_piece)
+        peer.register_handler(peerwire.REJECT_REQUEST, self._on_reject)
+
+        self.requests[peer] = {}
+        self.rates[peer] = RateMeter()
+        peer.send_message(peerwire.generate_message(peerwire.INTERESTED))
+        peer.am_interested = True
+
+    def remove_peer(self, peer):
+        """
+        Called when a peer is dropped. Its outstanding requests are made
+        available to other peers and its pieces no longer count towards
+        availability.
+        """
+        self._release_requests(peer)
+        self.requests.pop(peer, None)
+        self.rates.pop(peer, None)
+        for index in self.counted.pop(peer, peerwire.Bitfield()).indexes():
+            self.availability[index] -= 1
+
+    def _release_requests(self, peer):
+        requests = self.requests.get(peer, {})
+        for (index, begin), (_, timer) in requests.items():
+            self.timer_wheel.cancel(timer)
+            piece = self.active.get(index)
+            if piece is not None:
+                piece.release(begin)
+        requests.clear()
+
+    def _on_request_timeout(self, peer, index, begin):
+        """
+        Called by the timer wheel when a request has not been answered within
+        REQUEST_TIMEOUT seconds. The block is made available to other peers.
+        """
+        requests = self.requests.get(peer)
+        if requests is None or requests.pop((index, begin), None) is None:
+            return
+        piece = self.active.get(index)
+        if piece is not None:
+            piece.release(begin)
+        peer.snubbed = True
+        self.requests_timed_out.inc()
+
+    def _on_have(self, peer, payload):
+        index = struct.unpack(b">I", payload)[0]
+        counted = self.counted[peer]
+        if index < self.metadata.piece_count and not counted.has_index(index):
+            counted.add_index(index)
+            self.availability[index] += 1
+
+    def _recount(self, peer, payload):
+        """
+        Called once the peer replaced its pieces with a bitfield, have all or
+        have none. What was counted for the peer before is taken back, so a
+        second bitfield or have all is not counted twice.
+        """
+        piece_count = self.metadata.piece_count
+        for index in self.counted[peer].indexes():
+            self.availability[index] -= 1
+        counted = peerwire.Bitfield()
+        for index in peer.bitfield.indexes():
+            if index < piece_count:
+                counted.add_index(index)
+                self.availability[index] += 1
+        self.counted[peer] = counted
+
+    def _on_choke(self, peer, payload):
+        # A choke discards all requests the peer has not answered, unless the
+        # Fast extension is used. Then the peer rejects each of them or still
+        # sends the block, such as for allowed fast pieces.
+        if not peer.fast_extension:
+            self._release_requests(peer)
+
+    def _on_reject(self, peer, payload):
+        """
+        The peer will not send a block we requested, see the Fast extension.
+        The block is made available to other peers.
+        """
+        index, begin, _ = peerwire.REQUEST_PAYLOAD.unpack(payload)
+        request = self.requests.get(peer, {}).pop((index, begin), None)
+        if request is None:
+            return
+        self.timer_wheel.cancel(request[1])
+        piece = self.active.get(index)
+        if piece is not None:
+            piece.release(begin)
+        if peer.peer_choking:
+            # Do not ask again until we are unchoked
+            peer.allowed_fast.discard(index)
+        self.requests_rejected.inc()
+
+    def _on_piece(self, peer, payload):
+        index, begin, block = peerwire.decode_piece(payload)
+        self.receive_block(peer, index, begin, block)
+
+    def receive_block(self, peer, index, begin, block):
+        """
+        Stores a received block. Once the piece is complete it is queued to be
+        verified and written, after which it is appended to completed_pieces.
+        """
+        request = self.requests.get(peer, {}).pop((index, begin), None)
+        if request is not None:
+            sent, timer = request
+            self.timer_wheel.cancel(timer)
+            self.request_latency.observe(time.time() - sent)
+            peer.snubbed = False
+            rate = self.rates.get(peer)
+            if rate is not None:
+                rate.update(len(block))
+
+        piece = self.active.get(index)
+        if piece is None or not piece.add_block(begin, block):
+            return  # Not requested, possibly a duplicate
+
+        if not piece.is_complete():
+            return
+
+        del self.active[index]
+        self.verifying.add(index)
+        self.disk.write_piece(index, piece.data,
+                              self.metadata.piece_hash(index),
+                              functools.partial(self._on_piece_written, index,
+                                                piece.size))
+
+    def _on_piece_written(self, index, size, verified, error):
+        """
+        Called by the disk once a complete piece has been hashed and written.
+        """
+        self.verifying.discard(index)
+        if not verified:
+            return  # Hash or write failed, the piece will be picked again
+
+        self.have[index] = True
+        self.have_count += 1
+        self.downloaded += size
+        self.left -= self.wanted_bytes[index]
+        if self.piece_priorities[index] != PRIORITY_SKIP:
+            self.wanted_left -= 1
+        self.completed_pieces.append(index)
+        with self.piece_verified:
+            self.piece_verified.notify_all()
+
+    def wait_for_piece(self, index, timeout=None):
+        """
+        Blocks until a piece has been verified and written. Can be called from
+        any thread.
+
+        :param index: Piece index
+        :param timeout: Most seconds to wait, forever if None
+        :return: True if the piece is available, False if it is not within
+        timeout or only holds skipped files and is never downloaded
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.piece_verified:
+            while not self.have[index]:
+                if self.piece_priorities[index] == PRIORITY_SKIP:
+                    return False
+                if end is None:
+                    self.piece_verified.wait()
+                    continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.piece_verified.wait(remaining)
+        return True
+
+    def set_playback(self, offset, rate=0):
+        """
+        Turns on streaming mode or moves the playback offset. Can be called
+        from any thread.
+
+        :param offset: Byte offset in the torrent being played, None to turn
+        streaming mode off
+        :param rate: Bytes per second the playback advances at
+        """
+        if offset is None:
+            self.playback = None
+        else:
+            self.playback = (offset, rate, time.time())
+
+    def _is_fast(self, peer):
+        """
+        :return: True if the peer is among the STREAM_FAST_PEERS fastest
+        peers
+        """
+        now = time.time()
+        if now - self.fast_rate_time >= 1:
+            fastest = heapq.nlargest(STREAM_FAST_PEERS,
+                                     (rate.current()
+                                      for rate in self.rates.values()))
+            self.fast_rate = fastest[-1] if fastest else 0.0
+            self.fast_rate_time = now
+        rate = self.rates.get(peer)
+        return rate is not None and rate.current() >= self.fast_rate
+
+    def next_deadline_request(self, peer):
+        """
+        Picks the block with the earliest deadline in the streaming window
+        that the peer may be asked for.
+
+        :return: (index, begin, length) or None
+        """
+        playback = self.playback
+        if playback is None:
+            return None
+        offset, rate, since = playback
+        metadata = self.metadata
+        piece_length = metadata.piece_length
+
+        now = time.time()
+        offset = min(offset, metadata.total_length - 1)
+        window = max(rate * STREAM_WINDOW, piece_length * STREAM_MIN_PIECES)
+        first = offset // piece_length
+        last = min(metadata.piece_count - 1,
+                   int((offset + window) // piece_length))
+        fast = self._is_fast(peer)
+
+        for index in range(first, last + 1):
+            if (self.have[index] or index in self.verifying or
+                    self.piece_priorities[index] == PRIORITY_SKIP):
+                continue
+            if not peer.bitfield.has_index(index):
+                continue
+            if not fast:
+                deadline = since
+                if rate > 0:
+                    deadline += (index * piece_length - offset) / rate
+                if deadline > now:
+                    continue  # Left for the fast peers
+
+            piece = self.active.get(index)
+            if piece is None:
+                piece = PieceBuffer(index, metadata.piece_size(index))
+                self.active[index] = piece
+            elif not piece.pending:
+                continue
+            begin, length = piece.next_block()
+            return index, begin, length
+        return None
+
+    def pick_piece(self, peer):
+        """
+        Picks the piece with the highest priority, and the rarest among those,
+        that the peer has and that we neither have nor are downloading
+        already. Skipped pieces are never picked.
+
+        :return: Piece index or None
+        """
+        best = None
+        best_priority = PRIORITY_SKIP
+        best_availability = None
+        availability = self.availability
+        priorities = self.piece_priorities
+        for index in range(self.metadata.piece_count):
+            priority = priorities[index]
+            if priority < best_priority or priority == PRIORITY_SKIP:
+                continue
+            if (self.have[index] or index in self.active or
+                    index in self.verifying):
+                continue
+            if not peer.bitfield.has_index(index):
+                continue
+            if (priority > best_priority or
+                    availability[index] < best_availability):
+                best = index
+                best_priority = priority
+                best_availability = availability[index]
+        return best
+
+    def _is_wanted(self, index):
+        """
+        :return: True if the piece should be downloaded and is neither
+        verified nor waiting to be
+        """
+        return (self.piece_priorities[index] != PRIORITY_SKIP and
+                not self.have[index] and index not in self.verifying)
+
+    def _next_block_of(self, peer, indexes):
+        """
+        :param indexes: Piece indexes to choose from, in order of preference
+        :return: (index, begin, length) of the first block not requested yet
+        of the first of the pieces that the peer has and that we want, or None
+        """
+        for index in indexes:
+            if not self._is_wanted(index) or not peer.bitfield.has_index(index):
+                continue
+            piece = self.active.get(index)
+            if piece is None:
+                piece = PieceBuffer(index, self.metadata.piece_size(index))
+                self.active[index] = piece
+            if piece.pending:
+                begin, length = piece.next_block()
+                return index, begin, length
+        return None
+
+    def next_allowed_fast_request(self, peer):
+        """
+        :return: (index, begin, length) of the next block of the allowed fast
+        pieces of a peer that is choking us, or None
+        """
+        return self._next_block_of(peer, sorted(peer.allowed_fast))
+
+    def next_request(self, peer):
+        """
+        :return: (index, begin, length) of the next block to request from the
+        peer or None if there is nothing to request
+        """
+        request = self.next_deadline_request(peer)
+        if request is not None:
+            return request
+
+        # Pieces already started are finished first, the ones with the
+        # highest priority before the others
+        best = None
+        for index, piece in self.active.items():
+            if (piece.pending and self._is_wanted(index) and
+                    peer.bitfield.has_index(index) and
+                    (best is None or self.piece_priorities[index] >
+                     self.piece_priorities[best])):
+                best = index
+        if best is not None:
+            begin, length = self.active[best].next_block()
+            return best, begin, length
+
+        if peer.suggested_pieces:
+            suggested = [index for index in peer.suggested_pieces
+                         if index not in self.active and self._is_wanted(index)]
+            peer.suggested_pieces.intersection_update(suggested)
+            request = self._next_block_of(peer, suggested)
+            if request is not None:
+                return request
+
+        index = self.pick_piece(peer)
+        if index is None:
+            return None
+        piece = PieceBuffer(index, self.metadata.piece_size(index))
+        self.active[index] = piece
+        begin, length = piece.next_block()
+        return index, begin, length
+
+    def claim_run(self, max_pieces):
+        """
+        Claims a run of consecutive pieces for a source that has every piece
+        and fetches whole pieces, such as a web seed. The run starts at the
+        first unclaimed piece with the highest priority. All blocks of the
+        pieces are marked requested so peers do not request them.
+
+        :param max_pieces: Most pieces in the run
+        :return: List of the claimed piece indexes, empty if there is nothing
+        left to claim
+        """
+        def claimable(index):
+            return (self.piece_priorities[index] != PRIORITY_SKIP and
+                    not self.have[index] and index not in self.active and
+                    index not in self.verifying)
+
+        first = None
+        for index in range(self.metadata.piece_count):
+            if claimable(index) and (first is None or
+                                     self.piece_priorities[index] >
+                                     self.piece_priorities[first]):
+                first = index
+        if first is None:
+            return []
+
+        run = []
+        index = first
+        while (index < self.metadata.piece_count and len(run) < max_pieces and
+               claimable(index)):
+            piece = PieceBuffer(index, self.metadata.piece_size(index))
+            piece.claim_all()
+            self.active[index] = piece
+            run.append(index)
+            index += 1
+        return run
+
+    def release_run(self, indexes):
+        """
+        Makes the pieces of a claimed run that did not arrive available to
+        peers and other web seeds again. No block of a claimed piece is ever
+        requested from a peer, so the pieces are simply dropped.
+        """
+        for index in indexes:
+            self.active.pop(index, None)
+
+    def receive_run(self, source, indexes, data):
+        """
+        Stores the data of a claimed run, splitting it into blocks that are
+        handled like blocks from a peer.
+
+        :param source: The source the run was fetched from
+        :param indexes: The piece indexes of the run
+        :param data: The data of all the pieces
+        """
+        data = memoryview(data)
+        position = 0
+        for index in indexes:
+            size = self.metadata.piece_size(index)
+            for begin in range(0, size, metainfo.BLOCK_SIZE):
+                end = min(begin + metainfo.BLOCK_SIZE, size)
+                self.receive_block(source, index, begin,
+                                   data[position + begin:position + end])
+            position += size
+
+    def expect_block(self, peer, index, begin):
+        """
+        Marks a block as requested from the peer without sending a request.
+        Used when replaying traces where the requests were made by the
+        recorded run.
+        """
+        if self.have[index] or index in self.verifying:
+            return
+        piece = self.active.get(index)
+        if piece is None:
+            piece = PieceBuffer(index, self.metadata.piece_size(index))
+            self.active[index] = piece
+        if begin in piece.pending:
+            piece.pending.remove(begin)
+            piece.requested.add(begin)
+        requests = self.requests.setdefault(peer, {})
+        requests[(index, begin)] = (time.time(), None)
+
+    def fill_requests(self, peer):
+        """
+        Sends requests to the peer until PIPELINE_DEPTH requests are
+        outstanding, or SNUBBED_PIPELINE_DEPTH if the peer has snubbed us, as
+        long as the disk is not congested. While the peer is choking us only
+        blocks of its allowed fast pieces are requested.
+        """
+        requests = self.requests.get(peer)
+        if requests is None or self.disk.is_congested():
+            return
+        choked = peer.peer_choking
+        if choked and not peer.allowed_fast:
+            return
+
+        depth = SNUBBED_PIPELINE_DEPTH if peer.snubbed else PIPELINE_DEPTH
+        messages = []
+        now = time.time()
+        while len(requests) < depth:
+            if choked:
+                request = self.next_allowed_fast_request(peer)
+            else:
+                request = self.next_request(peer)
+            if request is None:
+                break
+            index, begin, length = request
+            if (self.rate_limiter is not None and
+                    not self.rate_limiter.take(length)):
+                self.active[index].release(begin)
+                break
+            timer = self.timer_wheel.schedule(REQUEST_TIMEOUT,
+                                              self._on_request_timeout, peer,
+                                              index, begin)
+            requests[(index, begin)] = (now, timer)
+            messages.append(peerwire.generate_request(index, begin, length))
+
+        if messages:
+            peer.send_message(b"".join(messages))
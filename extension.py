@@ -0,0 +1,251 @@
+"""
+Extension protocol (BEP 10), peer exchange (ut_pex, BEP 11) and metadata
+exchange (ut_metadata, BEP 9).
+
+Support for the extension protocol is signalled by setting bit 20 from the
+right (0x10 in the sixth byte) of the reserved bytes in the handshake. Once
+both sides support it, all extension messages are sent with message id 20:
+
+<len=0002+X><id=20><extended message id><payload>
+
+An extended message id of 0 is the extended handshake whose payload is a
+bencoded dictionary. Its 'm' key maps the names of supported extensions to the
+extended message ids the sender wants to receive them with. A peer that can
+send the info dict of the torrent also puts its size in 'metadata_size'.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import socket
+import struct
+import sys
+
+import bencode
+import lazybencode
+import tracker
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+EXTENDED = 20  # The peer wire message id of all extension messages
+HANDSHAKE_ID = 0  # Extended message id of the extended handshake
+
+RESERVED_BYTE = 5
+RESERVED_BIT = 0x10
+
+CLIENT_NAME = b"simple-pytorrent 0001"
+
+# The extensions we support mapped to the extended message id we want to
+# receive them with.
+LOCAL_EXTENSIONS = {
+    b"ut_pex": 1,
+    b"ut_metadata": 2,
+}
+
+# BEP 11: No more than 50 added and 50 dropped peers per ut_pex message
+PEX_MAX_PEERS = 50
+# BEP 11: ut_pex messages must not be sent more often than once a minute
+PEX_INTERVAL = 60
+
+# BEP 9: The info dict is exchanged in pieces of 16 KiB, the last one may be
+# shorter
+METADATA_PIECE_SIZE = 2 ** 14
+# ut_metadata message types
+METADATA_REQUEST = 0
+METADATA_DATA = 1
+METADATA_REJECT = 2
+
+
+def set_reserved_bit(reserved):
+    """
+    Sets the extension protocol bit in the 8 reserved handshake bytes.
+
+    :param reserved: 8 byte string
+    :return: 8 byte string with the extension bit set
+    """
+    reserved = bytearray(reserved)
+    reserved[RESERVED_BYTE] |= RESERVED_BIT
+    return bytes(reserved)
+
+
+def supports_extensions(reserved):
+    """
+    :param reserved: The 8 reserved bytes of a received handshake
+    :return: True if the extension protocol bit is set
+    """
+    return bool(bytearray(reserved)[RESERVED_BYTE] & RESERVED_BIT)
+
+
+def generate_extended_message(extended_id, payload):
+    """
+    Wraps a payload into a complete, length prefixed, extension message.
+
+    :param extended_id: The extended message id as announced by the receiver
+    :param payload: Raw payload bytes
+    :return: Byte string ready to be sent
+    """
+    header = struct.pack(b">IBB", len(payload) + 2, EXTENDED, extended_id)
+    return header + payload
+
+
+def generate_extended_handshake(listen_port=None, metadata_size=None):
+    """
+    Generates the extended handshake announcing LOCAL_EXTENSIONS.
+
+    :param listen_port: The port we are accepting connections on, if any
+    :param metadata_size: Size of the info dict if we have it and can send it
+    through ut_metadata
+    :return: Byte string ready to be sent
+    """
+    handshake = {
+        b"m": LOCAL_EXTENSIONS,
+        b"v": CLIENT_NAME,
+    }
+    if listen_port is not None:
+        handshake[b"p"] = listen_port
+    if metadata_size is not None:
+        handshake[b"metadata_size"] = metadata_size
+
+    return generate_extended_message(HANDSHAKE_ID, bencode.encode(handshake))
+
+
+def decode_extended(payload):
+    """
+    Splits the payload of an id 20 message into the extended message id and
+    the rest of the payload.
+
+    :param payload: Message payload without the peer wire message id
+    :return: (extended message id, payload) tuple
+    """
+    if not payload:
+        raise ValueError("Empty extension message")
+    return bytearray(payload[0:1])[0], payload[1:]
+
+
+def decode_extended_handshake(payload):
+    """
+    :param payload: The payload of an extended handshake
+    :return: The decoded handshake dictionary. The 'm' key is always present.
+    """
+    handshake = lazybencode.decode(payload)
+    if not isinstance(handshake, dict):
+        raise ValueError("Extended handshake is not a dictionary")
+    if not isinstance(handshake.get(b"m"), dict):
+        handshake[b"m"] = {}
+    return handshake
+
+
+def generate_metadata_message(extended_id, msg_type, piece, total_size=None,
+                              data=b""):
+    """
+    Generates a ut_metadata message. Data messages carry the piece of the info
+    dict right after the bencoded dictionary.
+
+    :param extended_id: The receiver's extended message id for ut_metadata
+    :param msg_type: One of the METADATA_* message types
+    :param piece: Index of the 16 KiB piece of the info dict
+    :param total_size: Size of the whole info dict, only for data messages
+    :param data: The piece, only for data messages
+    :return: Byte string ready to be sent
+    """
+    message = {b"msg_type": msg_type, b"piece": piece}
+    if total_size is not None:
+        message[b"total_size"] = total_size
+    return generate_extended_message(extended_id,
+                                     bencode.encode(message) + bytes(data))
+
+
+def decode_metadata_message(payload):
+    """
+    Decodes the payload of a ut_metadata message.
+
+    :param payload: The payload after the extended message id
+    :return: (msg_type, piece, total_size, data) tuple. total_size is None and
+    data empty unless it is a data message.
+    :raise ValueError: If the message is malformed
+    """
+    decoder = lazybencode.Decoder(payload)
+    message, end = decoder.decode_at(0)
+    if not isinstance(message, dict):
+        raise ValueError("ut_metadata message is not a dictionary")
+    msg_type = message.get(b"msg_type")
+    piece = message.get(b"piece")
+    if not isinstance(msg_type, int) or not isinstance(piece, int):
+        raise ValueError("ut_metadata message without msg_type or piece")
+    total_size = message.get(b"total_size")
+    if not isinstance(total_size, int):
+        total_size = None
+    return msg_type, piece, total_size, decoder.data[end:]
+
+
+def _compact_peers(addresses):
+    """
+    Packs peer addresses into the compact IPv4 and IPv6 formats.
+
+    :return: (compact IPv4 string, compact IPv6 string) tuple
+    """
+    peers = []
+    peers6 = []
+    for address in addresses:
+        if ":" in address.ip:
+            ip = socket.inet_pton(socket.AF_INET6, address.ip)
+            peers6.append(tracker.COMPACT_PEER6.pack(ip, address.port))
+        else:
+            ip = socket.inet_aton(address.ip)
+            peers.append(tracker.COMPACT_PEER.pack(ip, address.port))
+    return b"".join(peers), b"".join(peers6)
+
+
+def generate_pex(extended_id, added, dropped):
+    """
+    Generates a ut_pex message.
+
+    :param extended_id: The receiver's extended message id for ut_pex
+    :param added: Peer addresses we connected to since the last message. Only
+    the first PEX_MAX_PEERS are sent.
+    :param dropped: Peer addresses we disconnected from since the last message.
+    Only the first PEX_MAX_PEERS are sent.
+    :return: Byte string ready to be sent
+    """
+    added, added6 = _compact_peers(list(added)[:PEX_MAX_PEERS])
+    dropped, dropped6 = _compact_peers(list(dropped)[:PEX_MAX_PEERS])
+
+    message = {
+        b"added": added,
+        b"added.f": b"\x00" * (len(added) // tracker.COMPACT_PEER.size),
+        b"added6": added6,
+        b"added6.f": b"\x00" * (len(added6) // tracker.COMPACT_PEER6.size),
+        b"dropped": dropped,
+        b"dropped6": dropped6,
+    }
+    return generate_extended_message(extended_id, bencode.encode(message))
+
+
+def decode_pex(payload):
+    """
+    Decodes the payload of a ut_pex message.
+
+    :param payload: The payload after the extended message id
+    :return: (added, dropped) tuple of sets of tracker.PeerAddress
+    """
+    message = lazybencode.decode(payload)
+    if not isinstance(message, dict):
+        raise ValueError("ut_pex message is not a dictionary")
+
+    added = set(tracker.binary_peer_extract(message.get(b"added", b"")))
+    added.update(tracker.binary_peer6_extract(message.get(b"added6", b"")))
+
+    dropped = set(tracker.binary_peer_extract(message.get(b"dropped", b"")))
+    dropped.update(tracker.binary_peer6_extract(message.get(b"dropped6",
+                                                            b"")))
+    return added, dropped
@@ -0,0 +1,228 @@
+"""
+Lazy bencode decoder.
+
+Decodes bencoded data directly from the buffer it was read into instead of
+building the whole object tree up front. This matters for big .torrent files
+where the 'pieces' string can be several MB and the 'files' list can hold
+thousands of entries.
+
+The decoder keeps track of the raw byte span of the top level 'info'
+dictionary so that the info hash can be calculated from the original bytes
+rather than re-encoding the decoded dictionary.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import sys
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+INTEGER = b"i"
+LIST = b"l"
+DICT = b"d"
+END = b"e"
+COLON = b":"
+
+# Keys of a .torrent file that benefit from not being decoded eagerly
+TORRENT_VIEW_KEYS = (b"pieces",)
+TORRENT_LAZY_KEYS = (b"files",)
+
+
+class MetaInfo(dict):
+    """
+    A plain dict holding the decoded top level dictionary. raw_info is a zero
+    copy memoryview of the bencoded 'info' dictionary exactly as it appeared in
+    the decoded data, or None if there was no 'info' key.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MetaInfo, self).__init__(*args, **kwargs)
+        self.raw_info = None
+
+
+class LazyList(object):
+    """
+    A read only sequence of bencoded values that are decoded only when they
+    are accessed. The offsets of the items are found on first use by skipping
+    over the raw data, which does not create any objects.
+    """
+
+    def __init__(self, decoder, start):
+        self._decoder = decoder
+        self._start = start
+        self._offsets = None
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            offsets = []
+            data = self._decoder.data
+            pos = self._start + 1  # skip the 'l'
+            while data[pos:pos + 1] != END:
+                offsets.append(pos)
+                pos = self._decoder.skip(pos)
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self):
+        return len(self._get_offsets())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        offset = self._get_offsets()[index]
+        return self._decoder.decode_at(offset)[0]
+
+    def __iter__(self):
+        for offset in self._get_offsets():
+            yield self._decoder.decode_at(offset)[0]
+
+    def __repr__(self):
+        return "<LazyList of {} items>".format(len(self))
+
+
+class Decoder(object):
+    """
+    Decodes values out of a single bencoded buffer.
+
+    :param data: The bencoded byte string
+    :param view_keys: Dict keys whose string values are returned as zero copy
+    memoryview slices of the buffer instead of byte strings.
+    :param lazy_keys: Dict keys whose list values are returned as a LazyList.
+    """
+
+    def __init__(self, data, view_keys=(), lazy_keys=()):
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        self.view_keys = frozenset(view_keys)
+        self.lazy_keys = frozenset(lazy_keys)
+
+    def _string_bounds(self, pos):
+        """
+        Finds the start and end of the string starting at pos.
+
+        :return: (start, end) tuple of the string content
+        """
+        colon = self.data.index(COLON, pos)
+        length = int(self.data[pos:colon])
+        start = colon + 1
+        end = start + length
+        if length < 0 or end > len(self.data):
+            raise ValueError("Invalid string length at {}".format(pos))
+        return start, end
+
+    def skip(self, pos):
+        """
+        Finds the end of the value starting at pos without decoding it.
+
+        :param pos: Offset of the first byte of the value
+        :return: Offset of the first byte after the value
+        """
+        data = self.data
+        token = data[pos:pos + 1]
+        if token == INTEGER:
+            return data.index(END, pos) + 1
+        elif token == LIST or token == DICT:
+            pos += 1
+            while data[pos:pos + 1] != END:
+                if pos >= len(data):
+                    raise ValueError("Unterminated list or dict")
+                pos = self.skip(pos)
+            return pos + 1
+        elif token.isdigit():
+            return self._string_bounds(pos)[1]
+        raise ValueError("Invalid bencode token {} at {}".format(repr(token),
+                                                                  pos))
+
+    def decode_at(self, pos, top_level=False):
+        """
+        Decodes the value starting at pos.
+
+        :param pos: Offset of the first byte of the value
+        :param top_level: True if this is the outermost value. Only the info
+        dict of the outermost dict has its raw span recorded.
+        :return: (value, end) tuple where end is the offset after the value
+        """
+        data = self.data
+        token = data[pos:pos + 1]
+        if token == INTEGER:
+            end = data.index(END, pos)
+            return int(data[pos + 1:end]), end + 1
+        elif token == LIST:
+            result = []
+            pos += 1
+            while data[pos:pos + 1] != END:
+                if pos >= len(data):
+                    raise ValueError("Unterminated list")
+                value, pos = self.decode_at(pos)
+                result.append(value)
+            return result, pos + 1
+        elif token == DICT:
+            result = MetaInfo() if top_level else {}
+            pos += 1
+            while data[pos:pos + 1] != END:
+                if pos >= len(data):
+                    raise ValueError("Unterminated dict")
+                start, end = self._string_bounds(pos)
+                key = data[start:end]
+                pos = end
+
+                if key in self.view_keys and data[pos:pos + 1].isdigit():
+                    start, end = self._string_bounds(pos)
+                    value = self.view[start:end]
+                elif key in self.lazy_keys and data[pos:pos + 1] == LIST:
+                    value = LazyList(self, pos)
+                    end = self.skip(pos)
+                else:
+                    value, end = self.decode_at(pos)
+
+                if top_level and key == b"info":
+                    result.raw_info = self.view[pos:end]
+
+                result[key] = value
+                pos = end
+            return result, pos + 1
+        elif token.isdigit():
+            start, end = self._string_bounds(pos)
+            return data[start:end], end
+        raise ValueError("Invalid bencode token {} at {}".format(repr(token),
+                                                                  pos))
+
+
+def decode(data, view_keys=(), lazy_keys=()):
+    """
+    Decodes a bencoded byte string. Dicts are returned as normal dicts except
+    the outermost which is returned as a MetaInfo.
+
+    :param data: Bencoded byte string
+    :param view_keys: Keys whose string values are returned as memoryviews.
+    :param lazy_keys: Keys whose list values are returned as LazyLists.
+    :return: The decoded value
+    """
+    decoder = Decoder(data, view_keys, lazy_keys)
+    value, end = decoder.decode_at(0, top_level=True)
+    if end != len(decoder.data):
+        raise ValueError("Trailing data after bencoded value")
+    return value
+
+
+def decode_torrent(data):
+    """
+    Decodes the content of a .torrent file. The 'pieces' string is a
+    memoryview into data, the 'files' list is decoded lazily and the raw bytes
+    of the info dict are available as meta_info.raw_info.
+
+    :param data: Content of a .torrent file
+    :return: MetaInfo dict
+    """
+    return decode(data, TORRENT_VIEW_KEYS, TORRENT_LAZY_KEYS)
@@ -0,0 +1,700 @@
+"""
+A complete swarm running on localhost.
+
+Generates a synthetic torrent, serves it from in-process seeders and announces
+the seeders through a local HTTP tracker stub. The torrent can also be served
+by local HTTP web seeds, or be trackerless with the seeders announced to a
+cluster of local DHT nodes. The seeders send the info dict through ut_metadata
+so the torrent can also be started from its magnet link. Used by benchmark.py
+to measure full downloads without depending on the network.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import binascii
+import hashlib
+import os
+import random
+import re
+import select
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import bencode
+import dht
+import extension
+import peerwire
+import socketthread
+import tracker
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+    import BaseHTTPServer as http_server
+    import Queue as queue
+    import SocketServer as socketserver
+    from urllib import quote, unquote
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+    import http.server as http_server
+    import queue
+    import socketserver
+    from urllib.parse import quote, unquote
+
+HANDSHAKE_SIZE = 68  # 49 + len("BitTorrent protocol")
+CHUNK_SIZE = 2 ** 16  # Size of the random chunk synthetic data is tiled from
+
+
+def synthetic_data(size, seed=0):
+    """
+    Generates size bytes of reproducible pseudo random data.
+
+    :param size: Number of bytes
+    :param seed: Seed of the random generator
+    :return: Byte string
+    """
+    rng = random.Random(seed)
+    chunk = bytes(bytearray(rng.getrandbits(8) for _ in range(CHUNK_SIZE)))
+    # Prefix each chunk with its number so pieces do not repeat
+    parts = []
+    for number in range(size // CHUNK_SIZE + 1):
+        parts.append(struct.pack(b">Q", number) + chunk[8:])
+    return b"".join(parts)[:size]
+
+
+def make_meta_info(data, piece_length, announce_url, name="synthetic",
+                   file_count=1):
+    """
+    Creates the meta info of a torrent containing data.
+
+    :param data: The content of the torrent
+    :param piece_length: Number of bytes per piece
+    :param announce_url: URL of the tracker
+    :param name: Name of the torrent
+    :param file_count: The data is split evenly into this many files. A single
+    file torrent is created if 1.
+    :return: Meta info dict ready to be bencoded
+    """
+    pieces = b"".join(hashlib.sha1(data[i:i + piece_length]).digest()
+                      for i in range(0, len(data), piece_length))
+    info = {
+        b"name": name.encode("utf-8"),
+        b"piece length": piece_length,
+        b"pieces": pieces,
+    }
+
+    if file_count == 1:
+        info[b"length"] = len(data)
+    else:
+        file_length = len(data) // file_count
+        files = []
+        for number in range(file_count):
+            length = file_length
+            if number == file_count - 1:
+                length = len(data) - file_length * (file_count - 1)
+            path = "file{:04d}.bin".format(number).encode("utf-8")
+            files.append({b"length": length, b"path": [path]})
+        info[b"files"] = files
+
+    return {
+        b"announce": announce_url.encode("utf-8"),
+        b"announce-list": [[announce_url.encode("utf-8")]],
+        b"info": info,
+    }
+
+
+class SeederHandler(socketserver.BaseRequestHandler):
+    """
+    Serves every requested block of the torrent to a single connection. The
+    peer is unchoked unchoke_delay seconds after it is interested. With the
+    Fast extension requests made while choked are rejected unless they are
+    for allowed fast pieces. Pieces of the info dict are sent to peers that
+    support the extension protocol.
+    """
+
+    def setup(self):
+        self.server.connections.add(self.request)
+        self.lock = threading.Lock()  # Held while sending
+        self.choking = True
+        self.unchoke_timer = None
+
+    def finish(self):
+        self.server.connections.discard(self.request)
+        if self.unchoke_timer is not None:
+            self.unchoke_timer.cancel()
+
+    def send(self, message):
+        with self.lock:
+            self.request.sendall(message)
+
+    def unchoke(self):
+        with self.lock:
+            self.choking = False
+            try:
+                self.request.sendall(peerwire.generate_message(
+                    peerwire.UNCHOKE))
+            except socket.error:
+                pass
+
+    def handle(self):
+        server = self.server
+        sock = self.request
+
+        handshake = socketthread.receive_all(sock, HANDSHAKE_SIZE)
+        if len(handshake) != HANDSHAKE_SIZE:
+            return
+        decoded = peerwire.decode_handshake(handshake)
+        if decoded['info_hash'] != server.info_hash:
+            return
+        fast = server.fast and peerwire.supports_fast(decoded['reserved'])
+        extended = extension.supports_extensions(decoded['reserved'])
+
+        reserved = extension.set_reserved_bit(peerwire.NO_RESERVED)
+        if server.fast:
+            reserved = peerwire.set_fast_bit(reserved)
+        self.send(peerwire.generate_handshake(server.info_hash,
+                                              server.peer_id, reserved))
+        allowed_fast = set()
+        if fast:
+            self.send(peerwire.generate_message(peerwire.HAVE_ALL))
+            if server.unchoke_delay:
+                allowed_fast.update(peerwire.allowed_fast_set(
+                    server.info_hash, self.client_address[0],
+                    server.piece_count))
+                self.send(b"".join(peerwire.generate_allowed_fast(index)
+                                   for index in sorted(allowed_fast)))
+        else:
+            self.send(peerwire.generate_message(peerwire.BITFIELD,
+                                                server.bitfield))
+        if extended:
+            self.send(extension.generate_extended_handshake(
+                metadata_size=len(server.raw_info)))
+        metadata_id = None  # The peer's extended message id for ut_metadata
+
+        data = server.data
+        piece_length = server.piece_length
+        while True:
+            prefix = socketthread.receive_all(sock, 4)
+            if len(prefix) != 4:
+                return
+            length = struct.unpack(b">I", prefix)[0]
+            if length == 0:
+                continue  # keep-alive
+            message = socketthread.receive_all(sock, length)
+            if len(message) != length:
+                return
+
+            message_id = bytearray(message[0:1])[0]
+            if message_id == peerwire.INTERESTED:
+                if not server.unchoke_delay:
+                    self.unchoke()
+                elif self.unchoke_timer is None:
+                    self.unchoke_timer = threading.Timer(server.unchoke_delay,
+                                                         self.unchoke)
+                    self.unchoke_timer.daemon = True
+                    self.unchoke_timer.start()
+            elif message_id == peerwire.REQUEST:
+                index, begin, block_length = peerwire.REQUEST_PAYLOAD.unpack(
+                    message[1:])
+                if self.choking and index not in allowed_fast:
+                    if fast:
+                        self.send(peerwire.generate_reject(index, begin,
+                                                           block_length))
+                    continue
+                offset = index * piece_length + begin
+                block = data[offset:offset + block_length]
+                self.send(peerwire.generate_piece(index, begin, block))
+                server.blocks_served += 1
+            elif message_id == extension.EXTENDED and extended:
+                extended_id, payload = extension.decode_extended(message[1:])
+                if extended_id == extension.HANDSHAKE_ID:
+                    metadata_id = extension.decode_extended_handshake(
+                        payload)[b"m"].get(b"ut_metadata")
+                elif (extended_id == extension.LOCAL_EXTENSIONS[
+                        b"ut_metadata"] and metadata_id):
+                    self.send_metadata(metadata_id, payload)
+
+    def send_metadata(self, metadata_id, payload):
+        """
+        Answers a ut_metadata request for a piece of the info dict.
+        """
+        raw_info = self.server.raw_info
+        msg_type, piece, _, _ = extension.decode_metadata_message(payload)
+        if msg_type != extension.METADATA_REQUEST:
+            return
+        start = piece * extension.METADATA_PIECE_SIZE
+        if not 0 <= start < len(raw_info):
+            self.send(extension.generate_metadata_message(
+                metadata_id, extension.METADATA_REJECT, piece))
+            return
+        self.send(extension.generate_metadata_message(
+            metadata_id, extension.METADATA_DATA, piece, len(raw_info),
+            raw_info[start:start + extension.METADATA_PIECE_SIZE]))
+
+
+class Seeder(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    A seeder listening on localhost that has every piece of the torrent.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, data, piece_length, raw_info, peer_id, fast=True,
+                 unchoke_delay=0):
+        """
+        :param raw_info: The bencoded info dict of the torrent
+        :param fast: Support the Fast extension
+        :param unchoke_delay: Seconds a new peer is kept choked, during which
+        it may only request its allowed fast pieces
+        """
+        socketserver.TCPServer.__init__(self, ("127.0.0.1", 0), SeederHandler)
+        self.data = data
+        self.piece_length = piece_length
+        self.raw_info = raw_info
+        self.info_hash = hashlib.sha1(raw_info).digest()
+        self.peer_id = peer_id
+        self.fast = fast
+        self.unchoke_delay = unchoke_delay
+        self.connections = set()
+        self.blocks_served = 0
+
+        piece_count = -(-len(data) // piece_length)
+        self.piece_count = piece_count
+        bitfield = bytearray(b"\xff" * (-(-piece_count // 8)))
+        spare_bits = len(bitfield) * 8 - piece_count
+        if spare_bits:
+            bitfield[-1] = (0xff << spare_bits) & 0xff
+        self.bitfield = bytes(bitfield)
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def address(self):
+        return self.server_address
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class TrackerStubHandler(http_server.BaseHTTPRequestHandler):
+    """
+    Answers every announce with the compact addresses of all seeders and
+    every scrape with their number. Connections are kept alive and responses
+    gzipped if the client accepts it.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # The header lines are written one by one, which would otherwise be held
+    # back by Nagle's algorithm on a kept alive connection
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.server.connections += 1
+        self.server.open_sockets.add(self.request)
+        try:
+            http_server.BaseHTTPRequestHandler.handle(self)
+        finally:
+            self.server.open_sockets.discard(self.request)
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith("/scrape"):
+            server.scrapes += 1
+            response = bencode.encode({b"files": {}})
+        else:
+            server.announces += 1
+            response = bencode.encode({
+                b"interval": 1800,
+                b"complete": len(server.peers),
+                b"incomplete": 0,
+                b"peers": server.compact_peers(),
+            })
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            response = compressor.compress(response) + compressor.flush()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+
+class TrackerStub(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    """
+    A HTTP tracker on localhost that knows a fixed list of peers.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, peers):
+        """
+        :param peers: List of (ip, port) tuples to hand out
+        """
+        http_server.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                        TrackerStubHandler)
+        self.peers = peers
+        self.announces = 0
+        self.scrapes = 0
+        self.connections = 0
+        self.open_sockets = set()  # Kept alive connections
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def announce_url(self):
+        return "http://{}:{}/announce".format(*self.server_address)
+
+    def compact_peers(self):
+        return b"".join(tracker.COMPACT_PEER.pack(socket.inet_aton(ip), port)
+                        for ip, port in self.peers)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in list(self.open_sockets):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class WebSeedHandler(http_server.BaseHTTPRequestHandler):
+    """
+    Serves the files of the torrent with support for Range requests and
+    keep-alive connections.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def handle(self):
+        self.server.connections += 1
+        http_server.BaseHTTPRequestHandler.handle(self)
+
+    def do_GET(self):
+        server = self.server
+        span = server.files.get(unquote(self.path))
+        if span is None:
+            self.send_error(404)
+            return
+        offset, length = span
+
+        start, end = 0, length - 1
+        status = 200
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), length - 1)
+            if start > end:
+                self.send_error(416)
+                return
+            status = 206
+
+        body = server.data[offset + start:offset + end + 1]
+        self.send_response(status)
+        if status == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, end, length))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        server.requests += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebSeedServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    """
+    A HTTP mirror of the torrent on localhost, laid out as BEP 19 expects.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data, meta_info):
+        http_server.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                        WebSeedHandler)
+        self.data = data
+        self.connections = 0
+        self.requests = 0
+
+        # URL path mapped to the (offset, length) of the file in data
+        info = meta_info[b"info"]
+        name = info[b"name"].decode("utf-8")
+        self.files = {}
+        if b"files" in info:
+            offset = 0
+            for entry in info[b"files"]:
+                path = "/".join([name] + [part.decode("utf-8")
+                                          for part in entry[b"path"]])
+                self.files["/" + path] = (offset, entry[b"length"])
+                offset += entry[b"length"]
+        else:
+            self.files["/" + name] = (0, info[b"length"])
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class DHTCluster(object):
+    """
+    DHT nodes on localhost that all know each other, run by a single thread.
+    Other threads hand work to the nodes through a command queue.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.nodes = []
+        self.commands = queue.Queue()
+        self.running = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    @property
+    def addresses(self):
+        """
+        :return: (ip, port) tuples of the nodes, for DHTNode.bootstrap
+        """
+        return [node.address for node in self.nodes]
+
+    def start(self, timeout=10):
+        """
+        Creates the nodes and lets each of them join through the first one.
+        """
+        self.nodes = [dht.DHTNode(ip="127.0.0.1") for _ in range(self.size)]
+        pending = [len(self.nodes)]
+
+        def joined(_):
+            pending[0] -= 1
+
+        first = self.nodes[0]
+        first.bootstrap([], joined)
+        for node in self.nodes[1:]:
+            node.bootstrap([first.address], joined)
+        self.run_until(lambda: not pending[0], timeout)
+
+        self.running = True
+        self.thread.start()
+
+    def run_until(self, condition, timeout):
+        """
+        Polls the nodes until condition() is true. Only used before the
+        thread has been started.
+
+        :return: True if condition() became true within timeout seconds
+        """
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            self.poll(0.01)
+        return True
+
+    def poll(self, timeout):
+        select.select([node.sock for node in self.nodes], [], [], timeout)
+        for node in self.nodes:
+            node.poll()
+
+    def _run(self):
+        while self.running:
+            try:
+                while True:
+                    self.commands.get(block=False)()
+            except queue.Empty:
+                pass
+            self.poll(0.01)
+
+    def announce(self, info_hash, port, timeout=10):
+        """
+        Announces a peer from a random node and waits until it is done.
+
+        :param port: Port of the peer on localhost
+        """
+        done = threading.Event()
+        node = random.choice(self.nodes)
+        self.commands.put(lambda: node.get_peers(
+            info_hash, None, port, lambda _: done.set()))
+        done.wait(timeout)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+        for node in self.nodes:
+            node.close()
+        self.nodes = []
+
+
+class LoopbackSwarm(object):
+    """
+    Sets up a synthetic torrent, a number of seeders and a tracker stub. Can be
+    used as a context manager which stops everything and removes the temporary
+    directory on exit.
+
+    torrent_path is the path of the generated .torrent file, magnet_link its
+    magnet link and download_dir an empty directory to download into.
+    """
+
+    def __init__(self, size, piece_length, seeders=1, file_count=1, seed=0,
+                 web_seeds=0, dht_nodes=0, fast=True, unchoke_delay=0):
+        self.size = size
+        self.piece_length = piece_length
+        self.seeder_count = seeders
+        self.file_count = file_count
+        self.seed = seed
+        self.web_seed_count = web_seeds
+        self.dht_node_count = dht_nodes
+        self.fast = fast
+        self.unchoke_delay = unchoke_delay
+
+        self.directory = None
+        self.torrent_path = None
+        self.magnet_link = None
+        self.download_dir = None
+        self.data = None
+        self.meta_info = None
+        self.seeders = []
+        self.web_seeds = []
+        self.tracker = None
+        self.dht = None
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="pytorrent-bench-")
+        self.download_dir = os.path.join(self.directory, "download")
+        os.mkdir(self.download_dir)
+
+        self.data = synthetic_data(self.size, self.seed)
+
+        # The tracker needs the seeder addresses and the torrent needs the
+        # tracker address, so compute the info hash up front.
+        meta_info = make_meta_info(self.data, self.piece_length, "",
+                                   file_count=self.file_count)
+        raw_info = bencode.encode(meta_info[b"info"])
+        info_hash = hashlib.sha1(raw_info).digest()
+
+        for number in range(self.seeder_count):
+            peer_id = "-SE0001-{:012d}".format(number).encode("utf-8")
+            seeder = Seeder(self.data, self.piece_length, raw_info, peer_id,
+                            self.fast, self.unchoke_delay)
+            seeder.start()
+            self.seeders.append(seeder)
+
+        self.tracker = TrackerStub([seeder.address for seeder in self.seeders])
+        self.tracker.start()
+
+        self.meta_info = make_meta_info(self.data, self.piece_length,
+                                        self.tracker.announce_url,
+                                        file_count=self.file_count)
+        for _ in range(self.web_seed_count):
+            server = WebSeedServer(self.data, self.meta_info)
+            server.start()
+            self.web_seeds.append(server)
+        if self.web_seeds:
+            self.meta_info[b"url-list"] = [server.url.encode("utf-8")
+                                           for server in self.web_seeds]
+        if self.dht_node_count:
+            # Trackerless, the seeders can only be found through the DHT
+            del self.meta_info[b"announce"]
+            del self.meta_info[b"announce-list"]
+            self.dht = DHTCluster(self.dht_node_count)
+            self.dht.start()
+            for seeder in self.seeders:
+                self.dht.announce(info_hash, seeder.address[1])
+        self.torrent_path = os.path.join(self.directory, "synthetic.torrent")
+        with open(self.torrent_path, "wb") as f:
+            f.write(bencode.encode(self.meta_info))
+        self.magnet_link = "magnet:?xt=urn:btih:{}".format(
+            binascii.hexlify(info_hash).decode("ascii"))
+        if not self.dht_node_count:
+            self.magnet_link += "&tr=" + quote(self.tracker.announce_url,
+                                               safe=b"")
+
+    def stop(self):
+        for seeder in self.seeders:
+            seeder.stop()
+        self.seeders = []
+        for server in self.web_seeds:
+            server.stop()
+        self.web_seeds = []
+        if self.dht is not None:
+            self.dht.stop()
+            self.dht = None
+        if self.tracker is not None:
+            self.tracker.stop()
+            self.tracker = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def verify(self):
+        """
+        :return: True if the downloaded files contain exactly the synthetic
+        data
+        """
+        name = self.meta_info[b"info"][b"name"].decode("utf-8")
+        if self.file_count == 1:
+            paths = [os.path.join(self.download_dir, name)]
+        else:
+            paths = [os.path.join(self.download_dir, name,
+                                  entry[b"path"][0].decode("utf-8"))
+                     for entry in self.meta_info[b"info"][b"files"]]
+
+        position = 0
+        for path in paths:
+            with open(path, "rb") as f:
+                content = f.read()
+            if content != self.data[position:position + len(content)]:
+                return False
+            position += len(content)
+        return position == len(self.data)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,340 @@
+"""
+Magnet links and metadata exchange (ut_metadata, BEP 9).
+
+A magnet link only names the info hash of a torrent, and optionally its name,
+trackers and peers:
+
+magnet:?xt=urn:btih:<info hash>&dn=<name>&tr=<tracker url>&x.pe=<host:port>
+
+The info hash is either 40 hex digits or 32 base32 characters. The info dict
+itself is downloaded from the peers through the ut_metadata extension in
+pieces of 16 KiB, several pieces from several peers at a time, and checked
+against the info hash. Once it is known it is cached on disk as a .torrent
+file so a restart does not download it again, and it is served to other peers
+the same way.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import base64
+import binascii
+import collections
+import hashlib
+import os
+import sys
+import time
+
+import bencode
+import extension
+import metrics
+import tracker
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+    from urlparse import parse_qs, urlsplit
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+    from urllib.parse import parse_qs, urlsplit
+
+# Requests for pieces of the info dict in flight per peer
+METADATA_PIPELINE = 2
+# Seconds before a piece requested from one peer is requested again from
+# another
+METADATA_TIMEOUT = 10
+# Seconds before a peer that let a request time out is asked again
+METADATA_STALL_DELAY = 30
+# Largest info dict accepted from a peer, so a peer can not make us buffer an
+# arbitrary amount of data. Larger than the info dict of any sane torrent.
+MAX_METADATA_SIZE = 2 ** 23
+
+# info_hash is the raw 20 byte hash, name None if not given, trackers a list of
+# tracker URLs and peers a list of tracker.PeerAddress
+MagnetLink = collections.namedtuple("MagnetLink",
+                                    ["info_hash", "name", "trackers", "peers"])
+
+
+def is_magnet_link(uri):
+    """
+    :return: True if uri is a magnet link rather than a path
+    """
+    return uri.startswith("magnet:")
+
+
+def parse_magnet(uri):
+    """
+    :param uri: The magnet link
+    :return: MagnetLink
+    :raise ValueError: If it is not a magnet link of a BitTorrent info hash
+    """
+    scheme, _, _, query, _ = urlsplit(uri)
+    if scheme != "magnet":
+        raise ValueError("Not a magnet link: {}".format(uri))
+    params = parse_qs(query)
+
+    info_hash = None
+    for topic in params.get("xt", []):
+        if topic.lower().startswith("urn:btih:"):
+            info_hash = decode_info_hash(topic[len("urn:btih:"):])
+            break
+    if info_hash is None:
+        raise ValueError("Magnet link without a BitTorrent info hash")
+
+    peers = []
+    for peer in params.get("x.pe", []):
+        host, _, port = peer.rpartition(":")
+        if host and port.isdigit():
+            peers.append(tracker.PeerAddress(host.strip("[]"), int(port)))
+
+    name = params.get("dn", [None])[0]
+    return MagnetLink(info_hash, name, params.get("tr", []), peers)
+
+
+def decode_info_hash(text):
+    """
+    :param text: The info hash as 40 hex digits or 32 base32 characters
+    :return: The raw 20 byte info hash
+    :raise ValueError: If it is neither
+    """
+    try:
+        if len(text) == 40:
+            return binascii.unhexlify(text)
+        if len(text) == 32:
+            return base64.b32decode(text.upper())
+    except (TypeError, binascii.Error):
+        pass
+    raise ValueError("Invalid info hash {}".format(text))
+
+
+def cache_path(cache_dir, info_hash):
+    """
+    :return: Path of the cached .torrent file of an info hash
+    """
+    return os.path.join(cache_dir, "{}.torrent".format(
+        binascii.hexlify(info_hash).decode("ascii")))
+
+
+def encode_torrent(raw_info, trackers=()):
+    """
+    Builds the content of a .torrent file around the raw bytes of an info
+    dict. The info dict is not re-encoded so its info hash stays the same.
+
+    :param raw_info: The bencoded info dict
+    :param trackers: Tracker URLs to put in announce and announce-list
+    :return: Byte string of the .torrent file
+    """
+    trackers = [url if isinstance(url, bytes) else url.encode("utf-8")
+                for url in trackers]
+    meta_info = {}
+    if trackers:
+        meta_info[b"announce"] = trackers[0]
+        meta_info[b"announce-list"] = [[url] for url in trackers]
+    # 'info' sorts after the announce keys, so it is simply appended
+    return (bencode.encode(meta_info)[:-1] + b"4:info" + bytes(raw_info) +
+            b"e")
+
+
+def _piece_count(size):
+    return -(-size // extension.METADATA_PIECE_SIZE)
+
+
+def save_torrent(path, content):
+    """
+    Writes a .torrent file without ever leaving a truncated one behind.
+    """
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(content)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary, path)
+
+
+class MetadataExchange(object):
+    """
+    Downloads the info dict of a torrent from its peers and serves it to
+    them. Its on_message is registered as the ut_metadata handler of every
+    peer and fill_requests called like download.Download.fill_requests.
+    """
+
+    def __init__(self, info_hash, raw_info=None, torrent_label=""):
+        """
+        :param info_hash: The raw info hash the info dict must match
+        :param raw_info: The bencoded info dict if it is already known
+        :param torrent_label: Name of the torrent used to label metrics
+        """
+        self.info_hash = info_hash
+        self.raw_info = None if raw_info is None else bytes(raw_info)
+
+        self.size = None  # Size of the info dict being downloaded
+        self.size_peers = set()  # Peers asked for pieces of that size
+        self.pieces = {}  # Index of received pieces mapped to their data
+        self.sources = {}  # Index of received pieces mapped to their sender
+        # Index of requested pieces mapped to (peer, Unix time requested)
+        self.requested = {}
+        # Peers that are no longer asked: those that rejected a request or
+        # sent pieces of an info dict that failed the hash check
+        self.rejecting = set()
+        self.banned = set()
+        # Peers that let a request time out mapped to the Unix time they are
+        # asked again
+        self.stalled = {}
+
+        self.pieces_received = metrics.REGISTRY.counter(
+            "metadata_pieces_received",
+            "Pieces of the info dict received through ut_metadata",
+            torrent=torrent_label)
+        self.hash_failures = metrics.REGISTRY.counter(
+            "metadata_hash_failures",
+            "Info dicts that did not match the info hash",
+            torrent=torrent_label)
+
+    def is_complete(self):
+        return self.raw_info is not None
+
+    def on_message(self, peer, payload):
+        """
+        Handles a ut_metadata message from a peer.
+        """
+        msg_type, piece, total_size, data = \
+            extension.decode_metadata_message(payload)
+        if msg_type == extension.METADATA_REQUEST:
+            self._serve(peer, piece)
+        elif msg_type == extension.METADATA_DATA:
+            self._receive(peer, piece, total_size, data)
+        elif msg_type == extension.METADATA_REJECT:
+            if self.requested.get(piece, (None,))[0] is peer:
+                del self.requested[piece]
+            self.rejecting.add(peer)
+            self._check_size()
+
+    def _serve(self, peer, piece):
+        metadata_id = peer.extensions.get(b"ut_metadata")
+        if not metadata_id:
+            return
+        if (self.raw_info is None or
+                not 0 <= piece < _piece_count(len(self.raw_info))):
+            peer.send_message(extension.generate_metadata_message(
+                metadata_id, extension.METADATA_REJECT, piece))
+            return
+        start = piece * extension.METADATA_PIECE_SIZE
+        peer.send_message(extension.generate_metadata_message(
+            metadata_id, extension.METADATA_DATA, piece, len(self.raw_info),
+            self.raw_info[start:start + extension.METADATA_PIECE_SIZE]))
+
+    def _receive(self, peer, piece, total_size, data):
+        if self.raw_info is not None or self.size is None:
+            return
+        if piece in self.pieces or total_size != self.size:
+            return
+        if not 0 <= piece < _piece_count(self.size):
+            return
+        start = piece * extension.METADATA_PIECE_SIZE
+        if len(data) != min(extension.METADATA_PIECE_SIZE, self.size - start):
+            return
+
+        self.requested.pop(piece, None)
+        self.stalled.pop(peer, None)  # Slow, but still answering
+        self.pieces[piece] = data
+        self.sources[piece] = peer
+        self.pieces_received.inc()
+        if len(self.pieces) < _piece_count(self.size):
+            return
+
+        raw_info = b"".join(self.pieces[index]
+                            for index in range(len(self.pieces)))
+        if hashlib.sha1(raw_info).digest() != self.info_hash:
+            print("Info dict from peers does not match the info hash")
+            self.hash_failures.inc()
+            # Which piece was wrong is unknown, so none of the senders is
+            # asked again
+            self.banned.update(self.sources.values())
+            self._reset()
+            return
+        self._reset()
+        self.raw_info = raw_info
+
+    def _reset(self):
+        """
+        Forgets the info dict being downloaded, so the size of the next peer
+        asked is used.
+        """
+        self.size = None
+        self.size_peers = set()
+        self.pieces = {}
+        self.sources = {}
+        self.requested = {}
+
+    def _check_size(self):
+        """
+        Starts over once every peer with the size being downloaded has
+        rejected a request, let one time out, been banned or gone, so peers
+        announcing another size are asked instead.
+        """
+        if self.size is not None and not (self.size_peers - self.rejecting -
+                                          set(self.stalled) - self.banned):
+            self._reset()
+
+    def fill_requests(self, peer):
+        """
+        Requests pieces of the info dict from a peer that has it, up to
+        METADATA_PIPELINE at a time. A peer that has not sent a piece within
+        METADATA_TIMEOUT seconds is not asked again for METADATA_STALL_DELAY
+        seconds and the piece is requested from another.
+        """
+        if self.raw_info is not None:
+            return
+        now = time.time()
+        for piece, (requester, requested) in list(self.requested.items()):
+            if now - requested >= METADATA_TIMEOUT:
+                del self.requested[piece]
+                self.stalled[requester] = now + METADATA_STALL_DELAY
+        for stalled_peer, retry_at in list(self.stalled.items()):
+            if retry_at <= now:
+                del self.stalled[stalled_peer]
+        self._check_size()
+
+        metadata_id = peer.extensions.get(b"ut_metadata")
+        if (not metadata_id or not peer.metadata_size or
+                peer in self.rejecting or peer in self.stalled or
+                peer in self.banned):
+            return
+        if self.size is None:
+            if peer.metadata_size > MAX_METADATA_SIZE:
+                return
+            self.size = peer.metadata_size
+        elif peer.metadata_size != self.size:
+            return
+        self.size_peers.add(peer)
+
+        in_flight = sum(1 for requester, _ in self.requested.values()
+                        if requester is peer)
+        for piece in range(_piece_count(self.size)):
+            if in_flight >= METADATA_PIPELINE:
+                break
+            if piece in self.pieces or piece in self.requested:
+                continue
+            self.requested[piece] = (peer, now)
+            peer.send_message(extension.generate_metadata_message(
+                metadata_id, extension.METADATA_REQUEST, piece))
+            in_flight += 1
+
+    def remove_peer(self, peer):
+        """
+        Forgets a disconnected peer, its requests are made again to others.
+        """
+        self.rejecting.discard(peer)
+        self.stalled.pop(peer, None)
+        self.banned.discard(peer)
+        self.size_peers.discard(peer)
+        for piece, (requester, _) in list(self.requested.items()):
+            if requester is peer:
+                del self.requested[piece]
+        self._check_size()
@@ -5,8 +5,12 @@ from __future__ import (
     unicode_literals
 )
 
+import argparse
 import sys
 
+import dht
+import metrics
+import wiretrace
 from torrent import Torrent
 
 
@@ -19,10 +23,49 @@ elif sys.version_info.major == 3:
 
 
 def main(argv):
-    path = argv[1]
+    parser = argparse.ArgumentParser(description="A very simple torrent client")
+    parser.add_argument("torrent",
+                        help="Path to a .torrent file or a magnet link")
+    parser.add_argument("--download-dir", default=".",
+                        help="Directory to download to")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this local port")
+    parser.add_argument("--record-trace", default=None,
+                        help="Record all received peer wire frames to this "
+                             "file, see wiretrace.py")
+    parser.add_argument("--dht", action="store_true",
+                        help="Find peers through the DHT as well, needed for "
+                             "trackerless torrents")
+    parser.add_argument("--dht-port", type=int, default=6881,
+                        help="UDP port of the DHT node")
+    parser.add_argument("--dht-state", default=None,
+                        help="File to keep the DHT routing table in between "
+                             "runs")
+    args = parser.parse_args(argv[1:])
+
+    if args.metrics_port is not None:
+        metrics.enable()
+        metrics.MetricsServer(args.metrics_port).start()
+
+    node = None
+    if args.dht:
+        node = dht.DHTNode(args.dht_port, state_path=args.dht_state)
+        node.bootstrap()
+
+    torrent = Torrent(args.torrent, args.download_dir, dht=node)
+    if args.record_trace is not None:
+        torrent.recorder = wiretrace.TraceRecorder(args.record_trace)
+    try:
+        torrent.serve_forever()
+    finally:
+        try:
+            # Drains the disk queue and closes the files and the trace log,
+            # also on Ctrl-C
+            torrent.stop()
+        finally:
+            if node is not None:
+                node.close()  # Saves the routing table
 
-    torrent = Torrent(path)
-    torrent.serve_forever()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -0,0 +1,181 @@
+"""
+Precomputed torrent metadata.
+
+Everything that can be derived from the info dict of a torrent (info hash,
+piece geometry and file layout) is calculated once when the torrent is loaded
+so that the download and tracker code never has to recompute it.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import bisect
+import collections
+import sys
+import urllib
+
+import tracker
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+BLOCK_SIZE = 2 ** 14  # 16 KiB, the block size every client uses
+HASH_SIZE = 20  # Size of a sha1 digest
+
+# path is a list of path components starting with the torrent name, offset is
+# the position of the first byte of the file in the torrent as a whole
+FileEntry = collections.namedtuple("FileEntry", ["path", "length", "offset"])
+
+
+class Metadata(object):
+    """
+    Immutable, precomputed view of a torrent's info dict. Attributes can not
+    be changed after creation.
+    """
+
+    __slots__ = (
+        "info_hash",
+        "info_hash_quoted",
+        "name",
+        "piece_length",
+        "piece_count",
+        "last_piece_length",
+        "total_length",
+        "piece_hashes",
+        "files",
+        "file_offsets",
+        "blocks_per_piece",
+        "last_piece_blocks",
+    )
+
+    def __init__(self, meta_info):
+        """
+        :param meta_info: A decoded torrent file, preferably decoded with
+        lazybencode so the info hash is taken from the raw info bytes.
+        """
+        info = meta_info['info']
+        info_hash = tracker.calc_info_hash(meta_info)
+
+        set_attr = super(Metadata, self).__setattr__
+        set_attr("info_hash", info_hash)
+        # because the info_hash is a string we use quote_plus instead of
+        # urlencode
+        set_attr("info_hash_quoted", urllib.quote_plus(info_hash))
+        set_attr("name", info['name'])
+
+        piece_length = info['piece length']
+        set_attr("piece_length", piece_length)
+
+        pieces = info['pieces']
+        if not isinstance(pieces, memoryview):
+            pieces = memoryview(bytes(pieces))
+        if len(pieces) % HASH_SIZE != 0:
+            raise ValueError("pieces length must be a multiple of 20")
+        set_attr("piece_hashes", pieces)
+
+        files = []
+        offset = 0
+        if 'files' in info:
+            for entry in info['files']:
+                path = [info['name']] + list(entry['path'])
+                files.append(FileEntry(path, entry['length'], offset))
+                offset += entry['length']
+        else:
+            files.append(FileEntry([info['name']], info['length'], 0))
+            offset = info['length']
+        set_attr("files", tuple(files))
+        set_attr("file_offsets", tuple(f.offset for f in files))
+        set_attr("total_length", offset)
+
+        piece_count = len(pieces) // HASH_SIZE
+        set_attr("piece_count", piece_count)
+        if piece_count != -(-offset // piece_length):
+            raise ValueError("Number of piece hashes does not match the "
+                             "total length of the torrent")
+
+        last_piece_length = offset - (piece_count - 1) * piece_length
+        set_attr("last_piece_length", last_piece_length)
+        set_attr("blocks_per_piece", -(-piece_length // BLOCK_SIZE))
+        set_attr("last_piece_blocks", -(-last_piece_length // BLOCK_SIZE))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Metadata is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Metadata is immutable")
+
+    def piece_size(self, index):
+        """
+        :param index: Zero based piece index
+        :return: Number of bytes in the piece
+        """
+        if index == self.piece_count - 1:
+            return self.last_piece_length
+        return self.piece_length
+
+    def block_count(self, index):
+        """
+        :param index: Zero based piece index
+        :return: Number of BLOCK_SIZE blocks the piece is split into
+        """
+        if index == self.piece_count - 1:
+            return self.last_piece_blocks
+        return self.blocks_per_piece
+
+    def piece_hash(self, index):
+        """
+        :param index: Zero based piece index
+        :return: The expected 20 byte sha1 digest of the piece
+        """
+        start = index * HASH_SIZE
+        return self.piece_hashes[start:start + HASH_SIZE].tobytes()
+
+    def file_index(self, offset):
+        """
+        Finds the file containing the byte at offset in the torrent.
+
+        :param offset: Byte offset in the torrent as a whole
+        :return: Index into files
+        """
+        if not 0 <= offset < self.total_length:
+            raise IndexError("offset {} out of range".format(offset))
+        index = bisect.bisect_right(self.file_offsets, offset) - 1
+        # Skip past zero length files sharing the same offset
+        while self.files[index].length == 0:
+            index += 1
+        return index
+
+    def file_spans(self, offset, length):
+        """
+        Splits a byte range of the torrent into the parts that fall within
+        each file.
+
+        :param offset: Byte offset in the torrent as a whole
+        :param length: Number of bytes in the range
+        :return: List of (file index, offset within file, length) tuples
+        """
+        spans = []
+        index = self.file_index(offset)
+        while length > 0:
+            entry = self.files[index]
+            file_offset = offset - entry.offset
+            span = min(length, entry.length - file_offset)
+            if span > 0:
+                spans.append((index, file_offset, span))
+                offset += span
+                length -= span
+            index += 1
+        return spans
+
+    def __repr__(self):
+        return "<Metadata {} pieces={} length={}>".format(
+            repr(self.name), self.piece_count, self.total_length)
@@ -0,0 +1,287 @@
+"""
+Runtime metrics.
+
+A registry of counters, gauges and histograms that can be exported as a
+snapshot dict or as Prometheus text, optionally over a local HTTP endpoint.
+
+Metrics are disabled by default. While disabled the registry hands out a
+shared null metric whose methods do nothing, so instrumented code only pays for
+a method call. Call enable() before creating any torrents to collect metrics.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import bisect
+import sys
+import threading
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+    import BaseHTTPServer as http_server
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+    import http.server as http_server
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class NullMetric(object):
+    """
+    Stands in for every metric while metrics are disabled.
+    """
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge(object):
+    def __init__(self, function=None):
+        """
+        :param function: If given the value of the gauge is the return value
+        of calling function when it is sampled, which costs nothing until a
+        snapshot is taken.
+        """
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def sample(self):
+        """
+        :return: Dict with the cumulative count of each bucket upper bound, the
+        sum and the count of all observations.
+        """
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return dict(buckets=cumulative, sum=self.sum, count=self.count)
+
+
+def _label_value(value):
+    """
+    :return: value as text. Byte strings, such as torrent names on Python 2,
+    are decoded as UTF-8 so non-ASCII names do not raise.
+    """
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return "{}".format(value)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, _label_value(value))
+                        for key, value in labels.items()))
+
+
+class Registry(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # Name mapped to (type, help text, {label key: metric})
+        self.families = {}
+
+    def _get(self, kind, name, help_text, labels, factory):
+        if not self.enabled:
+            return NULL_METRIC
+
+        key = _label_key(labels)
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = (kind, help_text, {})
+                self.families[name] = family
+            elif family[0] != kind:
+                raise ValueError("{} is already registered as a {}".format(
+                    name, family[0]))
+
+            metric = family[2].get(key)
+            if metric is None:
+                metric = factory()
+                family[2][key] = metric
+            return metric
+
+    def counter(self, name, help_text="", **labels):
+        return self._get(COUNTER, name, help_text, labels, Counter)
+
+    def gauge(self, name, help_text="", function=None, **labels):
+        """
+        Registering a gauge again under the same labels, such as for a new
+        torrent with the same name, replaces its function so the old object
+        is neither sampled nor kept alive.
+        """
+        gauge = self._get(GAUGE, name, help_text, labels,
+                          lambda: Gauge(function))
+        if function is not None and gauge is not NULL_METRIC:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(HISTOGRAM, name, help_text, labels,
+                         lambda: Histogram(buckets))
+
+    def remove(self, name, **labels):
+        """
+        Removes a labelled metric, for example the metrics of a peer that has
+        been disconnected.
+        """
+        with self.lock:
+            family = self.families.get(name)
+            if family is not None:
+                family[2].pop(_label_key(labels), None)
+
+    def snapshot(self):
+        """
+        :return: Dict of metric names mapped to a dict of label tuples mapped
+        to the current value of the metric.
+        """
+        with self.lock:
+            families = [(name, dict(family[2]))
+                        for name, family in self.families.items()]
+        return dict((name, dict((key, metric.sample())
+                                for key, metric in metrics.items()))
+                    for name, metrics in families)
+
+    def prometheus_text(self):
+        """
+        :return: All metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            families = [(name, family[0], family[1], dict(family[2]))
+                        for name, family in sorted(self.families.items())]
+
+        lines = []
+        for name, kind, help_text, metrics in families:
+            if help_text:
+                lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for key, metric in sorted(metrics.items()):
+                sample = metric.sample()
+                if kind == HISTOGRAM:
+                    for bound, count in sample['buckets']:
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append("{}_bucket{} {}".format(
+                            name, _format_labels(key + (("le", le),)), count))
+                    lines.append("{}_sum{} {}".format(
+                        name, _format_labels(key), sample['sum']))
+                    lines.append("{}_count{} {}".format(
+                        name, _format_labels(key), sample['count']))
+                else:
+                    lines.append("{}{} {}".format(name, _format_labels(key),
+                                                  sample))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    parts = ['{}="{}"'.format(label, value.replace("\\", "\\\\")
+                              .replace('"', '\\"'))
+             for label, value in key]
+    return "{" + ",".join(parts) + "}"
+
+
+# The registry used by the client
+REGISTRY = Registry()
+
+
+def enable():
+    """
+    Turns on metrics collection. Only metrics created after this call are
+    collected.
+    """
+    REGISTRY.enabled = True
+
+
+class MetricsHandler(http_server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http_server.HTTPServer):
+    """
+    Serves the metrics of a registry as Prometheus text on localhost from a
+    daemon thread.
+    """
+
+    def __init__(self, port=0, registry=REGISTRY):
+        http_server.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                        MetricsHandler)
+        self.registry = registry
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,150 @@
+"""
+Bookkeeping of known peers.
+
+Trackers (and later other peers) can tell us about far more peers than we will
+ever connect to. Each of those is kept as a small slotted KnownPeer record and
+only turned into a full peerwire.Peer connection, with its own socket thread,
+once we actually decide to connect to it.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import heapq
+import sys
+import time
+
+import tracker
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+# Where we learned about a peer
+SOURCE_TRACKER = 0
+SOURCE_PEX = 1
+SOURCE_DHT = 2
+SOURCE_INCOMING = 3
+
+# A peer that has failed this many times is never picked for a connection
+MAX_FAILURES = 3
+
+
+class KnownPeer(tracker.PeerAddress):
+    """
+    A peer we know the address of but are not necessarily connected to.
+
+    score: Higher is better. Lowered whenever a connection fails.
+    failures: Number of failed connection attempts.
+    last_seen: Unix time of when we last heard of the peer.
+    source: One of the SOURCE_* constants.
+    connected: True while a peerwire.Peer connection exists for this peer.
+    """
+
+    __slots__ = ("score", "failures", "last_seen", "source", "connected")
+
+    def __init__(self, ip, port, peer_id=None, source=SOURCE_TRACKER):
+        super(KnownPeer, self).__init__(ip, port, peer_id)
+        self.score = 0
+        self.failures = 0
+        self.last_seen = time.time()
+        self.source = source
+        self.connected = False
+
+    def __repr__(self):
+        return "KnownPeer({}, {}, score={})".format(repr(self.ip), self.port,
+                                                   self.score)
+
+
+class PeerStore(object):
+    """
+    Holds every KnownPeer of a torrent, keyed on (ip, port).
+    """
+
+    def __init__(self):
+        self.peers = {}
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, address):
+        return (address.ip, address.port) in self.peers
+
+    def __iter__(self):
+        return iter(self.peers.values())
+
+    def get(self, ip, port):
+        return self.peers.get((ip, port))
+
+    def add(self, address, source=SOURCE_TRACKER):
+        """
+        Adds a peer address to the store. If the peer is already known only its
+        last_seen time (and peer_id if it was unknown) is updated.
+
+        :param address: Anything with ip, port and peer_id attributes such as a
+        tracker.PeerAddress
+        :param source: One of the SOURCE_* constants
+        :return: The KnownPeer for the address
+        """
+        key = (address.ip, address.port)
+        known_peer = self.peers.get(key)
+        if known_peer is None:
+            known_peer = KnownPeer(address.ip, address.port, address.peer_id,
+                                   source)
+            self.peers[key] = known_peer
+        else:
+            known_peer.last_seen = time.time()
+            if known_peer.peer_id is None:
+                known_peer.peer_id = address.peer_id
+        return known_peer
+
+    def add_all(self, addresses, source=SOURCE_TRACKER):
+        """
+        Adds all the given addresses.
+
+        :return: Number of addresses that were not already known
+        """
+        size = len(self.peers)
+        for address in addresses:
+            self.add(address, source)
+        return len(self.peers) - size
+
+    def remove(self, known_peer):
+        self.peers.pop((known_peer.ip, known_peer.port), None)
+
+    def candidates(self, count):
+        """
+        Picks the best peers to connect to next.
+
+        :param count: Maximum number of peers to return
+        :return: List of unconnected KnownPeers with the highest score first
+        """
+        if count <= 0:
+            return []
+        available = (peer for peer in self.peers.values()
+                     if not peer.connected and peer.failures < MAX_FAILURES)
+        return heapq.nlargest(count, available, key=lambda peer: peer.score)
+
+    def mark_connected(self, known_peer):
+        known_peer.connected = True
+
+    def mark_disconnected(self, known_peer, failed=False):
+        """
+        Called when the connection to a peer is gone.
+
+        :param known_peer: The KnownPeer that was connected
+        :param failed: True if the connection failed or misbehaved, which
+        lowers the score of the peer.
+        """
+        known_peer.connected = False
+        if failed:
+            known_peer.failures += 1
+            known_peer.score -= 1
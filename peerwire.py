@@ -7,6 +7,12 @@ used the term "piece" when describing the peer protocol, but as a different term
 than "piece" in the metainfo file. For that reason, the term "block" will be
 used in this specification to describe the data that is exchanged between peers
 over the wire.
+
+The Fast extension (BEP 6) is used with peers that set its reserved bit too. It
+adds have_all and have_none messages that replace the bitfield, makes a choke
+keep the outstanding requests which the peer then answers or rejects one by
+one, and lets a peer name allowed fast pieces that may be requested while it is
+choking us.
 """
 
 from __future__ import (
@@ -15,10 +21,15 @@ from __future__ import (
     print_function,
     unicode_literals
 )
+import hashlib
 import socket
 
 import struct
 import sys
+import time
+
+import extension
+import metrics
 import socketthread
 
 
@@ -30,6 +41,60 @@ elif sys.version_info.major == 3:
     string_type = str
 
 LENGTH_PREFIX_SIZE = 4
+NO_RESERVED = b"\x00" * 8
+
+# Message ids
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+PORT = 9
+# Fast extension (BEP 6)
+SUGGEST_PIECE = 0x0D
+HAVE_ALL = 0x0E
+HAVE_NONE = 0x0F
+REJECT_REQUEST = 0x10
+ALLOWED_FAST = 0x11
+
+# The Fast extension is signalled by the third least significant bit of the
+# last reserved byte
+FAST_RESERVED_BYTE = 7
+FAST_RESERVED_BIT = 0x04
+# Number of allowed fast pieces given to a peer
+ALLOWED_FAST_COUNT = 10
+
+BLOCK_HEADER = struct.Struct(b">II")  # <index><begin> of piece messages
+REQUEST_PAYLOAD = struct.Struct(b">III")  # <index><begin><length>
+
+# Largest block accepted in a piece message. Blocks are normally 16 KiB but
+# some clients use up to 128 KiB.
+MAX_BLOCK_SIZE = 2 ** 17
+# Largest message accepted unless a larger bitfield is expected. Anything
+# larger is refused before it is read from the socket.
+MAX_MESSAGE_LENGTH = 1 + BLOCK_HEADER.size + MAX_BLOCK_SIZE
+
+# A keep-alive is a length prefix of zero without message id or payload
+KEEP_ALIVE = struct.pack(b">I", 0)
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a message that violates the protocol. The peer
+    should be dropped.
+    """
+
+    def __init__(self, peer, error_string):
+        self.peer = peer
+        self.error_string = error_string
+
+    def __str__(self):
+        return "{} violated the protocol: {}".format(self.peer,
+                                                     self.error_string)
 
 
 class HandshakeException(Exception):
@@ -46,7 +111,7 @@ class HandshakeException(Exception):
                                                             self.error_string)
 
 
-def generate_handshake(info_hash, peer_id):
+def generate_handshake(info_hash, peer_id, reserved=NO_RESERVED):
     """
     The handshake is a required message and must be the first message
     transmitted by the client. It is (49+len(pstr)) bytes long in the form:
@@ -69,12 +134,14 @@ def generate_handshake(info_hash, peer_id):
 
     :param info_hash:
     :param peer_id:
+    :param reserved: The 8 reserved bytes, all zeroes unless extensions such as
+    extension.set_reserved_bit are used.
     :return:
     """
     pstr = b"BitTorrent protocol"
     pstrlen = bytes(chr(len(pstr)))
 
-    reserved = b"\x00" * 8  # 8 zeroes
+    assert len(reserved) == 8
 
     handshake = pstrlen + pstr + reserved + info_hash + peer_id
 
@@ -118,8 +185,140 @@ def decode_handshake(handshake):
     return decoded_handshake
 
 
+def set_fast_bit(reserved):
+    """
+    Sets the Fast extension bit in the 8 reserved handshake bytes.
+
+    :param reserved: 8 byte string
+    :return: The new 8 byte string
+    """
+    reserved = bytearray(reserved)
+    reserved[FAST_RESERVED_BYTE] |= FAST_RESERVED_BIT
+    return bytes(reserved)
+
+
+def supports_fast(reserved):
+    """
+    :param reserved: The 8 reserved bytes of a handshake
+    :return: True if the Fast extension bit is set
+    """
+    return bool(bytearray(reserved)[FAST_RESERVED_BYTE] & FAST_RESERVED_BIT)
+
+
+def allowed_fast_set(info_hash, ip, piece_count, count=ALLOWED_FAST_COUNT):
+    """
+    The canonical allowed fast set of BEP 6. The pieces only depend on the
+    torrent and the /24 network of the peer, so a peer gains nothing from
+    reconnecting from another address of the same network.
+
+    :param info_hash: Raw info hash of the torrent
+    :param ip: IPv4 address of the peer we give the set to
+    :param piece_count: Number of pieces in the torrent
+    :param count: Number of pieces in the set
+    :return: List of piece indexes
+    """
+    count = min(count, piece_count)
+    address = bytearray(socket.inet_aton(ip))
+    address[3] = 0
+    x = bytes(address) + info_hash
+    allowed = []
+    while len(allowed) < count:
+        x = hashlib.sha1(x).digest()
+        for offset in range(0, 20, 4):
+            index = struct.unpack_from(b">I", x, offset)[0] % piece_count
+            if len(allowed) < count and index not in allowed:
+                allowed.append(index)
+    return allowed
+
+
+def generate_message(message_id, payload=b""):
+    """
+    Generates a length prefixed message: <length prefix><message ID><payload>
+
+    :param message_id: Single byte message id
+    :param payload: Message depended payload
+    :return: Byte string ready to be sent
+    """
+    return struct.pack(b">IB", len(payload) + 1, message_id) + payload
+
+
+def generate_have(index):
+    """
+    have: <len=0005><id=4><piece index>
+    """
+    return generate_message(HAVE, struct.pack(b">I", index))
+
+
+def generate_request(index, begin, length):
+    """
+    request: <len=0013><id=6><index><begin><length>
+    """
+    return generate_message(REQUEST, REQUEST_PAYLOAD.pack(index, begin, length))
+
+
+def generate_cancel(index, begin, length):
+    """
+    cancel: <len=0013><id=8><index><begin><length>
+    """
+    return generate_message(CANCEL, REQUEST_PAYLOAD.pack(index, begin, length))
+
+
+def generate_reject(index, begin, length):
+    """
+    reject request: <len=0013><id=16><index><begin><length>
+    """
+    return generate_message(REJECT_REQUEST,
+                            REQUEST_PAYLOAD.pack(index, begin, length))
+
+
+def generate_allowed_fast(index):
+    """
+    allowed fast: <len=0005><id=17><piece index>
+    """
+    return generate_message(ALLOWED_FAST, struct.pack(b">I", index))
+
+
+def generate_bitfield(bitfield, piece_count):
+    """
+    bitfield: <len=0001+X><id=5><bitfield>
+
+    :param bitfield: Bitfield of the pieces we have
+    """
+    return generate_message(BITFIELD, bitfield.to_bytes(piece_count))
+
+
+def generate_piece(index, begin, block):
+    """
+    piece: <len=0009+X><id=7><index><begin><block>
+    """
+    return generate_message(PIECE, BLOCK_HEADER.pack(index, begin) + block)
+
+
+def decode_piece(payload):
+    """
+    Decodes the payload of a piece message.
+
+    :param payload: The payload without the message id
+    :return: (index, begin, block) tuple
+    """
+    index, begin = BLOCK_HEADER.unpack_from(payload)
+    return index, begin, payload[BLOCK_HEADER.size:]
+
+
 class Peer(object):
-    def __init__(self, ip, port, peer_id):
+    def __init__(self, ip, port, peer_id, torrent_label="", sock=None,
+                 piece_count=None):
+        """
+        :param ip: IP address of the peer
+        :param port: Port of the peer
+        :param peer_id: The peer's id if known
+        :param torrent_label: Name of the torrent used to label metrics
+        :param sock: Object implementing the SocketThread interface to use. A
+        new socketthread.SocketThread is created if None.
+        :param piece_count: Number of pieces in the torrent. If given have and
+        bitfield messages are validated against it. None while the metadata of
+        a magnet link is downloaded, see set_piece_count.
+        """
         self.ip = ip
         self.port = port
 
@@ -128,10 +327,16 @@ class Peer(object):
         self.peers_info_hash = None
         self.has_shook_hands = False
 
-        self.socket = socketthread.SocketThread()
+        if sock is None:
+            sock = socketthread.SocketThread()
+        self.socket = sock
         self.socket.start()
 
+        # wiretrace.ConnectionRecorder recording received frames, if any
+        self.recorder = None
+
         self.peer_id = peer_id
+        self.receiving = False  # A receive is pending in the socket thread
 
         # Peer state
         self.am_choking = True  # this client is choking the peer
@@ -140,6 +345,108 @@ class Peer(object):
         self.peer_interested = False  # peer is interested in this client
 
         self.bitfield = Bitfield()  # Contains info on what pieces the peer has
+        self.piece_count = piece_count
+        # The peer sent have all before we knew the piece count
+        self.has_all = False
+
+        # Fast extension (BEP 6), used if both we and the peer support it
+        self.fast_extension = False
+        self.allowed_fast = set()  # Pieces we may request while choked
+        self.suggested_pieces = set()  # Pieces the peer suggests we request
+
+        self.max_message_length = MAX_MESSAGE_LENGTH
+        if piece_count is not None:
+            self.set_piece_count(piece_count)
+
+        # Message handlers indexed by message id, see register_handler
+        self.handlers = [()] * 256
+        self.register_handler(CHOKE, Peer._on_choke)
+        self.register_handler(UNCHOKE, Peer._on_unchoke)
+        self.register_handler(INTERESTED, Peer._on_interested)
+        self.register_handler(NOT_INTERESTED, Peer._on_not_interested)
+        self.register_handler(HAVE, Peer._on_have)
+        self.register_handler(BITFIELD, Peer._on_bitfield)
+        self.register_handler(REQUEST, Peer._on_request)
+        self.register_handler(extension.EXTENDED, Peer._on_extended)
+        self.register_handler(SUGGEST_PIECE, Peer._on_suggest_piece)
+        self.register_handler(HAVE_ALL, Peer._on_have_all)
+        self.register_handler(HAVE_NONE, Peer._on_have_none)
+        self.register_handler(REJECT_REQUEST, Peer._check_fast)
+        self.register_handler(ALLOWED_FAST, Peer._on_allowed_fast)
+
+        # Extension protocol (BEP 10)
+        self.reserved = NO_RESERVED  # reserved bytes of the peer's handshake
+        self.extensions = {}  # Extension names mapped to the peer's ids
+        self.discovered_peers = set()  # Addresses received through ut_pex
+        self.pex_peers = set()  # Addresses we last told the peer about
+        self.last_pex = 0  # Unix time of the last ut_pex message we sent
+        # Size of the info dict the peer can send through ut_metadata (BEP 9)
+        self.metadata_size = None
+        # Extended message ids mapped to their handler
+        self.extended_handlers = {
+            extension.HANDSHAKE_ID: Peer._on_extended_handshake,
+            extension.LOCAL_EXTENSIONS[b"ut_pex"]: Peer._on_pex,
+        }
+
+        self.label = "{}:{}".format(ip, port)
+        self.choke_changed = time.time()  # When peer_choking last changed
+
+        # When we last sent to or received anything from the peer, used to
+        # send keep-alives and to evict idle connections
+        self.last_sent = time.time()
+        self.last_received = time.time()
+        # timers.Timer checking for keep-alives and idleness, set by the owner
+        self.keep_alive_timer = None
+        self.idle_timer = None
+        # Set when a block request timed out, cleared when a block arrives
+        self.snubbed = False
+        self._create_metrics(torrent_label)
+
+    def _create_metrics(self, torrent_label):
+        registry = metrics.REGISTRY
+        # A peer may be connected for several torrents at once, so its
+        # metrics are labelled with the torrent as well
+        self.torrent_label = torrent_label
+        label = self.label
+        self.bytes_received = registry.counter(
+            "peer_bytes_received", "Bytes received from a peer", peer=label,
+            torrent=torrent_label)
+        self.bytes_sent = registry.counter(
+            "peer_bytes_sent", "Bytes sent to a peer", peer=label,
+            torrent=torrent_label)
+        self.messages_received = registry.counter(
+            "peer_messages_received", "Messages received from a peer",
+            peer=label, torrent=torrent_label)
+        registry.gauge("socket_command_queue_depth",
+                       "Commands waiting in the socket thread of a peer",
+                       function=self.socket.command_queue.qsize, peer=label,
+                       torrent=torrent_label)
+        registry.gauge("socket_reply_queue_depth",
+                       "Replies waiting to be read from the socket thread of "
+                       "a peer",
+                       function=self.socket.reply_queue.qsize, peer=label,
+                       torrent=torrent_label)
+
+        self.torrent_bytes_received = registry.counter(
+            "torrent_bytes_received", "Bytes received for a torrent",
+            torrent=torrent_label)
+        self.torrent_bytes_sent = registry.counter(
+            "torrent_bytes_sent", "Bytes sent for a torrent",
+            torrent=torrent_label)
+        self.choked_time = registry.histogram(
+            "peer_choked_seconds", "How long peers kept us choked",
+            torrent=torrent_label)
+        self.unchoked_time = registry.histogram(
+            "peer_unchoked_seconds", "How long peers kept us unchoked",
+            torrent=torrent_label)
+
+    def _remove_metrics(self):
+        registry = metrics.REGISTRY
+        for name in ("peer_bytes_received", "peer_bytes_sent",
+                     "peer_messages_received", "socket_command_queue_depth",
+                     "socket_reply_queue_depth"):
+            registry.remove(name, peer=self.label,
+                            torrent=self.torrent_label)
 
     def __str__(self):
         return "Peer: {ip}:{port}".format(ip=self.ip, port=self.port)
@@ -177,6 +484,71 @@ class Peer(object):
         address = (self.ip, self.port)
         self.socket.connect(address)
 
+    def disconnect(self):
+        """
+        Closes the connection to the peer without waiting for the socket
+        thread, which stops by itself once it has handled the close command.
+        """
+        self.socket.close()
+        self._remove_metrics()
+
+    def set_piece_count(self, piece_count):
+        """
+        Sets the number of pieces once the metadata of a magnet link is known.
+        What the peer said it has until now is checked against it.
+
+        :param piece_count: Number of pieces in the torrent
+        :raise ProtocolError: If the peer announced pieces that do not exist
+        """
+        self.piece_count = piece_count
+        self.max_message_length = max(MAX_MESSAGE_LENGTH,
+                                      1 + -(-piece_count // 8))
+        if self.has_all:
+            self.bitfield = Bitfield.full(piece_count)
+            self.has_all = False
+        for indexes in (self.bitfield.indexes(), self.allowed_fast,
+                        self.suggested_pieces):
+            for index in indexes:
+                if index >= piece_count:
+                    raise ProtocolError(self, "piece {} of {}".format(
+                        index, piece_count))
+
+    def supports_extensions(self):
+        """
+        :return: True if the peer has set the extension protocol bit in its
+        handshake
+        """
+        return extension.supports_extensions(self.reserved)
+
+    def negotiate_extensions(self, handshake):
+        """
+        Enables the extensions both our handshake and the peer's support.
+
+        :param handshake: Our handshake
+        """
+        self.fast_extension = (supports_fast(self.reserved) and
+                               supports_fast(decode_handshake(handshake)[
+                                   'reserved']))
+
+    def send_message(self, message):
+        """
+        Sends a complete, length prefixed message to the peer. Requires a
+        connected socket.
+        :param message: Byte string as generated by generate_message
+        :raise socket.error: If the message could not be sent
+        """
+        self.socket.sendall(message)
+        self.last_sent = time.time()
+        self.bytes_sent.inc(len(message))
+        self.torrent_bytes_sent.inc(len(message))
+
+    def send_keep_alive(self):
+        """
+        Sends a keep-alive so the peer does not close the connection.
+        :raise socket.error: If the message could not be sent
+        """
+        self.send_message(KEEP_ALIVE)
+
     def attempt_handshake(self, handshake):
         """
         Attempts to initiate a handshake with the peer. The has_shook_hands
@@ -195,7 +567,9 @@ class Peer(object):
 
             self.receive_handshake(block=True, timeout=1)
 
-            peers_info_hash = decode_handshake(self.handshake)['info_hash']
+            peers_handshake = decode_handshake(self.handshake)
+            peers_info_hash = peers_handshake['info_hash']
+            self.reserved = peers_handshake['reserved']
             info_hash = decode_handshake(handshake)['info_hash']
 
             if not peers_info_hash == info_hash:
@@ -204,10 +578,40 @@ class Peer(object):
                     info_hash.encode('hex'),peers_info_hash.encode('hex'))
                 raise HandshakeException(self, error_str)
             else:
+                self.negotiate_extensions(handshake)
                 self.has_shook_hands = True
         except socket.error as e:
             raise HandshakeException(self, str(e))
 
+    def accept_handshake(self, received, handshake):
+        """
+        Completes a handshake the peer initiated by answering with our own
+        handshake. The has_shook_hands property will be updated to True if the
+        handshake is successfully made.
+        :param received: The handshake received from the peer
+        :param handshake: Our handshake sent in reply
+        :raise HandshakeException: If handshake fails
+        """
+        self.handshake = received
+        if self.recorder is not None:
+            self.recorder.record_handshake(received)
+
+        peers_handshake = decode_handshake(received)
+        peers_info_hash = peers_handshake['info_hash']
+        info_hash = decode_handshake(handshake)['info_hash']
+        if peers_info_hash != info_hash:
+            error_str = "info_hash differs, Expected {} but got {}.".format(
+                info_hash.encode('hex'), peers_info_hash.encode('hex'))
+            raise HandshakeException(self, error_str)
+        self.reserved = peers_handshake['reserved']
+
+        try:
+            self.send_message(handshake)
+        except socket.error as e:
+            raise HandshakeException(self, str(e))
+        self.negotiate_extensions(handshake)
+        self.has_shook_hands = True
+
     def send_handshake(self, handshake):
         """
         Sends the handshake to the peer
@@ -248,27 +652,52 @@ class Peer(object):
 
             handshake = pstrlen + pstr + reply.payload
             self.handshake = handshake
+            if self.recorder is not None:
+                self.recorder.record_handshake(handshake)
             return self.handshake
         except socket.error as e:
             raise HandshakeException(self, str(e))
 
-    def receive_message(self):
+    def receive_message(self, block=True, timeout=None):
         """
         All messages comes on the form  <length prefix><message ID><payload>.
         Where <length prefix> is a four byte big-endian value. <message ID> is a
         single decimal byte and <payload> is message depended.
 
-        :return:
+        When called non blocking the receive is left pending in the socket
+        thread and the message is returned by a later call once it has arrived.
+
+        :param block: {Boolean} if the call should be blocking
+        :param timeout: if block=True block for this amount of time before
+        giving up
+        :return: (message_id, payload) tuple or None if no message has arrived
+        yet or the message was a keep-alive.
+        :raise ProtocolError: If the message has an invalid length or content
         """
 
-        self.socket.receive_with_prefix(LENGTH_PREFIX_SIZE)
+        if not self.receiving:
+            self.socket.receive_with_prefix(LENGTH_PREFIX_SIZE,
+                                            self.max_message_length)
+            self.receiving = True
+
+        reply = self.socket.get_reply(block=block, timeout=timeout)
+        if reply.status is None:
+            return None
 
-        reply = self.socket.get_reply(block=True, timeout=None)
+        self.receiving = False
         if reply.status != "success":
             raise reply.payload
+        self.last_received = time.time()
 
         length_prefix, message = reply.payload
+        if self.recorder is not None:
+            self.recorder.record_message(length_prefix + message)
         length_prefix = struct.unpack(b">I", length_prefix)[0]
+
+        self.bytes_received.inc(LENGTH_PREFIX_SIZE + length_prefix)
+        self.torrent_bytes_received.inc(LENGTH_PREFIX_SIZE + length_prefix)
+        self.messages_received.inc()
+
         if length_prefix == 0:
             # keep-alive: <len=0000>
 
@@ -279,150 +708,335 @@ class Peer(object):
             # a keep-alive message must be sent to maintain the connection alive
             # if no command have been sent for a given amount of time. This
             # amount of time is generally two minutes.
-            print("keep alive")
-            return
+            return None
 
         # The message ID is a single decimal byte so just extract it from the
         # received message
-        message_id = ord(message[0])
+        message_id = ord(message[0:1])
+        # The payload is the rest of the message, empty for id 0, 1, 2 and 3.
+        payload = message[1:]
 
-        # id 0, 1, 2 and 3 have no payload.
-        if message_id >= 4:
-            # The payload is the rest of the message.
-            payload = message[1:]
-        else:
-            payload = None
-
-        # TODO: handle received messages!
-        if message_id == 0:
-            # choke: <len=0001><id=0>
-            # The choke message is fixed-length and has no payload.
-
-            self.peer_choking = True
-        elif message_id == 1:
-            # unchoke: <len=0001><id=1>
-            # The unchoke message is fixed-length and has no payload
-
-            self.peer_choking = False
-        elif message_id == 2:
-            # interested: <len=0001><id=2>
-            # The interested message is fixed-length and has no payload
-
-            self.peer_interested = True
-        elif message_id == 3:
-            # not interested: <len=0001><id=3>
-            # The not interested message is fixed-length and has no payload
-
-            self.peer_interested = False
-        elif message_id == 4:
-            # have: <len=0005><id=4><piece index>
-            # The have message is fixed length. The payload is the zero-based
-            # index of a piece that has just been successfully downloaded and
-            # verified via the hash.
-
-            piece_index = int(payload.encode('hex'), 16)  # Convert to Integer
-            self.bitfield.add_index(piece_index)
-        elif message_id == 5:
-            # bitfield: <len=0001+X><id=5><bitfield>
-            # The bitfield message may only be sent immediately after the
-            # handshaking sequence is completed, and before any other messages
-            # are sent. It is optional, and need not be sent if a client has no
-            # pieces. The bitfield message is variable length, where X is the
-            # length of the bitfield. The payload is a bitfield representing the
-            # pieces that have been successfully downloaded. The high bit in the
-            # first byte corresponds to piece index 0. Bits that are cleared
-            # indicated a missing piece, and set bits indicate a valid and
-            # available piece. Spare bits at the end are set to zero.
-
-            # i.e. '\xfe\xff' = 1111111011111111 (pieces 0-15, piece 7 is
-            # missing). Any spare bits at the end of the last byte are left
-            # unset (0)
-
-            # Some clients (Deluge for example) send bitfield with missing
-            # pieces even if it has all data. Then it sends rest of pieces as
-            # have messages. They are saying this helps against ISP filtering of
-            # BitTorrent protocol. It is called lazy bitfield. A bitfield of the
-            # wrong length is considered an error. Clients should drop the
-            # connection if they receive bitfields that are not of the correct
-            # size, or if the bitfield has any of the spare bits set.
-
-            self.bitfield = Bitfield(payload)
-        elif message_id == 6:
-            # request: <len=0013><id=6><index><begin><length>
-            # The request message is fixed length, and is used to request a
-            # block. The payload contains the following information:
-            #  index: integer specifying the zero-based piece index
-            #  begin: integer specifying the zero-based byte offset within
-            #   the piece
-            #  length: integer specifying the requested length.
-
-            pass  # TODO: Implement this
-        elif message_id == 7:
-            # piece: <len=0009+X><id=7><index><begin><block>
-            # piece message is variable length, where X is the length of the
-            # block. The payload contains the following information:
-            #  index: integer specifying the zero-based piece index
-            #  begin: integer specifying the zero-based byte offset within the
-            #  piece block: block of data, which is a subset of the piece
-            #  specified by index
-
-            pass  # TODO: Implement this
-        elif message_id == 8:
-            # cancel: <len=0013><id=8><index><begin><length
-            # cancel message is fixed length, and is used to cancel block
-            # requests. The payload is identical to that of the "request"
-            # message. It is typically used during "End Game".
-
-            pass  # TODO: Implement this
-        elif message_id == 9:
-            # port: <len=0003><id=9><listen-port>
-            # The port message is sent by newer versions of the Mainline that
-            # implements a DHT tracker. The listen port is the port this peer's
-            # DHT node is listening on. This peer should be inserted in the
-            # local routing table (if DHT tracker is supported).
-
-            pass  # TODO: Implement this
+        lengths = PAYLOAD_LENGTHS[message_id]
+        if lengths is not None:
+            minimum, maximum = lengths
+            if len(payload) < minimum or (maximum is not None and
+                                          len(payload) > maximum):
+                raise ProtocolError(self, "message id {} with a {} byte "
+                                          "payload".format(message_id,
+                                                           len(payload)))
+
+        for handler in self.handlers[message_id]:
+            handler(self, payload)
+
+        return message_id, payload
+
+    def register_handler(self, message_id, handler):
+        """
+        Registers a handler for a message id. Handlers are called in the order
+        they were registered as handler(peer, payload) once the length of the
+        payload has been validated. The peer's own state handlers are always
+        registered first.
+
+        :param message_id: The message id to handle
+        :param handler: Callable taking the peer and the payload
+        """
+        self.handlers[message_id] = self.handlers[message_id] + (handler,)
+
+    def register_extended_handler(self, extended_id, handler):
+        """
+        Registers the handler of an extension message. Called as
+        handler(peer, payload) with the payload after the extended message id.
+
+        :param extended_id: The extended message id we announced for the
+        extension in our extended handshake.
+        :param handler: Callable taking the peer and the payload
+        """
+        self.extended_handlers[extended_id] = handler
+
+    def _on_choke(self, payload):
+        """
+        choke: <len=0001><id=0>
+        The choke message is fixed-length and has no payload.
+        """
+        if not self.peer_choking:
+            now = time.time()
+            self.unchoked_time.observe(now - self.choke_changed)
+            self.choke_changed = now
+        self.peer_choking = True
+
+    def _on_unchoke(self, payload):
+        """
+        unchoke: <len=0001><id=1>
+        The unchoke message is fixed-length and has no payload
+        """
+        if self.peer_choking:
+            now = time.time()
+            self.choked_time.observe(now - self.choke_changed)
+            self.choke_changed = now
+        self.peer_choking = False
+
+    def _on_interested(self, payload):
+        """
+        interested: <len=0001><id=2>
+        The interested message is fixed-length and has no payload
+        """
+        self.peer_interested = True
+
+    def _on_not_interested(self, payload):
+        """
+        not interested: <len=0001><id=3>
+        The not interested message is fixed-length and has no payload
+        """
+        self.peer_interested = False
+
+    def _on_have(self, payload):
+        """
+        have: <len=0005><id=4><piece index>
+        The have message is fixed length. The payload is the zero-based index
+        of a piece that has just been successfully downloaded and verified via
+        the hash.
+        """
+        self.bitfield.add_index(self._piece_index(payload, "have"))
+
+    def _piece_index(self, payload, message_name):
+        """
+        :return: The piece index a have, suggest or allowed fast message is
+        about
+        :raise ProtocolError: If there is no such piece
+        """
+        piece_index = struct.unpack(b">I", payload)[0]
+        if self.piece_count is not None and piece_index >= self.piece_count:
+            raise ProtocolError(self, "{} for piece {} of {}".format(
+                message_name, piece_index, self.piece_count))
+        return piece_index
+
+    def _on_bitfield(self, payload):
+        """
+        bitfield: <len=0001+X><id=5><bitfield>
+        The bitfield message may only be sent immediately after the
+        handshaking sequence is completed, and before any other messages are
+        sent. It is optional, and need not be sent if a client has no pieces.
+        The bitfield message is variable length, where X is the length of the
+        bitfield. The payload is a bitfield representing the pieces that have
+        been successfully downloaded. The high bit in the first byte
+        corresponds to piece index 0. Bits that are cleared indicated a missing
+        piece, and set bits indicate a valid and available piece. Spare bits at
+        the end are set to zero.
+
+        i.e. '\xfe\xff' = 1111111011111111 (pieces 0-15, piece 7 is missing).
+        Any spare bits at the end of the last byte are left unset (0)
+
+        Some clients (Deluge for example) send bitfield with missing pieces
+        even if it has all data. Then it sends rest of pieces as have messages.
+        They are saying this helps against ISP filtering of BitTorrent
+        protocol. It is called lazy bitfield. A bitfield of the wrong length is
+        considered an error. Clients should drop the connection if they receive
+        bitfields that are not of the correct size, or if the bitfield has any
+        of the spare bits set.
+        """
+        if self.piece_count is not None:
+            expected = -(-self.piece_count // 8)
+            if len(payload) != expected:
+                raise ProtocolError(self, "bitfield of {} bytes, expected "
+                                          "{}".format(len(payload), expected))
+            spare_bits = expected * 8 - self.piece_count
+            if spare_bits and bytearray(payload[-1:])[0] & ((1 << spare_bits)
+                                                             - 1):
+                raise ProtocolError(self, "bitfield has spare bits set")
+
+        self.bitfield = Bitfield(payload)
+
+    def _on_request(self, payload):
+        """
+        request: <len=0013><id=6><index><begin><length>
+        We never unchoke and give no allowed fast pieces, so with the Fast
+        extension every request is rejected instead of being left unanswered.
+        """
+        if self.fast_extension and self.am_choking:
+            index, begin, length = REQUEST_PAYLOAD.unpack(payload)
+            self.send_message(generate_reject(index, begin, length))
+
+    def _check_fast(self, payload):
+        """
+        The messages of the Fast extension may only be sent if both peers
+        support it.
+        """
+        if not self.fast_extension:
+            raise ProtocolError(self, "Fast extension message without "
+                                      "negotiating the extension")
+
+    def _on_suggest_piece(self, payload):
+        """
+        suggest piece: <len=0005><id=13><piece index>
+        The peer would like us to download the piece, for example because it
+        has it in its cache.
+        """
+        self._check_fast(payload)
+        self.suggested_pieces.add(self._piece_index(payload, "suggest"))
+
+    def _on_have_all(self, payload):
+        """
+        have all: <len=0001><id=14>
+        Sent instead of a bitfield by a peer that has every piece.
+        """
+        self._check_fast(payload)
+        if self.piece_count is None:
+            self.has_all = True
         else:
-            # !!! Unknown message id
+            self.bitfield = Bitfield.full(self.piece_count)
 
-            pass  # TODO: Implement this
+    def _on_have_none(self, payload):
+        """
+        have none: <len=0001><id=15>
+        Sent instead of a bitfield by a peer that has no pieces.
+        """
+        self._check_fast(payload)
+        self.has_all = False
+        self.bitfield = Bitfield()
+
+    def _on_allowed_fast(self, payload):
+        """
+        allowed fast: <len=0005><id=17><piece index>
+        We may request blocks of the piece even while the peer chokes us.
+        """
+        self._check_fast(payload)
+        self.allowed_fast.add(self._piece_index(payload, "allowed fast"))
 
-        print(self, repr(message_id), repr(payload))
+    def _on_extended(self, payload):
+        """
+        extended: <len=0002+X><id=20><extended message id><payload>
+        Messages of the extension protocol (BEP 10). The extended message id 0
+        is the extended handshake, other ids are the ones we announced in our
+        own extended handshake.
+        """
+        extended_id, payload = extension.decode_extended(payload)
+        handler = self.extended_handlers.get(extended_id)
+        if handler is not None:
+            handler(self, payload)
+
+    def _on_extended_handshake(self, payload):
+        handshake = extension.decode_extended_handshake(payload)
+        self.extensions = handshake[b"m"]
+        metadata_size = handshake.get(b"metadata_size")
+        if isinstance(metadata_size, int) and metadata_size > 0:
+            self.metadata_size = metadata_size
+
+    def _on_pex(self, payload):
+        added, dropped = extension.decode_pex(payload)
+        self.discovered_peers.update(added)
+
+
+# Allowed payload lengths (not counting the message id) of each message id as
+# (minimum, maximum) tuples, a maximum of None only limits the payload to the
+# maximum message length. Message ids without an entry are not checked.
+#
+# request: <len=0013><id=6><index><begin><length>
+# The request message is fixed length, and is used to request a block. The
+# payload contains the following information:
+#  index: integer specifying the zero-based piece index
+#  begin: integer specifying the zero-based byte offset within the piece
+#  length: integer specifying the requested length.
+#
+# piece: <len=0009+X><id=7><index><begin><block>
+# piece message is variable length, where X is the length of the block. The
+# payload contains the following information:
+#  index: integer specifying the zero-based piece index
+#  begin: integer specifying the zero-based byte offset within the piece
+#  block: block of data, which is a subset of the piece specified by index
+#
+# cancel: <len=0013><id=8><index><begin><length>
+# cancel message is fixed length, and is used to cancel block requests. The
+# payload is identical to that of the "request" message. It is typically used
+# during "End Game".
+#
+# port: <len=0003><id=9><listen-port>
+# The port message is sent by newer versions of the Mainline that implements a
+# DHT tracker. The listen port is the port this peer's DHT node is listening
+# on. This peer should be inserted in the local routing table (if DHT tracker
+# is supported).
+#
+# The messages of the Fast extension (BEP 6) either have no payload, a piece
+# index or the payload of a request.
+PAYLOAD_LENGTHS = [None] * 256
+PAYLOAD_LENGTHS[CHOKE] = (0, 0)
+PAYLOAD_LENGTHS[UNCHOKE] = (0, 0)
+PAYLOAD_LENGTHS[INTERESTED] = (0, 0)
+PAYLOAD_LENGTHS[NOT_INTERESTED] = (0, 0)
+PAYLOAD_LENGTHS[HAVE] = (4, 4)
+PAYLOAD_LENGTHS[BITFIELD] = (0, None)
+PAYLOAD_LENGTHS[REQUEST] = (12, 12)
+PAYLOAD_LENGTHS[PIECE] = (BLOCK_HEADER.size, BLOCK_HEADER.size + MAX_BLOCK_SIZE)
+PAYLOAD_LENGTHS[CANCEL] = (12, 12)
+PAYLOAD_LENGTHS[PORT] = (2, 2)
+PAYLOAD_LENGTHS[SUGGEST_PIECE] = (4, 4)
+PAYLOAD_LENGTHS[HAVE_ALL] = (0, 0)
+PAYLOAD_LENGTHS[HAVE_NONE] = (0, 0)
+PAYLOAD_LENGTHS[REJECT_REQUEST] = (12, 12)
+PAYLOAD_LENGTHS[ALLOWED_FAST] = (4, 4)
+PAYLOAD_LENGTHS[extension.EXTENDED] = (1, None)
 
 
 class Bitfield(object):
     """
-    Super simple and very inefficient way to store the bit-torrent bitfield.
-
-    We simply take a bitfield and convert it to a list of boolean values. So the
-    bitfield "11011" is converted to the list [True, True, False, True, True]
-    This way we can use the add_index(2) to change this to
-    [True, True, True, True, True] and has_index(2) will return True. If
-    add_index is called on an index that is out of range the missing indexes is
-    simply set to False.
+    The pieces a peer has, kept in the format of the bitfield message: one bit
+    per piece where the high bit of the first byte is piece 0. A received
+    bitfield is copied as is instead of being decoded bit by bit. If add_index
+    is called on an index that is out of range the bitfield simply grows.
     """
 
+    __slots__ = ("bits",)
+
     def __init__(self, bitfield=b""):
-        self.bitfield = []
+        self.bits = bytearray(bitfield)
 
-        # Add the bits as Boolean values in the bitfield
-        for byte in bitfield:
-            for bit in reversed(range(8)):  # Reverse to get correct endian
-                self.bitfield.append(bool(ord(byte) >> bit & 1))
+    @classmethod
+    def full(cls, piece_count):
+        """
+        :return: A Bitfield with all piece_count pieces, as for have all
+        """
+        bitfield = cls(b"\xff" * (piece_count // 8))
+        spare_bits = piece_count % 8
+        if spare_bits:
+            bitfield.bits.append((0xff << (8 - spare_bits)) & 0xff)
+        return bitfield
 
     def __str__(self):
-        return "".join(["{}".format(int(bit)) for bit in self.bitfield])
+        return "".join("{:08b}".format(byte) for byte in self.bits)
 
     def add_index(self, index):
-        while len(self.bitfield) <= index:
-            self.bitfield.append(False)
-        self.bitfield[index] = True
+        position = index >> 3
+        if position >= len(self.bits):
+            self.bits.extend(bytearray(position + 1 - len(self.bits)))
+        self.bits[position] |= 0x80 >> (index & 7)
+
+    def remove_index(self, index):
+        position = index >> 3
+        if position < len(self.bits):
+            self.bits[position] &= ~(0x80 >> (index & 7)) & 0xff
 
     def has_index(self, index):
-        if len(self.bitfield) >= index:
-            return self.bitfield[index]
-        else:
-            return False
+        position = index >> 3
+        return (position < len(self.bits) and
+                bool(self.bits[position] & (0x80 >> (index & 7))))
+
+    def indexes(self):
+        """
+        :return: Generator of the indexes of the pieces, skipping whole bytes
+        without pieces
+        """
+        for position, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield position * 8 + bit
+
+    def to_bytes(self, piece_count):
+        """
+        :return: The payload of a bitfield message for piece_count pieces
+        """
+        length = -(-piece_count // 8)
+        return bytes(self.bits[:length] +
+                     bytearray(max(0, length - len(self.bits))))
 
 
 if __name__ == "__main__":
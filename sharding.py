@@ -0,0 +1,413 @@
+"""
+Running many torrents across several processes.
+
+A single process only uses one core for protocol work, so with many torrents
+the Coordinator spreads them over one worker process per core. The coordinator
+owns the listening socket and announces every torrent to its trackers, while
+the workers run the torrents assigned to them and never talk to trackers.
+
+Peers found by the trackers are sent to the worker owning the torrent. An
+inbound connection is accepted by the coordinator, which reads the handshake to
+learn the info hash and then passes the socket's file descriptor to the owning
+worker (Unix only).
+
+The statistics of every torrent and the global download rate limit live in
+shared memory, so the coordinator can aggregate them and all workers draw from
+the same budget without any messages.
+
+Usage:
+
+    python sharding.py TORRENT [TORRENT ...] [--workers N] [--port PORT]
+                       [--download-rate KIB]
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import argparse
+import collections
+import ctypes
+import multiprocessing
+import os
+import select
+import socket
+import sys
+import threading
+import time
+from multiprocessing import reduction
+
+import lazybencode
+import metainfo
+import peerstore
+import peerwire
+import socketthread
+import torrent
+import tracker
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+DEFAULT_PORT = 6881
+HANDSHAKE_SIZE = 68  # 49 + len("BitTorrent protocol")
+# Seconds an inbound connection has to send its handshake
+HANDSHAKE_TIMEOUT = 10
+# Seconds between announces to the trackers of a torrent and between retries
+# of a failed announce
+ANNOUNCE_INTERVAL = 1800
+ANNOUNCE_RETRY = 60
+# Seconds between updates of the shared statistics by the workers
+STATS_INTERVAL = 1
+# Seconds between status lines printed by serve_forever
+STATUS_INTERVAL = 10
+
+# Messages sent from the coordinator to a worker
+ADD_TORRENT = "add_torrent"  # (ADD_TORRENT, slot, path)
+PEERS = "peers"  # (PEERS, info_hash, [(ip, port), ...])
+INCOMING = "incoming"  # (INCOMING, info_hash, (ip, port), handshake) + fd
+STOP = "stop"  # (STOP,)
+
+# Statistics kept per torrent in shared memory
+STAT_FIELDS = ("connections", "known_peers", "pieces_complete", "downloaded",
+               "left")
+
+Worker = collections.namedtuple("Worker", ["process", "connection", "lock"])
+
+
+class SharedRateLimiter(object):
+    """
+    A token bucket in shared memory that limits the combined rate of every
+    process it is passed to.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Bytes per second
+        :param burst: Most bytes that can be taken at once after being idle,
+        one second worth of rate but at least a block if None.
+        """
+        if burst is None:
+            burst = max(rate, metainfo.BLOCK_SIZE)
+        self.rate = rate
+        self.burst = burst
+        self.lock = multiprocessing.Lock()
+        # Tokens available and the time they were last refilled
+        self.state = multiprocessing.RawArray(ctypes.c_double, 2)
+        self.state[0] = burst
+        self.state[1] = time.time()
+
+    def take(self, amount):
+        """
+        :param amount: Number of bytes about to be transferred
+        :return: True if the bytes fit in the budget and were taken from it
+        """
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst,
+                         self.state[0] + (now - self.state[1]) * self.rate)
+            self.state[1] = now
+            if tokens < amount:
+                self.state[0] = tokens
+                return False
+            self.state[0] = tokens - amount
+            return True
+
+
+def _write_stats(stats, slot, client):
+    base = slot * len(STAT_FIELDS)
+    stats[base] = len(client.connections)
+    stats[base + 1] = len(client.known_peers)
+    stats[base + 2] = client.download.have_count
+    stats[base + 3] = client.download.downloaded
+    stats[base + 4] = client.download.left
+
+
+def run_worker(connection, download_dir, stats, rate_limiter):
+    """
+    The main loop of a worker process. Runs the torrents the coordinator
+    assigns to it until told to stop.
+
+    :param connection: multiprocessing connection to the coordinator
+    :param download_dir: Directory the torrents are downloaded to
+    :param stats: Shared array of the statistics of every torrent
+    :param rate_limiter: SharedRateLimiter or None
+    """
+    torrents = {}  # info_hash mapped to (stats slot, Torrent)
+    last_stats = 0
+
+    while True:
+        while connection.poll():
+            message = connection.recv()
+            kind = message[0]
+            if kind == STOP:
+                for _, client in torrents.values():
+                    client.stop()
+                return
+            elif kind == ADD_TORRENT:
+                _, slot, path = message
+                client = torrent.Torrent(path, download_dir, rate_limiter)
+                client.disk.allocate(client.download.wanted_files())
+                torrents[client.metadata.info_hash] = (slot, client)
+            elif kind == PEERS:
+                _, info_hash, addresses = message
+                _, client = torrents[info_hash]
+                client.known_peers.add_all(
+                    [tracker.PeerAddress(ip, port) for ip, port in addresses],
+                    peerstore.SOURCE_TRACKER)
+            elif kind == INCOMING:
+                _, info_hash, address, handshake = message
+                fd = reduction.recv_handle(connection)
+                sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+                os.close(fd)  # fromfd duplicated it
+                _, client = torrents[info_hash]
+                client.add_incoming(sock, address, handshake)
+
+        handled = 0
+        for _, client in torrents.values():
+            handled += client.poll()
+
+        now = time.time()
+        if now - last_stats >= STATS_INTERVAL:
+            for slot, client in torrents.values():
+                _write_stats(stats, slot, client)
+            last_stats = now
+
+        if not handled:
+            time.sleep(torrent.IDLE_SLEEP)
+
+
+class Coordinator(object):
+    def __init__(self, torrent_paths, download_dir=".", port=DEFAULT_PORT,
+                 worker_count=None, download_rate=None):
+        """
+        :param torrent_paths: Paths of the .torrent files to run
+        :param download_dir: Directory the torrents are downloaded to
+        :param port: Port to accept connections from peers on
+        :param worker_count: Number of worker processes, one per core if None
+        :param download_rate: Combined download limit of all torrents in
+        bytes per second, unlimited if None
+        """
+        if worker_count is None:
+            worker_count = multiprocessing.cpu_count()
+        self.download_dir = download_dir
+        self.port = port
+        self.worker_count = worker_count
+
+        self.torrents = []  # (path, meta_info, Metadata) indexed by slot
+        for path in torrent_paths:
+            with open(path, "rb") as f:
+                meta_info = lazybencode.decode_torrent(f.read())
+            self.torrents.append((path, meta_info,
+                                  metainfo.Metadata(meta_info)))
+        # info_hash mapped to the index of the worker owning the torrent
+        self.owners = {}
+        self.next_announce = [0] * len(self.torrents)
+
+        self.stats = multiprocessing.RawArray(
+            ctypes.c_double, len(self.torrents) * len(STAT_FIELDS))
+        for slot, (_, _, metadata) in enumerate(self.torrents):
+            self.stats[slot * len(STAT_FIELDS) + 4] = metadata.total_length
+        self.rate_limiter = None
+        if download_rate is not None:
+            self.rate_limiter = SharedRateLimiter(download_rate)
+
+        self.workers = []
+        self.listener = None
+        self.running = threading.Event()
+        self.announce_thread = threading.Thread(target=self._announce_loop)
+        self.announce_thread.daemon = True
+
+    def start(self):
+        """
+        Starts the workers, assigns the torrents to them round robin and
+        starts listening and announcing.
+        """
+        # Fork the workers before any thread or the listening socket exists
+        for _ in range(self.worker_count):
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_worker, args=(child_connection, self.download_dir,
+                                         self.stats, self.rate_limiter))
+            process.daemon = True
+            process.start()
+            child_connection.close()
+            self.workers.append(Worker(process, connection, threading.Lock()))
+
+        for slot, (path, _, metadata) in enumerate(self.torrents):
+            owner = slot % self.worker_count
+            self.owners[metadata.info_hash] = owner
+            self._send(owner, (ADD_TORRENT, slot, path))
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("", self.port))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+
+        self.running.set()
+        self.announce_thread.start()
+
+    def _send(self, owner, message, fd=None):
+        """
+        Sends a message, and a file descriptor if given, to a worker. Both go
+        out under the worker's lock so messages from different threads do not
+        interleave.
+        """
+        worker = self.workers[owner]
+        with worker.lock:
+            worker.connection.send(message)
+            if fd is not None:
+                reduction.send_handle(worker.connection, fd,
+                                      worker.process.pid)
+
+    def route(self, sock, address):
+        """
+        Reads the handshake of an inbound connection and passes the
+        connection to the worker owning the torrent it is for.
+
+        :param sock: The accepted socket
+        :param address: (ip, port) tuple of the peer
+        """
+        try:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            handshake = socketthread.receive_all(sock, HANDSHAKE_SIZE)
+            sock.settimeout(None)
+        except socket.error:
+            sock.close()
+            return
+
+        owner = None
+        if len(handshake) == HANDSHAKE_SIZE:
+            info_hash = peerwire.decode_handshake(handshake)['info_hash']
+            owner = self.owners.get(info_hash)
+        if owner is not None:
+            self._send(owner, (INCOMING, info_hash, address, handshake),
+                       sock.fileno())
+        sock.close()
+
+    def announce(self, slot):
+        """
+        Announces a torrent to its trackers and sends the peers they return
+        to the owning worker.
+        """
+        _, meta_info, metadata = self.torrents[slot]
+        base = slot * len(STAT_FIELDS)
+        addresses = tracker.get_peers(meta_info, torrent.PEER_ID,
+                                      metadata.info_hash, port=self.port,
+                                      downloaded=int(self.stats[base + 3]),
+                                      left=int(self.stats[base + 4]))
+        self._send(self.owners[metadata.info_hash],
+                   (PEERS, metadata.info_hash,
+                    [(address.ip, address.port) for address in addresses]))
+
+    def _announce_loop(self):
+        while self.running.is_set():
+            now = time.time()
+            for slot in range(len(self.torrents)):
+                if now < self.next_announce[slot]:
+                    continue
+                try:
+                    self.announce(slot)
+                    self.next_announce[slot] = now + ANNOUNCE_INTERVAL
+                except Exception as e:
+                    # Anything a tracker sends back must not end the thread,
+                    # or the torrent would never be announced again
+                    print("Announce of {} failed: {}".format(
+                        self.torrents[slot][0], e))
+                    self.next_announce[slot] = now + ANNOUNCE_RETRY
+            time.sleep(1)
+
+    def torrent_stats(self, slot):
+        """
+        :return: Dict of the STAT_FIELDS of a torrent
+        """
+        base = slot * len(STAT_FIELDS)
+        return dict((field, self.stats[base + i])
+                    for i, field in enumerate(STAT_FIELDS))
+
+    def total_stats(self):
+        """
+        :return: Dict of the STAT_FIELDS summed over every torrent
+        """
+        totals = dict((field, 0) for field in STAT_FIELDS)
+        for slot in range(len(self.torrents)):
+            for field, value in self.torrent_stats(slot).items():
+                totals[field] += value
+        return totals
+
+    def accept(self, timeout=None):
+        """
+        Accepts pending inbound connections and routes each of them from its
+        own thread, as reading the handshake may take a while.
+
+        :param timeout: Seconds to wait for a connection
+        """
+        readable, _, _ = select.select([self.listener], [], [], timeout)
+        if not readable:
+            return
+        sock, address = self.listener.accept()
+        thread = threading.Thread(target=self.route, args=(sock, address[:2]))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.listener is not None:
+            self.listener.close()
+        for owner, worker in enumerate(self.workers):
+            self._send(owner, (STOP,))
+        for worker in self.workers:
+            worker.process.join()
+            worker.connection.close()
+        self.workers = []
+
+    def serve_forever(self):
+        self.start()
+
+        last_status = time.time()
+        try:
+            while True:
+                self.accept(timeout=1)
+                if time.time() - last_status >= STATUS_INTERVAL:
+                    totals = self.total_stats()
+                    print("{} torrents, {connections:.0f} connections, "
+                          "{downloaded:.0f} bytes downloaded, {left:.0f} bytes "
+                          "left".format(len(self.torrents), **totals))
+                    last_status = time.time()
+        finally:
+            self.stop()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run torrents sharded across worker processes")
+    parser.add_argument("torrents", nargs="+", help="Paths to .torrent files")
+    parser.add_argument("--download-dir", default=".",
+                        help="Directory to download to")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="Port to accept peer connections on")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes, one per core by "
+                             "default")
+    parser.add_argument("--download-rate", type=int, default=None,
+                        help="Combined download limit in KiB/s")
+    args = parser.parse_args(argv[1:])
+
+    download_rate = None
+    if args.download_rate is not None:
+        download_rate = args.download_rate * 2 ** 10
+    coordinator = Coordinator(args.torrents, args.download_dir, args.port,
+                              args.workers, download_rate)
+    coordinator.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -45,6 +45,37 @@ def receive_all(sock, n):
     return data
 
 
+class MessageTooLargeError(socket.error):
+    """
+    The length prefix of a message exceeded the allowed maximum. The message is
+    not read, so the connection can not be used anymore.
+    """
+
+
+PREFIX_FORMATS = {
+    1: b"!B",
+    2: b"!H",
+    4: b"!I",
+    8: b"!Q",
+}
+
+
+def unpack_prefix(length_prefix):
+    """
+    Unpacks a big-endian length prefix.
+
+    :param length_prefix: The raw prefix of 1, 2, 4 or 8 bytes
+    :return: The length as an integer
+    :raise TypeError: If the prefix has an unsupported size
+    """
+    prefix_format = PREFIX_FORMATS.get(len(length_prefix))
+    if prefix_format is None:
+        error = "prefix_size must be either 1,2,4 or 8 got {}".\
+            format(len(length_prefix))
+        raise TypeError(error)
+    return struct.unpack(prefix_format, length_prefix)[0]
+
+
 class SocketCommand(object):
     """
     Command object for communicating with SocketThread.
@@ -53,7 +84,7 @@ class SocketCommand(object):
     SocketCommand.CONNECT               (host, port) tuple
     SocketCommand.SEND                  Binary data string
     SocketCommand.RECEIVE               Number of bytes to receive
-    SocketCommand.RECEIVE_WITH_PREFIX   byte size of the prefix
+    SocketCommand.RECEIVE_WITH_PREFIX   (prefix size, max length) tuple
     SocketCommand.CLOSE                 None
     """
 
@@ -97,18 +128,25 @@ class SocketThread(threading.Thread):
     """
     # TODO: should we keep track of what command corresponds to what reply?
 
-    def __init__(self):
+    def __init__(self, sock=None):
+        """
+        :param sock: An already connected socket to use, such as one accepted
+        by a listening socket. connect must not be called if given.
+        """
         super(SocketThread, self).__init__()
 
         self.command_queue = queue.Queue()
         self.reply_queue = queue.Queue()
-        self.socket = None
+        self.socket = sock
+        self.send_lock = threading.Lock()
 
         self.alive = threading.Event()
         self.alive.set()
 
         self.connected = threading.Event()
         self.connected.clear()
+        if sock is not None:
+            self.connected.set()
 
     def run(self):
         """
@@ -133,8 +171,8 @@ class SocketThread(threading.Thread):
                     number_of_bytes = cmd.payload
                     self._handle_RECEIVE(number_of_bytes)
                 elif cmd.command == SocketCommand.RECEIVE_WITH_PREFIX:
-                    prefix_size = cmd.payload
-                    self._handle_RECEIVE_WITH_PREFIX(prefix_size)
+                    prefix_size, max_length = cmd.payload
+                    self._handle_RECEIVE_WITH_PREFIX(prefix_size, max_length)
                 else:
                     # TODO: Handle invalid command
                     pass
@@ -171,9 +209,15 @@ class SocketThread(threading.Thread):
 
     def close(self):
         """
-        Closes the socket
+        Closes the socket. The socket is shut down right away so a receive the
+        thread is blocked in returns and the close command gets handled.
         """
-        self.command_queue.put(SocketCommand(SocketCommand.CONNECT))
+        if self.socket is not None and self.is_connected():
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # Already closed by the peer
+        self.command_queue.put(SocketCommand(SocketCommand.CLOSE))
 
     def send(self, payload):
         """
@@ -182,6 +226,20 @@ class SocketThread(threading.Thread):
         """
         self.command_queue.put(SocketCommand(SocketCommand.SEND, payload))
 
+    def sendall(self, payload):
+        """
+        Sends the payload right away from the calling thread instead of going
+        through the command queue, so a send is never stuck behind a pending
+        receive. No reply is put in the reply queue. Requires a connected
+        socket.
+        :param payload: Byte string of data
+        :raise socket.error: If the data could not be sent
+        """
+        if not self.is_connected():
+            raise socket.error("Socket is not connected")
+        with self.send_lock:
+            self.socket.sendall(payload)
+
     def receive(self, n):
         """
         Receives a specified number of bytes from the socket. Requires an open
@@ -190,14 +248,16 @@ class SocketThread(threading.Thread):
         """
         self.command_queue.put(SocketCommand(SocketCommand.RECEIVE, n))
 
-    def receive_with_prefix(self, prefix_size):
+    def receive_with_prefix(self, prefix_size, max_length=None):
         """
         Receive a message that has a length prefix that is prefix_size bytes
         long.
         :param prefix_size: byte size of the prefix
+        :param max_length: If given a message longer than this is refused with
+        a MessageTooLargeError instead of being read.
         """
         self.command_queue.put(SocketCommand(SocketCommand.RECEIVE_WITH_PREFIX,
-                                             prefix_size))
+                                             (prefix_size, max_length)))
 
     def get_reply(self, block=True, timeout=None):
         """
@@ -220,12 +280,15 @@ class SocketThread(threading.Thread):
         Handles the connection command by creating a tcp connection to the given
         address.
 
-        :param address: (host, port) tuple
+        :param address: (host, port) tuple, the host may be an IPv6 address
         """
-        self.socket = socket.socket(socket.AF_INET,
-                                    socket.SOCK_STREAM)  # tcp connection
+        # Only IPv6 addresses contain a colon, hosts and IPv4 addresses do not
+        family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
 
         try:
+            # Creating the socket fails too if the host has no IPv6 support
+            self.socket = socket.socket(family,
+                                        socket.SOCK_STREAM)  # tcp connection
             self.socket.connect(address)
             self.connected.set()
             self.reply_queue.put(SocketReply(SocketReply.SUCCESS))
@@ -235,10 +298,12 @@ class SocketThread(threading.Thread):
     def _handle_CLOSE(self):
         """
         Handles the close command. This requires that a socket already has been
-        opened.
+        opened. The thread stops afterwards, as a closed socket is not reused.
         """
-        self.socket.close()
+        if self.socket is not None:
+            self.socket.close()
         self.connected.clear()
+        self.alive.clear()
         self.reply_queue.put(SocketReply(SocketReply.SUCCESS))
 
     def _handle_SEND(self, payload):
@@ -248,7 +313,8 @@ class SocketThread(threading.Thread):
         :param payload:
         """
         try:
-            self.socket.sendall(payload)
+            with self.send_lock:
+                self.socket.sendall(payload)
             self.reply_queue.put(SocketReply(SocketReply.SUCCESS))
         except socket.error as e:
             self.reply_queue.put(SocketReply(SocketReply.ERROR, e))
@@ -266,36 +332,31 @@ class SocketThread(threading.Thread):
         except socket.error as e:
             self.reply_queue.put(SocketReply(SocketReply.ERROR, e))
 
-    def _handle_RECEIVE_WITH_PREFIX(self, prefix_size):
+    def _handle_RECEIVE_WITH_PREFIX(self, prefix_size, max_length=None):
         """
         Handles the receive with prefix command. This require an open and valid
         socket connection.
         :param prefix_size: byte size of the prefix
+        :param max_length: Maximum allowed message length or None
         :return:
         """
         try:
             length_prefix = receive_all(self.socket, prefix_size)
             if len(length_prefix) == prefix_size:
-                if prefix_size == 1:
-                    message_length = struct.unpack(b"!B", length_prefix)[0]
-                elif prefix_size == 2:
-                    message_length = struct.unpack(b"!H", length_prefix)[0]
-                elif prefix_size == 4:
-                    message_length = struct.unpack(b"!I", length_prefix)[0]
-                elif prefix_size == 8:
-                    message_length = struct.unpack(b"!Q", length_prefix)[0]
-                else:
-                    error = "prefix_size must be either 1,2,4 or 8 got {}".\
-                        format(prefix_size)
-                    raise TypeError(error)
+                message_length = unpack_prefix(length_prefix)
+
+                if max_length is not None and message_length > max_length:
+                    # A garbage or hostile length prefix would otherwise make
+                    # receive_all try to allocate and read up to 4 GiB.
+                    error = MessageTooLargeError(
+                        "Message of {} bytes exceeds the maximum of {}".format(
+                            message_length, max_length))
+                    self.reply_queue.put(SocketReply(SocketReply.ERROR, error))
+                    return
 
                 if message_length == 0:
                     received_data = b''
                 else:
-                    # A Peer sometimes seems to send a message that raises an
-                    # Overflow error in the call to receive_all.
-                    # TODO: debug overflow error
-                    # print("msg len:", message_length, "prefix_size:", prefix_size)
                     received_data = receive_all(self.socket, message_length)
 
                 if len(received_data) == message_length:
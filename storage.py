@@ -0,0 +1,178 @@
+"""
+Maps the pieces of a torrent onto the files on disk.
+
+A torrent is treated as one long byte string made up of all its files after
+each other. Reads and writes at an offset in that byte string are split into
+the parts that fall within each file using the precomputed file offsets of
+metainfo.Metadata.
+
+Storage can be used from several threads at once, see diskio.py. Every thread
+gets its own file objects so the seek and write of one thread can not be
+interleaved with those of another.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import errno
+import os
+import sys
+import threading
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+
+class Storage(object):
+    def __init__(self, metadata, directory="."):
+        """
+        :param metadata: metainfo.Metadata of the torrent
+        :param directory: Directory the files of the torrent are placed in
+        """
+        self.metadata = metadata
+        self.directory = directory
+        # Holds the handles attribute of each thread, a dict of file indexes
+        # mapped to open file objects
+        self.local = threading.local()
+        self.all_handles = []  # The file objects of every thread
+        self.lock = threading.Lock()
+        # Indexes of files that are not downloaded. Writes to them are dropped
+        # so they are never created. Replaced, never modified in place, as
+        # other threads may be writing.
+        self.skipped = frozenset()
+
+    def file_path(self, index):
+        """
+        :param index: Index into metadata.files
+        :return: Path of the file on disk
+        """
+        path = [self.decode_path(part)
+                for part in self.metadata.files[index].path]
+        return os.path.join(self.directory, *path)
+
+    @staticmethod
+    def decode_path(part):
+        if isinstance(part, bytes):
+            return part.decode("utf-8", "replace")
+        return part
+
+    def allocate(self, indexes=None):
+        """
+        Creates the files of the torrent with their full length. The files are
+        created sparse so this does not write any data.
+
+        :param indexes: Indexes of the files to allocate, all files if None
+        """
+        if indexes is None:
+            indexes = range(len(self.metadata.files))
+
+        for index in indexes:
+            path = self._create(index)
+            with open(path, "ab") as f:
+                length = self.metadata.files[index].length
+                if os.path.getsize(path) != length:
+                    f.truncate(length)
+
+    def _create(self, index):
+        """
+        Creates a file and its directories if they do not exist.
+
+        :return: Path of the file
+        """
+        path = self.file_path(index)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:  # Created by another thread
+                    raise
+        if not os.path.exists(path):
+            open(path, "ab").close()
+        return path
+
+    def _handle(self, index):
+        handles = getattr(self.local, "handles", None)
+        if handles is None:
+            handles = self.local.handles = {}
+        handle = handles.get(index)
+        if handle is None:
+            # Writes may arrive before the file has been allocated
+            handle = open(self._create(index), "r+b")
+            handles[index] = handle
+            with self.lock:
+                self.all_handles.append(handle)
+        return handle
+
+    def write(self, offset, data):
+        """
+        Writes data at the given offset of the torrent. The data is flushed
+        so it can be read through the file objects of other threads right
+        away.
+
+        :param offset: Byte offset in the torrent as a whole
+        :param data: Bytes to write
+        """
+        data = memoryview(data)
+        position = 0
+        skipped = self.skipped
+        for index, file_offset, length in self.metadata.file_spans(offset,
+                                                                   len(data)):
+            if index in skipped:
+                position += length
+                continue
+            handle = self._handle(index)
+            handle.seek(file_offset)
+            handle.write(data[position:position + length])
+            handle.flush()
+            position += length
+
+    def read(self, offset, length):
+        """
+        Reads length bytes at the given offset of the torrent.
+
+        :param offset: Byte offset in the torrent as a whole
+        :param length: Number of bytes to read
+        :return: The read bytes
+        """
+        parts = []
+        for index, file_offset, span in self.metadata.file_spans(offset,
+                                                                 length):
+            handle = self._handle(index)
+            handle.seek(file_offset)
+            parts.append(handle.read(span))
+        return b"".join(parts)
+
+    def write_piece(self, index, data):
+        self.write(index * self.metadata.piece_length, data)
+
+    def read_piece(self, index):
+        return self.read(index * self.metadata.piece_length,
+                         self.metadata.piece_size(index))
+
+    def flush(self):
+        """
+        Flushes the file objects of the calling thread.
+        """
+        for handle in getattr(self.local, "handles", {}).values():
+            handle.flush()
+
+    def close(self):
+        """
+        Closes the file objects of every thread. No other thread may be using
+        the storage.
+        """
+        with self.lock:
+            for handle in self.all_handles:
+                handle.close()
+            self.all_handles = []
+        self.local = threading.local()
@@ -0,0 +1,113 @@
+"""
+Reading a torrent while it is being downloaded.
+
+A StreamReader is a file-like object over the whole torrent or a single file
+of it. It puts the torrent in streaming mode at the position it reads from and
+a read only blocks until the piece it needs has been verified, so a consumer
+such as a media transcoder can start long before the download is complete.
+
+The reader is meant to be used from another thread than the one running the
+torrent's main loop.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import io
+import sys
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+
+class StreamReader(object):
+    def __init__(self, torrent, rate, start=0, length=None, timeout=None):
+        """
+        :param torrent: torrent.Torrent to read from
+        :param rate: Bytes per second the data is consumed at, used to give
+        the pieces ahead of the read position their deadlines
+        :param start: Byte offset in the torrent the stream starts at
+        :param length: Length of the stream, up to the end of the torrent if
+        None
+        :param timeout: Most seconds a read waits for a piece, forever if None
+        """
+        if length is None:
+            length = torrent.metadata.total_length - start
+        self.torrent = torrent
+        self.rate = rate
+        self.start = start
+        self.length = length
+        self.timeout = timeout
+        self.position = 0
+        self.closed = False
+        torrent.download.set_playback(start, rate)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """
+        Moves the read position, which also moves the streaming window.
+        """
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        self.torrent.download.set_playback(self.start + self.position,
+                                           self.rate)
+        return self.position
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes, all remaining bytes if negative. Like a raw
+        file at most the rest of the current piece is returned, so only a
+        single piece is waited for.
+
+        :return: The bytes read, empty at the end of the stream
+        :raise IOError: If the piece did not arrive within the timeout
+        """
+        if self.closed:
+            raise ValueError("read of closed stream")
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b""
+
+        metadata = self.torrent.metadata
+        offset = self.start + self.position
+        index = offset // metadata.piece_length
+        size = min(size, (index + 1) * metadata.piece_length - offset)
+        if not self.torrent.download.wait_for_piece(index, self.timeout):
+            raise IOError("Piece {} is skipped or did not arrive within {} "
+                          "seconds".format(index, self.timeout))
+
+        data = self.torrent.storage.read(offset, size)
+        self.position += len(data)
+        self.torrent.download.set_playback(self.start + self.position,
+                                           self.rate)
+        return data
+
+    def close(self):
+        """
+        Turns streaming mode off again.
+        """
+        if not self.closed:
+            self.closed = True
+            self.torrent.download.set_playback(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
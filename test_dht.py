@@ -0,0 +1,116 @@
+"""
+The DHT node against a cluster of nodes on localhost.
+
+Run with python -m unittest test_dht
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import bencode
+import dht
+import lazybencode
+import loopback
+import tracker
+
+INFO_HASH = b"\x42" * dht.ID_LENGTH
+
+
+class DHTTest(unittest.TestCase):
+    def setUp(self):
+        self.cluster = loopback.DHTCluster(6)
+        self.cluster.start()
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def run_on_cluster(self, function):
+        """
+        Runs function(done) on the thread of the cluster, where done must be
+        called with the result.
+
+        :return: The result
+        """
+        finished = threading.Event()
+        results = []
+
+        def done(result):
+            results.append(result)
+            finished.set()
+
+        self.cluster.commands.put(lambda: function(done))
+        self.assertTrue(finished.wait(10))
+        return results[0]
+
+    def test_bootstrap_fills_routing_tables(self):
+        others = len(self.cluster.nodes) - 1
+        first = self.cluster.nodes[0]
+        self.assertEqual(len(first.table), others)
+        for node in self.cluster.nodes[1:]:
+            self.assertGreater(len(node.table), 0)
+            self.assertTrue(first.node_id in
+                            [other.id for other in node.table])
+
+    def test_get_peers_returns_announced_peer(self):
+        self.cluster.announce(INFO_HASH, 6881)
+        node = self.cluster.nodes[-1]
+        found = set()
+        self.run_on_cluster(lambda done: node.get_peers(
+            INFO_HASH, found.update, on_done=done))
+        self.assertIn(tracker.PeerAddress("127.0.0.1", 6881), found)
+
+    def test_announce_with_invalid_token_is_rejected(self):
+        node = self.cluster.nodes[0]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        try:
+            sock.sendto(bencode.encode({
+                b"t": b"aa", b"y": b"q", b"q": b"announce_peer",
+                b"a": {b"id": b"\x01" * dht.ID_LENGTH,
+                       b"info_hash": INFO_HASH, b"port": 6881,
+                       b"token": b"invalid!"}}), node.address)
+            reply = lazybencode.decode(sock.recvfrom(dht.MAX_PACKET)[0])
+        finally:
+            sock.close()
+        self.assertEqual(reply[b"y"], b"e")
+        self.assertEqual(reply[b"t"], b"aa")
+        self.assertEqual(reply[b"e"][0], dht.ERROR_PROTOCOL)
+        self.assertFalse(self.run_on_cluster(
+            lambda done: done(node.stored_peers(INFO_HASH))))
+
+    def test_saved_state_loads_back(self):
+        directory = tempfile.mkdtemp(prefix="pytorrent-test-")
+        try:
+            path = os.path.join(directory, "dht.dat")
+            node = self.cluster.nodes[0]
+            saved = self.run_on_cluster(lambda done: done(
+                (node.save(path),
+                 set((other.id, other.address) for other in node.table))))[1]
+
+            node_id, nodes = dht.DHTNode._load(path, None)
+            self.assertEqual(node_id, node.node_id)
+            self.assertEqual(set(nodes), saved)
+
+            restarted = dht.DHTNode(ip="127.0.0.1", state_path=path)
+            try:
+                self.assertEqual(restarted.node_id, node.node_id)
+                self.assertEqual(len(restarted.table), len(saved))
+            finally:
+                restarted.sock.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+"""
+Piece bookkeeping of download.Download.
+
+Run with python -m unittest test_download
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import unittest
+
+import bencode
+import download
+import lazybencode
+import loopback
+import metainfo
+import peerwire
+
+PIECE_LENGTH = 2 ** 14
+FILE_LENGTH = 30000
+FILE_COUNT = 4
+
+HIGH = download.PRIORITY_HIGH
+NORMAL = download.PRIORITY_NORMAL
+SKIP = download.PRIORITY_SKIP
+
+
+def make_metadata(piece_length=PIECE_LENGTH):
+    """
+    Four files of 30000 bytes, by default in pieces of 16 KiB:
+
+    piece  0     1     2     3     4     5     6     7
+    file   0    0,1    1    1,2    2    2,3    3     3
+    """
+    data = loopback.synthetic_data(FILE_LENGTH * FILE_COUNT)
+    meta_info = loopback.make_meta_info(data, piece_length, "",
+                                        file_count=FILE_COUNT)
+    return metainfo.Metadata(
+        lazybencode.decode_torrent(bencode.encode(meta_info)))
+
+
+class FakePeer(object):
+    def __init__(self, piece_count, indexes=None):
+        """
+        :param indexes: The pieces the peer has, every piece if None
+        """
+        if indexes is None:
+            self.bitfield = peerwire.Bitfield.full(piece_count)
+        else:
+            self.bitfield = peerwire.Bitfield()
+            for index in indexes:
+                self.bitfield.add_index(index)
+        self.suggested_pieces = set()
+
+
+class FilePrioritiesTest(unittest.TestCase):
+    def setUp(self):
+        self.metadata = make_metadata()
+        self.download = download.Download(self.metadata, disk=None)
+
+    def complete(self, index):
+        self.download._on_piece_written(
+            index, self.metadata.piece_size(index), True, None)
+
+    def test_skipped_file(self):
+        self.download.set_file_priorities([NORMAL, SKIP, NORMAL, NORMAL])
+        self.assertEqual(self.download.piece_priorities,
+                         [NORMAL, NORMAL, SKIP, NORMAL,
+                          NORMAL, NORMAL, NORMAL, NORMAL])
+        self.assertEqual(self.download.wanted_bytes,
+                         [PIECE_LENGTH, FILE_LENGTH - PIECE_LENGTH, 0,
+                          4 * PIECE_LENGTH - 2 * FILE_LENGTH,
+                          PIECE_LENGTH, PIECE_LENGTH, PIECE_LENGTH,
+                          FILE_LENGTH * FILE_COUNT - 7 * PIECE_LENGTH])
+        self.assertEqual(self.download.left, 3 * FILE_LENGTH)
+        self.assertEqual(self.download.wanted_left, 7)
+        self.assertEqual(self.download.wanted_files(), [0, 2, 3])
+
+        for index in (0, 1):
+            self.complete(index)
+        self.assertEqual(self.download.left, 2 * FILE_LENGTH)
+        self.assertEqual(self.download.wanted_left, 5)
+
+    def test_unskipped_file_downloads_straddling_pieces_again(self):
+        self.download.set_file_priorities([NORMAL, SKIP, NORMAL, NORMAL])
+        for index in (0, 1, 3):
+            self.complete(index)
+        self.assertEqual(self.download.have_count, 3)
+
+        self.download.set_file_priorities([NORMAL] * FILE_COUNT)
+        # Only the part of pieces 1 and 3 in the wanted files was written
+        self.assertEqual(self.download.have,
+                         [True, False, False, False,
+                          False, False, False, False])
+        self.assertEqual(self.download.have_count, 1)
+        self.assertEqual(self.download.left,
+                         FILE_LENGTH * FILE_COUNT - PIECE_LENGTH)
+        self.assertEqual(self.download.wanted_left, 7)
+
+    def test_skipped_piece_is_not_waited_for(self):
+        self.download.set_file_priorities([NORMAL, SKIP, NORMAL, NORMAL])
+        self.assertFalse(self.download.wait_for_piece(2))
+
+    def test_wrong_priority_count(self):
+        with self.assertRaises(ValueError):
+            self.download.set_file_priorities([NORMAL])
+
+
+class StartedPiecesTest(unittest.TestCase):
+    """
+    Pieces of two blocks, so a piece can be started and left with a block
+    pending:
+
+    piece  0     1     2     3
+    file  0,1   1,2   2,3    3
+    """
+
+    def setUp(self):
+        self.metadata = make_metadata(2 * metainfo.BLOCK_SIZE)
+        self.download = download.Download(self.metadata, disk=None)
+
+    def start_piece(self, index):
+        peer = FakePeer(self.metadata.piece_count, [index])
+        self.assertEqual(self.download.next_request(peer)[0], index)
+
+    def test_started_pieces_by_priority(self):
+        self.start_piece(1)
+        self.start_piece(3)
+        peer = FakePeer(self.metadata.piece_count)
+        self.download.set_file_priorities([SKIP, NORMAL, NORMAL, HIGH])
+        self.assertEqual(self.download.next_request(peer)[0], 3)
+        self.assertEqual(self.download.next_request(peer)[0], 1)
+
+    def test_skipped_started_piece_is_dropped(self):
+        self.start_piece(0)
+        self.start_piece(3)
+        self.download.set_file_priorities([SKIP, SKIP, NORMAL, NORMAL])
+        self.assertEqual(sorted(self.download.active), [3])
+        peer = FakePeer(self.metadata.piece_count)
+        self.assertEqual(self.download.next_request(peer)[0], 3)
+        self.assertEqual(self.download.next_request(peer)[0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Decoding .torrent files and tracker responses with lazybencode.
+
+Run with python -m unittest test_lazybencode
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import hashlib
+import unittest
+
+import bencode
+import lazybencode
+import loopback
+import tracker
+
+PIECE_LENGTH = 2 ** 14
+
+
+def make_meta_info(file_count=3):
+    data = loopback.synthetic_data(5 * PIECE_LENGTH + 100)
+    return loopback.make_meta_info(data, PIECE_LENGTH,
+                                   "http://127.0.0.1:1/announce",
+                                   file_count=file_count)
+
+
+class DecodeTest(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(lazybencode.decode(b"i-42e"), -42)
+        self.assertEqual(lazybencode.decode(b"4:spam"), b"spam")
+        self.assertEqual(lazybencode.decode(b"0:"), b"")
+        self.assertEqual(lazybencode.decode(b"li1e3:abclee"),
+                         [1, b"abc", []])
+        self.assertEqual(lazybencode.decode(b"d1:ai1e1:bl1:cee"),
+                         {b"a": 1, b"b": [b"c"]})
+
+    def test_invalid_data(self):
+        for data in (b"", b"x", b"i1", b"l", b"d1:a", b"5:abc",
+                     b"i1ei2e", b"-1:"):
+            with self.assertRaises(ValueError):
+                lazybencode.decode(data)
+
+    def test_torrent_views_and_lazy_files(self):
+        meta_info = make_meta_info()
+        decoded = lazybencode.decode_torrent(bencode.encode(meta_info))
+        info = decoded[b"info"]
+        self.assertIsInstance(info[b"pieces"], memoryview)
+        self.assertEqual(info[b"pieces"].tobytes(),
+                         meta_info[b"info"][b"pieces"])
+        self.assertIsInstance(info[b"files"], lazybencode.LazyList)
+        self.assertEqual(len(info[b"files"]), 3)
+        self.assertEqual(list(info[b"files"]), meta_info[b"info"][b"files"])
+        self.assertEqual(info[b"files"][-1], meta_info[b"info"][b"files"][-1])
+        self.assertEqual(info[b"files"][1:], meta_info[b"info"][b"files"][1:])
+
+
+class InfoHashTest(unittest.TestCase):
+    def test_raw_info_matches_reencoded_info(self):
+        for file_count in (1, 3):
+            meta_info = make_meta_info(file_count)
+            decoded = lazybencode.decode_torrent(bencode.encode(meta_info))
+            self.assertEqual(decoded.raw_info.tobytes(),
+                             bencode.encode(meta_info[b"info"]))
+            self.assertEqual(tracker.calc_info_hash(decoded),
+                             tracker.calc_info_hash(meta_info))
+
+    def test_raw_info_of_unsorted_keys(self):
+        # Keys out of order, re-encoding the info dict would sort them and
+        # give another hash than the one the swarm uses
+        raw_info = (b"d4:name1:x6:lengthi5e12:piece lengthi16384e"
+                    b"6:pieces20:" + b"a" * 20 + b"e")
+        self.assertNotEqual(bencode.encode(lazybencode.decode(raw_info)),
+                            raw_info)
+        decoded = lazybencode.decode_torrent(b"d4:info" + raw_info + b"e")
+        self.assertEqual(tracker.calc_info_hash(decoded),
+                         hashlib.sha1(raw_info).digest())
+
+    def test_no_info(self):
+        decoded = lazybencode.decode(b"d8:intervali1800ee")
+        self.assertIsNone(decoded.raw_info)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+"""
+Downloading the info dict of a magnet link through ut_metadata.
+
+Run with python -m unittest test_magnet
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import hashlib
+import unittest
+
+import bencode
+import extension
+import magnet
+
+# Three pieces of ut_metadata, one more than are requested from a peer at once
+RAW_INFO = bencode.encode({b"name": b"test", b"pad": b"x" * 40000})
+INFO_HASH = hashlib.sha1(RAW_INFO).digest()
+METADATA_ID = 3
+
+
+class FakePeer(object):
+    """
+    A peer that records the ut_metadata messages sent to it.
+    """
+
+    def __init__(self, metadata_size=len(RAW_INFO)):
+        self.extensions = {b"ut_metadata": METADATA_ID}
+        self.metadata_size = metadata_size
+        self.sent = []
+
+    def send_message(self, message):
+        self.sent.append(extension.decode_metadata_message(message[6:]))
+
+    def take_requests(self):
+        """
+        :return: Pieces requested since the last call
+        """
+        pieces = [piece for msg_type, piece, _, _ in self.sent
+                  if msg_type == extension.METADATA_REQUEST]
+        self.sent = []
+        return pieces
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def payload(msg_type, piece, total_size=None, data=b""):
+    """
+    :return: A ut_metadata message as passed to on_message
+    """
+    return extension.generate_metadata_message(0, msg_type, piece,
+                                               total_size, data)[6:]
+
+
+def piece_data(piece, raw_info=RAW_INFO):
+    start = piece * extension.METADATA_PIECE_SIZE
+    return raw_info[start:start + extension.METADATA_PIECE_SIZE]
+
+
+class MetadataExchangeTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = magnet.time
+        magnet.time = self.clock
+        self.exchange = magnet.MetadataExchange(INFO_HASH)
+
+    def tearDown(self):
+        magnet.time = self.time
+
+    def send_piece(self, peer, piece, raw_info=RAW_INFO):
+        self.exchange.on_message(peer, payload(
+            extension.METADATA_DATA, piece, len(raw_info),
+            piece_data(piece, raw_info)))
+
+    def download(self, peer):
+        """
+        Answers every request made to the peer until nothing is requested.
+        """
+        while True:
+            self.exchange.fill_requests(peer)
+            pieces = peer.take_requests()
+            if not pieces:
+                return
+            for piece in pieces:
+                self.send_piece(peer, piece)
+
+    def test_download_from_one_peer(self):
+        peer = FakePeer()
+        self.exchange.fill_requests(peer)
+        self.assertEqual(peer.take_requests(), [0, 1])
+        self.send_piece(peer, 1)
+        self.send_piece(peer, 0)
+        self.exchange.fill_requests(peer)
+        self.assertEqual(peer.take_requests(), [2])
+        self.send_piece(peer, 2)
+        self.assertTrue(self.exchange.is_complete())
+        self.assertEqual(self.exchange.raw_info, RAW_INFO)
+
+    def test_reject_of_wrong_size_lets_other_size_lead(self):
+        wrong = FakePeer(metadata_size=100)
+        right = FakePeer()
+        self.exchange.fill_requests(wrong)
+        self.exchange.fill_requests(right)
+        self.assertEqual(wrong.take_requests(), [0])
+        self.assertEqual(right.take_requests(), [])
+
+        self.exchange.on_message(wrong, payload(extension.METADATA_REJECT, 0))
+        self.exchange.fill_requests(wrong)
+        self.assertEqual(wrong.take_requests(), [])
+        self.download(right)
+        self.assertEqual(self.exchange.raw_info, RAW_INFO)
+
+    def test_timed_out_request_goes_to_other_peer(self):
+        slow = FakePeer()
+        fast = FakePeer()
+        self.exchange.fill_requests(slow)
+        self.assertEqual(slow.take_requests(), [0, 1])
+
+        self.clock.now += magnet.METADATA_TIMEOUT
+        self.exchange.fill_requests(fast)
+        self.assertEqual(fast.take_requests(), [0, 1])
+        self.exchange.fill_requests(slow)
+        self.assertEqual(slow.take_requests(), [])
+
+    def test_stalled_peer_is_asked_again(self):
+        slow = FakePeer()
+        self.exchange.fill_requests(slow)
+        self.assertEqual(slow.take_requests(), [0, 1])
+
+        self.clock.now += magnet.METADATA_TIMEOUT
+        self.exchange.fill_requests(slow)
+        self.assertEqual(slow.take_requests(), [])
+
+        self.clock.now += magnet.METADATA_STALL_DELAY
+        self.download(slow)
+        self.assertEqual(self.exchange.raw_info, RAW_INFO)
+
+    def test_late_piece_clears_stall(self):
+        slow = FakePeer()
+        fast = FakePeer()
+        self.exchange.fill_requests(slow)
+        self.assertEqual(slow.take_requests(), [0, 1])
+        self.clock.now += magnet.METADATA_TIMEOUT
+        self.exchange.fill_requests(fast)
+        self.assertEqual(fast.take_requests(), [0, 1])
+
+        self.send_piece(slow, 0)
+        self.exchange.fill_requests(slow)
+        self.assertEqual(slow.take_requests(), [2])
+
+    def test_hash_mismatch_bans_senders(self):
+        liar = FakePeer()
+        honest = FakePeer()
+        self.exchange.fill_requests(liar)
+        liar.take_requests()
+        bad_info = b"y" * len(RAW_INFO)
+        for piece in range(3):
+            self.send_piece(liar, piece, bad_info)
+        self.assertFalse(self.exchange.is_complete())
+
+        self.exchange.fill_requests(liar)
+        self.assertEqual(liar.take_requests(), [])
+        self.download(honest)
+        self.assertEqual(self.exchange.raw_info, RAW_INFO)
+
+    def test_serves_known_info_dict(self):
+        exchange = magnet.MetadataExchange(INFO_HASH, RAW_INFO)
+        peer = FakePeer()
+        exchange.on_message(peer, payload(extension.METADATA_REQUEST, 1))
+        exchange.on_message(peer, payload(extension.METADATA_REQUEST, 3))
+        self.assertEqual(peer.sent, [
+            (extension.METADATA_DATA, 1, len(RAW_INFO), piece_data(1)),
+            (extension.METADATA_REJECT, 3, None, b"")])
+
+
+class ParseMagnetTest(unittest.TestCase):
+    def test_hex_and_base32_info_hash(self):
+        hex_hash = "c12fe1c06bba254a9dc9f519b335aa7c1367a88a"
+        link = magnet.parse_magnet(
+            "magnet:?xt=urn:btih:{}&dn=name&tr=http%3A%2F%2Ft%2Fa"
+            "&x.pe=10.0.0.1:6881&x.pe=[::1]:6882".format(hex_hash))
+        self.assertEqual(link.info_hash, bytes(bytearray.fromhex(hex_hash)))
+        self.assertEqual(link.name, "name")
+        self.assertEqual(link.trackers, ["http://t/a"])
+        self.assertEqual([(peer.ip, peer.port) for peer in link.peers],
+                         [("10.0.0.1", 6881), ("::1", 6882)])
+
+        base32 = magnet.parse_magnet(
+            "magnet:?xt=urn:btih:YEX6DQDLXISUVHOJ6UM3GNNKPQJWPKEK")
+        self.assertEqual(base32.info_hash, link.info_hash)
+
+    def test_rejects_other_links(self):
+        with self.assertRaises(ValueError):
+            magnet.parse_magnet("http://example.com/")
+        with self.assertRaises(ValueError):
+            magnet.parse_magnet("magnet:?xt=urn:sha1:abc")
+
+
+if __name__ == "__main__":
+    unittest.main()
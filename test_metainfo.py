@@ -0,0 +1,121 @@
+"""
+Piece and file geometry of metainfo.Metadata.
+
+Run with python -m unittest test_metainfo
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import unittest
+
+import bencode
+import lazybencode
+import loopback
+import metainfo
+import tracker
+
+PIECE_LENGTH = 2 ** 15
+FILE_LENGTH = 30000
+FILE_COUNT = 4
+
+
+def make_metadata(meta_info):
+    return metainfo.Metadata(
+        lazybencode.decode_torrent(bencode.encode(meta_info)))
+
+
+def make_meta_info(file_count=FILE_COUNT):
+    data = loopback.synthetic_data(FILE_LENGTH * FILE_COUNT)
+    return loopback.make_meta_info(data, PIECE_LENGTH, "",
+                                   file_count=file_count)
+
+
+class MetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.meta_info = make_meta_info()
+        self.metadata = make_metadata(self.meta_info)
+
+    def test_geometry(self):
+        metadata = self.metadata
+        self.assertEqual(metadata.info_hash,
+                         tracker.calc_info_hash(self.meta_info))
+        self.assertEqual(metadata.total_length, FILE_LENGTH * FILE_COUNT)
+        self.assertEqual(metadata.piece_count, 4)
+        self.assertEqual(metadata.piece_size(0), PIECE_LENGTH)
+        self.assertEqual(metadata.piece_size(3),
+                         FILE_LENGTH * FILE_COUNT - 3 * PIECE_LENGTH)
+        self.assertEqual(metadata.block_count(0), 2)
+        self.assertEqual(metadata.block_count(3), 2)
+        self.assertEqual(metadata.piece_hash(1),
+                         self.meta_info[b"info"][b"pieces"][20:40])
+        self.assertEqual(metadata.file_offsets,
+                         tuple(FILE_LENGTH * index
+                               for index in range(FILE_COUNT)))
+
+    def test_file_index_at_boundaries(self):
+        metadata = self.metadata
+        self.assertEqual(metadata.file_index(0), 0)
+        self.assertEqual(metadata.file_index(FILE_LENGTH - 1), 0)
+        self.assertEqual(metadata.file_index(FILE_LENGTH), 1)
+        self.assertEqual(metadata.file_index(3 * FILE_LENGTH), 3)
+        self.assertEqual(metadata.file_index(metadata.total_length - 1), 3)
+        for offset in (-1, metadata.total_length):
+            with self.assertRaises(IndexError):
+                metadata.file_index(offset)
+
+    def test_file_spans(self):
+        metadata = self.metadata
+        self.assertEqual(metadata.file_spans(0, FILE_LENGTH),
+                         [(0, 0, FILE_LENGTH)])
+        self.assertEqual(metadata.file_spans(FILE_LENGTH - 1, 2),
+                         [(0, FILE_LENGTH - 1, 1), (1, 0, 1)])
+        # The second piece straddles files 1 and 2
+        self.assertEqual(metadata.file_spans(PIECE_LENGTH, PIECE_LENGTH),
+                         [(1, PIECE_LENGTH - FILE_LENGTH,
+                           2 * FILE_LENGTH - PIECE_LENGTH),
+                          (2, 0, 2 * PIECE_LENGTH - 2 * FILE_LENGTH)])
+        self.assertEqual(metadata.file_spans(0, metadata.total_length),
+                         [(index, 0, FILE_LENGTH)
+                          for index in range(FILE_COUNT)])
+
+    def test_zero_length_files(self):
+        info = self.meta_info[b"info"]
+        info[b"files"].insert(1, {b"length": 0, b"path": [b"empty1"]})
+        info[b"files"].append({b"length": 0, b"path": [b"empty2"]})
+        metadata = make_metadata(self.meta_info)
+        self.assertEqual(metadata.file_index(FILE_LENGTH), 2)
+        self.assertEqual(metadata.file_spans(FILE_LENGTH - 1, 2),
+                         [(0, FILE_LENGTH - 1, 1), (2, 0, 1)])
+
+    def test_single_file(self):
+        metadata = make_metadata(make_meta_info(file_count=1))
+        self.assertEqual(len(metadata.files), 1)
+        self.assertEqual(metadata.file_spans(PIECE_LENGTH, 10),
+                         [(0, PIECE_LENGTH, 10)])
+
+    def test_wrong_pieces_length(self):
+        info = self.meta_info[b"info"]
+        info[b"pieces"] = info[b"pieces"][:-1]
+        with self.assertRaises(ValueError):
+            make_metadata(self.meta_info)
+
+    def test_wrong_piece_count(self):
+        info = self.meta_info[b"info"]
+        info[b"pieces"] = info[b"pieces"][:-20]
+        with self.assertRaises(ValueError):
+            make_metadata(self.meta_info)
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.metadata.piece_length = 1
+        with self.assertRaises(AttributeError):
+            del self.metadata.name
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,223 @@
+"""
+The Fast extension of peerwire.Peer, fed through a wiretrace.ReplaySocket.
+
+Run with python -m unittest test_peerwire
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import struct
+import unittest
+
+import bencode
+import download
+import lazybencode
+import loopback
+import metainfo
+import peerwire
+import wiretrace
+
+PIECE_COUNT = 8
+# Two blocks per piece
+PIECE_LENGTH = 2 * metainfo.BLOCK_SIZE
+INFO_HASH = b"\x11" * 20
+
+
+class RecordingSocket(wiretrace.ReplaySocket):
+    """
+    A ReplaySocket that keeps what is sent instead of discarding it.
+    """
+
+    def __init__(self):
+        wiretrace.ReplaySocket.__init__(self)
+        self.sent = bytearray()
+
+    def sendall(self, payload):
+        self.sent.extend(payload)
+
+    def take_sent(self):
+        """
+        :return: (message_id, payload) of the messages sent since the last
+        call
+        """
+        messages = []
+        data = bytes(self.sent)
+        offset = 0
+        while offset < len(data):
+            length = struct.unpack_from(b">I", data, offset)[0]
+            message = data[offset + 4:offset + 4 + length]
+            messages.append((ord(message[0:1]), message[1:]))
+            offset += 4 + length
+        self.sent = bytearray()
+        return messages
+
+
+class FakeDisk(object):
+    def is_congested(self):
+        return False
+
+
+def make_peer(fast=True):
+    """
+    :param fast: If both sides set the Fast extension bit in the handshake
+    :return: (peer, socket) tuple
+    """
+    sock = RecordingSocket()
+    peer = peerwire.Peer("10.0.0.1", 6881, None, sock=sock,
+                         piece_count=PIECE_COUNT)
+    reserved = peerwire.NO_RESERVED
+    if fast:
+        reserved = peerwire.set_fast_bit(reserved)
+    peer.reserved = reserved
+    peer.negotiate_extensions(peerwire.generate_handshake(
+        INFO_HASH, b"-PT0001-000000000000", reserved))
+    return peer, sock
+
+
+def receive(peer, sock, message):
+    """
+    Feeds a message as sent by the remote peer and lets the peer handle it.
+    """
+    sock.feed(message)
+    return peer.receive_message(block=False)
+
+
+def have_all():
+    return peerwire.generate_message(peerwire.HAVE_ALL)
+
+
+def have_none():
+    return peerwire.generate_message(peerwire.HAVE_NONE)
+
+
+class FastExtensionTest(unittest.TestCase):
+    def test_negotiation(self):
+        self.assertTrue(make_peer()[0].fast_extension)
+        self.assertFalse(make_peer(fast=False)[0].fast_extension)
+
+    def test_request_while_choking_is_rejected(self):
+        peer, sock = make_peer()
+        self.assertTrue(peer.am_choking)
+        receive(peer, sock, peerwire.generate_request(3, 0, 2 ** 14))
+        self.assertEqual(sock.take_sent(), [
+            (peerwire.REJECT_REQUEST,
+             peerwire.REQUEST_PAYLOAD.pack(3, 0, 2 ** 14))])
+
+    def test_request_without_fast_extension_is_ignored(self):
+        peer, sock = make_peer(fast=False)
+        receive(peer, sock, peerwire.generate_request(3, 0, 2 ** 14))
+        self.assertEqual(sock.take_sent(), [])
+
+    def test_have_all_and_have_none(self):
+        peer, sock = make_peer()
+        self.assertEqual(receive(peer, sock, have_all()),
+                         (peerwire.HAVE_ALL, b""))
+        self.assertEqual(sorted(peer.bitfield.indexes()),
+                         list(range(PIECE_COUNT)))
+        receive(peer, sock, have_none())
+        self.assertEqual(list(peer.bitfield.indexes()), [])
+
+    def test_have_all_before_piece_count(self):
+        sock = RecordingSocket()
+        peer = peerwire.Peer("10.0.0.1", 6881, None, sock=sock)
+        peer.fast_extension = True
+        receive(peer, sock, have_all())
+        self.assertTrue(peer.has_all)
+        receive(peer, sock, have_none())
+        self.assertFalse(peer.has_all)
+
+    def test_fast_messages_without_the_bit(self):
+        messages = [
+            have_all(),
+            have_none(),
+            peerwire.generate_message(peerwire.SUGGEST_PIECE,
+                                      struct.pack(b">I", 1)),
+            peerwire.generate_allowed_fast(1),
+            peerwire.generate_reject(1, 0, 2 ** 14),
+        ]
+        for message in messages:
+            peer, sock = make_peer(fast=False)
+            with self.assertRaises(peerwire.ProtocolError):
+                receive(peer, sock, message)
+
+    def test_allowed_fast_of_missing_piece(self):
+        peer, sock = make_peer()
+        with self.assertRaises(peerwire.ProtocolError):
+            receive(peer, sock, peerwire.generate_allowed_fast(PIECE_COUNT))
+
+    def test_allowed_fast_set(self):
+        # The example of BEP 6
+        self.assertEqual(
+            peerwire.allowed_fast_set(b"\xaa" * 20, "80.4.4.200", 1313, 7),
+            [1059, 431, 808, 1217, 287, 376, 1188])
+
+
+class FastDownloadTest(unittest.TestCase):
+    def setUp(self):
+        data = loopback.synthetic_data(PIECE_COUNT * PIECE_LENGTH)
+        meta_info = loopback.make_meta_info(data, PIECE_LENGTH, "")
+        self.metadata = metainfo.Metadata(
+            lazybencode.decode_torrent(bencode.encode(meta_info)))
+        self.download = download.Download(self.metadata, FakeDisk())
+        self.peer, self.sock = make_peer()
+        self.download.add_peer(self.peer)
+        self.sock.take_sent()  # Interested
+
+    def sent_requests(self):
+        return [peerwire.REQUEST_PAYLOAD.unpack(payload)
+                for message_id, payload in self.sock.take_sent()
+                if message_id == peerwire.REQUEST]
+
+    def test_availability_of_have_all_and_have_none(self):
+        receive(self.peer, self.sock, have_all())
+        receive(self.peer, self.sock, have_all())
+        self.assertEqual(self.download.availability, [1] * PIECE_COUNT)
+        bitfield = peerwire.Bitfield()
+        bitfield.add_index(2)
+        receive(self.peer, self.sock,
+                peerwire.generate_bitfield(bitfield, PIECE_COUNT))
+        self.assertEqual(self.download.availability,
+                         [0, 0, 1, 0, 0, 0, 0, 0])
+        receive(self.peer, self.sock, have_none())
+        self.assertEqual(self.download.availability, [0] * PIECE_COUNT)
+
+    def test_allowed_fast_while_choked(self):
+        receive(self.peer, self.sock, have_all())
+        self.download.fill_requests(self.peer)
+        self.assertEqual(self.sent_requests(), [])
+
+        receive(self.peer, self.sock, peerwire.generate_allowed_fast(5))
+        self.assertTrue(self.peer.peer_choking)
+        self.download.fill_requests(self.peer)
+        self.assertEqual(self.sent_requests(),
+                         [(5, 0, metainfo.BLOCK_SIZE),
+                          (5, metainfo.BLOCK_SIZE, metainfo.BLOCK_SIZE)])
+
+    def test_reject_while_choked(self):
+        receive(self.peer, self.sock, have_all())
+        receive(self.peer, self.sock, peerwire.generate_allowed_fast(5))
+        self.download.fill_requests(self.peer)
+        self.assertEqual(len(self.sent_requests()), 2)
+
+        receive(self.peer, self.sock,
+                peerwire.generate_reject(5, 0, metainfo.BLOCK_SIZE))
+        # The block is free again but not asked for until we are unchoked
+        self.assertEqual(list(self.download.requests[self.peer]),
+                         [(5, metainfo.BLOCK_SIZE)])
+        self.assertEqual(self.peer.allowed_fast, set())
+        self.download.fill_requests(self.peer)
+        self.assertEqual(self.sent_requests(), [])
+
+        receive(self.peer, self.sock,
+                peerwire.generate_message(peerwire.UNCHOKE))
+        self.download.fill_requests(self.peer)
+        self.assertIn((5, 0, metainfo.BLOCK_SIZE), self.sent_requests())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+Firing, cancelling and rescheduling timers of timers.TimerWheel.
+
+Run with python -m unittest test_timers
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import unittest
+
+import timers
+
+START = 1000.0
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = START
+
+    def time(self):
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = timers.time
+        timers.time = self.clock
+        self.fired = []
+
+    def tearDown(self):
+        timers.time = self.time
+
+    def make_wheel(self, tick=0.5, slot_count=8):
+        return timers.TimerWheel(tick, slot_count, now=self.clock.now)
+
+    def record(self, name):
+        self.fired.append((name, self.clock.now))
+
+    def advance(self, wheel, now):
+        self.clock.now = now
+        return wheel.advance(now)
+
+    def test_deadline_between_ticks(self):
+        wheel = self.make_wheel()
+        wheel.schedule(1.3, self.record, "a")
+        # Rounded up to the tick starting at 1001.5, never fired early
+        self.assertEqual(self.advance(wheel, START + 1.3), 0)
+        self.assertEqual(self.advance(wheel, START + 1.49), 0)
+        self.assertEqual(self.advance(wheel, START + 1.5), 1)
+        self.assertEqual(self.fired, [("a", START + 1.5)])
+        self.assertEqual(len(wheel), 0)
+
+    def test_delay_of_several_revolutions(self):
+        # One revolution takes 4 seconds
+        wheel = self.make_wheel(tick=0.5, slot_count=8)
+        wheel.schedule(10, self.record, "late")
+        wheel.schedule(2, self.record, "early")
+        now = START
+        while now < START + 9.5:
+            now += 0.5
+            self.advance(wheel, now)
+        self.assertEqual(self.fired, [("early", START + 2)])
+
+        self.assertEqual(self.advance(wheel, START + 10), 1)
+        self.assertEqual(self.fired[-1], ("late", START + 10))
+
+    def test_several_revolutions_in_one_advance(self):
+        wheel = self.make_wheel(tick=0.5, slot_count=8)
+        wheel.schedule(10, self.record, "late")
+        self.assertEqual(self.advance(wheel, START + 9.9), 0)
+        self.assertEqual(self.advance(wheel, START + 30), 1)
+
+    def test_cancel(self):
+        wheel = self.make_wheel()
+        timer = wheel.schedule(1, self.record, "cancelled")
+        wheel.schedule(1, self.record, "kept")
+        self.assertEqual(len(wheel), 2)
+        wheel.cancel(timer)
+        wheel.cancel(timer)
+        wheel.cancel(None)
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(self.advance(wheel, START + 5), 1)
+        self.assertEqual(self.fired, [("kept", START + 5)])
+        # Cancelling a timer that fired does nothing
+        wheel.cancel(timer)
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel_from_callback(self):
+        wheel = self.make_wheel()
+        scheduled = []
+
+        def cancel_others():
+            self.record("first")
+            for timer in scheduled:
+                wheel.cancel(timer)
+
+        # Both in the same slot, either may be handled first
+        scheduled.append(wheel.schedule(1, cancel_others))
+        scheduled.append(wheel.schedule(1, cancel_others))
+        self.assertEqual(self.advance(wheel, START + 1), 1)
+        self.assertEqual(len(self.fired), 1)
+        self.assertEqual(len(wheel), 0)
+
+    def test_reschedule_from_callback(self):
+        wheel = self.make_wheel()
+
+        def periodic():
+            self.record("periodic")
+            wheel.schedule(1, periodic)
+
+        wheel.schedule(1, periodic)
+        for second in range(1, 4):
+            self.advance(wheel, START + second)
+        self.assertEqual(self.fired, [("periodic", START + second)
+                                      for second in range(1, 4)])
+        self.assertEqual(len(wheel), 1)
+
+        # A late advance fires the timer once, the new one is due a second
+        # after the callback
+        self.assertEqual(self.advance(wheel, START + 20), 1)
+        self.assertEqual(self.advance(wheel, START + 20.5), 0)
+        self.assertEqual(self.advance(wheel, START + 21), 1)
+
+    def test_zero_delay_from_callback_fires_next_tick(self):
+        wheel = self.make_wheel()
+
+        def again():
+            self.record("again")
+            if len(self.fired) < 2:
+                wheel.schedule(0, again)
+
+        wheel.schedule(0, again)
+        self.assertEqual(self.advance(wheel, START + 0.5), 1)
+        self.assertEqual(self.advance(wheel, START + 1), 1)
+        self.assertEqual(self.fired, [("again", START + 0.5),
+                                      ("again", START + 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+File priorities of a Torrent downloading from a loopback swarm.
+
+Run with python -m unittest test_torrent
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import os
+import sys
+import time
+import unittest
+
+import benchmark
+import download
+import loopback
+import torrent
+
+if sys.version_info.major == 2:
+    from urllib import quote
+elif sys.version_info.major == 3:
+    from urllib.parse import quote
+
+PIECE_LENGTH = 2 ** 14
+FILE_LENGTH = 30000
+FILE_COUNT = 4
+
+NORMAL = download.PRIORITY_NORMAL
+SKIP = download.PRIORITY_SKIP
+
+
+class FilePrioritiesTest(unittest.TestCase):
+    def setUp(self):
+        self.swarm = loopback.LoopbackSwarm(
+            FILE_LENGTH * FILE_COUNT, PIECE_LENGTH, file_count=FILE_COUNT)
+        self.swarm.start()
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            with benchmark._quiet():
+                self.client.stop()
+        self.swarm.stop()
+
+    def run_until_complete(self, timeout=30):
+        deadline = time.time() + timeout
+        with benchmark._quiet():
+            while not self.client.is_complete():
+                self.assertLess(time.time(), deadline)
+                self.client.step()
+            self.client.poll()  # Moves the last pieces into the bitfield
+
+    def read_file(self, index):
+        path = os.path.join(self.swarm.download_dir, "synthetic",
+                            "file{:04d}.bin".format(index))
+        with open(path, "rb") as f:
+            return f.read()
+
+    def file_data(self, index):
+        return self.swarm.data[index * FILE_LENGTH:(index + 1) * FILE_LENGTH]
+
+    def assert_bitfield_matches_download(self):
+        have = self.client.download.have
+        self.assertEqual(sorted(self.client.bitfield.indexes()),
+                         [index for index in range(len(have)) if have[index]])
+
+    def test_unskipped_file_is_downloaded(self):
+        self.client = torrent.Torrent(self.swarm.torrent_path,
+                                      self.swarm.download_dir)
+        self.client.set_file_priorities([NORMAL, SKIP, NORMAL, NORMAL])
+        with benchmark._quiet():
+            self.client.start()
+        self.run_until_complete()
+        self.assertEqual(self.client.download.left, 0)
+        self.assertFalse(self.client.download.have[2])
+
+        self.client.set_file_priorities([NORMAL] * FILE_COUNT)
+        # Pieces 1 and 3 straddle the file and are downloaded again
+        self.assertEqual(self.client.download.left, 3 * PIECE_LENGTH)
+        self.assert_bitfield_matches_download()
+
+        self.run_until_complete()
+        self.assert_bitfield_matches_download()
+        for index in range(FILE_COUNT):
+            self.assertEqual(self.read_file(index), self.file_data(index))
+
+    def test_priorities_before_metadata(self):
+        link = "{}&tr={}".format(self.swarm.magnet_link,
+                                 quote(self.swarm.tracker.announce_url,
+                                       safe=b""))
+        self.client = torrent.Torrent(link, self.swarm.download_dir)
+        with self.assertRaises(ValueError):
+            self.client.open_stream(2 ** 20)
+        self.client.set_file_priorities([SKIP, NORMAL, NORMAL, SKIP])
+        with benchmark._quiet():
+            self.client.start()
+        self.run_until_complete()
+
+        self.assertEqual(self.client.download.file_priorities,
+                         [SKIP, NORMAL, NORMAL, SKIP])
+        self.assertEqual(self.client.download.have,
+                         [False, True, True, True, True, True, False, False])
+        self.assertEqual(self.read_file(1), self.file_data(1))
+        self.assertEqual(self.read_file(2), self.file_data(2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,218 @@
+"""
+The HTTP client of the tracker module against a tracker on localhost, and
+decoding the peers of tracker responses.
+
+Run with python -m unittest test_tracker
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import socket
+import struct
+import unittest
+
+import bencode
+import lazybencode
+import loopback
+import tracker
+
+PEERS = [("10.0.0.1", 6881), ("10.0.0.2", 6882)]
+INFO_HASH = b"\x11" * 20
+PEER_ID = b"-PT0001-000000000000"
+# Nothing listens on port 1 of localhost
+DEAD_TRACKER = "http://127.0.0.1:1/announce"
+
+
+class RedirectHandler(loopback.TrackerStubHandler):
+    """
+    Redirects requests for /moved to /announce with the same query.
+    """
+
+    def do_GET(self):
+        if not self.path.startswith("/moved"):
+            loopback.TrackerStubHandler.do_GET(self)
+            return
+        self.server.redirects += 1
+        self.send_response(302)
+        self.send_header("Location", "/announce" + self.path[len("/moved"):])
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class RedirectLoopHandler(loopback.TrackerStubHandler):
+    """
+    Redirects every request to itself.
+    """
+
+    def do_GET(self):
+        self.server.redirects += 1
+        self.send_response(301)
+        self.send_header("Location", self.path)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class BadGzipHandler(loopback.TrackerStubHandler):
+    """
+    Claims the response is gzipped while it is not.
+    """
+
+    def do_GET(self):
+        response = b"not gzip"
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class HTTPClientTest(unittest.TestCase):
+    def setUp(self):
+        self.trackers = []
+        self.client = tracker.HTTPClient()
+
+    def tearDown(self):
+        self.client.close()
+        for stub in self.trackers:
+            stub.stop()
+
+    def start_tracker(self, handler=loopback.TrackerStubHandler):
+        stub = loopback.TrackerStub(PEERS)
+        stub.RequestHandlerClass = handler
+        stub.redirects = 0
+        stub.start()
+        self.trackers.append(stub)
+        return stub
+
+    def assert_peers(self, response):
+        self.assertEqual(
+            sorted((peer.ip, peer.port)
+                   for peer in tracker.extract_peers(
+                       lazybencode.decode(response))),
+            PEERS)
+
+    def test_keep_alive_connection_is_reused(self):
+        stub = self.start_tracker()
+        for _ in range(3):
+            self.assert_peers(self.client.get(stub.announce_url))
+        self.assertEqual(stub.announces, 3)
+        self.assertEqual(stub.connections, 1)
+        self.assertEqual(self.client.connections_opened, 1)
+        self.assertEqual(self.client.requests, 3)
+        self.assertEqual(self.client.dns_lookups, 1)
+
+    def test_gzip_response(self):
+        # The stub gzips as the client accepts it
+        stub = self.start_tracker()
+        self.assert_peers(self.client.get(stub.announce_url))
+
+    def test_bad_gzip_response(self):
+        stub = self.start_tracker(BadGzipHandler)
+        with self.assertRaises(tracker.TrackerError):
+            self.client.get(stub.announce_url)
+
+    def test_redirect(self):
+        stub = self.start_tracker(RedirectHandler)
+        url = stub.announce_url.replace("/announce", "/moved")
+        self.assert_peers(self.client.get(url + "?numwant=5"))
+        self.assertEqual(stub.redirects, 1)
+        self.assertEqual(stub.announces, 1)
+        # The redirect was followed over the same connection
+        self.assertEqual(stub.connections, 1)
+
+    def test_redirect_loop(self):
+        stub = self.start_tracker(RedirectLoopHandler)
+        with self.assertRaises(tracker.TrackerError):
+            self.client.get(stub.announce_url)
+        self.assertEqual(stub.redirects, tracker.MAX_REDIRECTS + 1)
+
+    def test_connection_refused(self):
+        with self.assertRaises(tracker.TrackerError):
+            self.client.get(DEAD_TRACKER)
+
+
+class GetPeersTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = loopback.TrackerStub(PEERS)
+        self.stub.start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def get_peers(self, announce_urls):
+        meta_info = {"announce": announce_urls[0],
+                     "announce-list": [[url] for url in announce_urls]}
+        return tracker.get_peers(meta_info, PEER_ID, INFO_HASH, port=6881)
+
+    def test_one_failing_tracker(self):
+        peers = self.get_peers([DEAD_TRACKER, self.stub.announce_url,
+                                "udp://127.0.0.1:1/announce"])
+        self.assertEqual(sorted((peer.ip, peer.port) for peer in peers),
+                         PEERS)
+        self.assertEqual(self.stub.announces, 1)
+
+    def test_every_tracker_failing(self):
+        with self.assertRaises(tracker.TrackerError):
+            self.get_peers([DEAD_TRACKER, DEAD_TRACKER])
+
+
+class CompactPeersTest(unittest.TestCase):
+    def test_ipv4(self):
+        peers = b"".join(tracker.COMPACT_PEER.pack(socket.inet_aton(ip), port)
+                         for ip, port in PEERS)
+        self.assertEqual(tracker.binary_peer_extract(peers),
+                         [tracker.PeerAddress(ip, port) for ip, port in PEERS])
+        self.assertEqual(tracker.binary_peer_extract(b""), [])
+
+    def test_ipv6(self):
+        peers6 = (socket.inet_pton(socket.AF_INET6, "2001:db8::1") +
+                  struct.pack(b">H", 6881) +
+                  socket.inet_pton(socket.AF_INET6, "::ffff:10.0.0.1") +
+                  struct.pack(b">H", 65535))
+        self.assertEqual(
+            [(peer.ip, peer.port)
+             for peer in tracker.binary_peer6_extract(peers6)],
+            [("2001:db8::1", 6881), ("::ffff:10.0.0.1", 65535)])
+
+    def test_truncated(self):
+        # Trailing bytes that do not make up a whole peer are ignored
+        peers = tracker.COMPACT_PEER.pack(socket.inet_aton("10.0.0.1"), 1)
+        self.assertEqual(len(tracker.binary_peer_extract(peers + b"\x0a")),
+                         1)
+        peers6 = socket.inet_pton(socket.AF_INET6, "::1") + b"\x00\x01"
+        self.assertEqual(tracker.binary_peer6_extract(peers6 + peers6[:17]),
+                         [tracker.PeerAddress("::1", 1)])
+        self.assertEqual(tracker.binary_peer6_extract(peers6[:17]), [])
+
+    def test_extract_peers(self):
+        response = lazybencode.decode(bencode.encode({
+            b"interval": 1800,
+            b"peers": tracker.COMPACT_PEER.pack(
+                socket.inet_aton("10.0.0.1"), 6881),
+            b"peers6": (socket.inet_pton(socket.AF_INET6, "::1") +
+                        struct.pack(b">H", 6882)),
+        }))
+        self.assertEqual(sorted((peer.ip, peer.port)
+                                for peer in tracker.extract_peers(response)),
+                         [("10.0.0.1", 6881), ("::1", 6882)])
+
+    def test_extract_dict_peers(self):
+        # The same address twice is only returned once
+        response = lazybencode.decode(bencode.encode({
+            b"interval": 1800,
+            b"peers": [
+                {b"ip": b"10.0.0.1", b"port": 6881, b"peer id": b"a" * 20},
+                {b"ip": b"10.0.0.1", b"port": 6881, b"peer id": b"b" * 20},
+            ],
+        }))
+        self.assertEqual(list(tracker.extract_peers(response)),
+                         [tracker.PeerAddress("10.0.0.1", 6881)])
+
+
+if __name__ == "__main__":
+    unittest.main()
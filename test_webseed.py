@@ -0,0 +1,149 @@
+"""
+Web seeds against a HTTP server on localhost.
+
+Run with python -m unittest test_webseed
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import time
+import unittest
+
+import bencode
+import lazybencode
+import loopback
+import metainfo
+import webseed
+
+PIECE_LENGTH = 2 ** 14
+# Not a multiple of the piece length, so pieces straddle the files
+SIZE = 10 * PIECE_LENGTH + 1000
+FILE_COUNT = 3
+
+
+class IgnoreRangeHandler(loopback.WebSeedHandler):
+    """
+    Answers every request with the whole file and 200 OK.
+    """
+
+    def do_GET(self):
+        del self.headers["Range"]
+        loopback.WebSeedHandler.do_GET(self)
+
+
+class ShortBodyHandler(loopback.WebSeedHandler):
+    """
+    Answers with one byte less than was asked for.
+    """
+
+    def do_GET(self):
+        offset, length = self.server.files[self.path]
+        self.send_response(206)
+        self.send_header("Content-Length", str(length - 1))
+        self.end_headers()
+        self.wfile.write(self.server.data[offset:offset + length - 1])
+
+
+class ClosingHandler(loopback.WebSeedHandler):
+    """
+    Closes every connection after one response without announcing it, as a
+    server whose keep-alive timeout passed does.
+    """
+
+    def do_GET(self):
+        loopback.WebSeedHandler.do_GET(self)
+        self.close_connection = True
+
+
+class WebSeedTest(unittest.TestCase):
+    def setUp(self):
+        self.data = loopback.synthetic_data(SIZE)
+        meta_info = loopback.make_meta_info(
+            self.data, PIECE_LENGTH, "http://127.0.0.1:1/announce",
+            file_count=FILE_COUNT)
+        self.metadata = metainfo.Metadata(
+            lazybencode.decode_torrent(bencode.encode(meta_info)))
+        self.server = loopback.WebSeedServer(self.data, meta_info)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def start_server(self, handler=loopback.WebSeedHandler):
+        self.server.RequestHandlerClass = handler
+        self.server.start()
+        return webseed.WebSeed(self.server.url, self.metadata)
+
+    def piece_data(self, indexes):
+        return self.data[indexes[0] * PIECE_LENGTH:
+                         (indexes[-1] + 1) * PIECE_LENGTH]
+
+    def test_run_spanning_files(self):
+        seed = self.start_server()
+        indexes = list(range(self.metadata.piece_count))
+        spans = self.metadata.file_spans(0, SIZE)
+        self.assertEqual([index for index, _, _ in spans],
+                         list(range(FILE_COUNT)))
+
+        connections = {}
+        self.assertEqual(seed.fetch_run(indexes, connections), self.data)
+        self.assertEqual(self.server.requests, FILE_COUNT)
+        # Every file was fetched over the same keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+
+    def test_last_piece(self):
+        seed = self.start_server()
+        last = self.metadata.piece_count - 1
+        self.assertEqual(seed.fetch_run([last], {}), self.piece_data([last]))
+
+    def test_ignored_range(self):
+        seed = self.start_server(IgnoreRangeHandler)
+        indexes = [3, 4, 5, 6]
+        self.assertEqual(seed.fetch_run(indexes, {}),
+                         self.piece_data(indexes))
+
+    def test_short_body(self):
+        seed = self.start_server(ShortBodyHandler)
+        with self.assertRaises(webseed.WebSeedError):
+            seed.get_range(seed.file_urls[0], 0, 100, {})
+
+    def test_missing_file(self):
+        seed = self.start_server()
+        with self.assertRaises(webseed.WebSeedError):
+            seed.get_range(self.server.url + "missing", 0, 100, {})
+
+    def test_closed_connection_is_reopened(self):
+        seed = self.start_server(ClosingHandler)
+        connections = {}
+        self.assertEqual(seed.fetch_run([0], connections),
+                         self.piece_data([0]))
+        self.assertEqual(seed.fetch_run([1], connections),
+                         self.piece_data([1]))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_replies_through_queue(self):
+        seed = self.start_server()
+        seed.fetch([0, 1])
+        seed.fetch([2])
+        replies = []
+        deadline = time.time() + 10
+        while len(replies) < 2 and time.time() < deadline:
+            reply = seed.get_reply()
+            if reply is None:
+                time.sleep(0.01)
+            else:
+                replies.append(reply)
+        seed.close()
+        self.assertEqual(sorted((indexes, data, error)
+                                for indexes, data, error in replies),
+                         [([0, 1], self.piece_data([0, 1]), None),
+                          ([2], self.piece_data([2]), None)])
+        self.assertEqual(seed.in_flight, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
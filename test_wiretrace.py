@@ -0,0 +1,71 @@
+"""
+Round trip of a recorded peer wire trace through read_trace and replay.
+
+Run with python -m unittest test_wiretrace
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+import loopback
+import torrent
+import wiretrace
+
+
+class WireTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="pytorrent-test-")
+        self.trace_path = os.path.join(self.directory, "trace.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_records_read_back(self):
+        recorder = wiretrace.TraceRecorder(self.trace_path)
+        # Connection ids past what fits in 2 bytes must survive
+        recorder.connection_count = 2 ** 16 + 1
+        connection = recorder.connection("127.0.0.1:6881")
+        connection.record_handshake(b"\x13BitTorrent protocol")
+        connection.record_message(b"\x00\x00\x00\x01\x02")
+        recorder.close()
+
+        records = list(wiretrace.read_trace(self.trace_path))
+        self.assertEqual([(record.connection, record.kind, record.data)
+                          for record in records],
+                         [(2 ** 16 + 1, wiretrace.OPEN, b"127.0.0.1:6881"),
+                          (2 ** 16 + 1, wiretrace.HANDSHAKE,
+                           b"\x13BitTorrent protocol"),
+                          (2 ** 16 + 1, wiretrace.MESSAGE,
+                           b"\x00\x00\x00\x01\x02")])
+
+    def test_replay_completes_recorded_download(self):
+        torrent_path = os.path.join(self.directory, "swarm.torrent")
+        with loopback.LoopbackSwarm(2 ** 20, 2 ** 16, 2) as swarm:
+            client = torrent.Torrent(swarm.torrent_path, swarm.download_dir)
+            client.recorder = wiretrace.TraceRecorder(self.trace_path)
+            with benchmark._quiet():
+                client.start()
+                while not client.is_complete():
+                    client.step()
+                client.stop()
+            shutil.copy(swarm.torrent_path, torrent_path)
+            piece_count = client.metadata.piece_count
+
+        with benchmark._quiet():
+            result = wiretrace.replay(self.trace_path, torrent_path)
+        self.assertEqual(result['pieces'], piece_count)
+        self.assertGreater(result['messages'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
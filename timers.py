@@ -0,0 +1,134 @@
+"""
+Hashed timer wheel.
+
+Timers are put in one of a fixed number of slots depending on when they expire,
+so scheduling and cancelling a timer are O(1) no matter how many timers exist.
+Advancing the wheel only looks at the slots of the ticks that have passed.
+Timers further in the future than one revolution of the wheel keep a count of
+the revolutions left before they fire.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import math
+import sys
+import time
+
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+
+
+class Timer(object):
+    """
+    A scheduled callback. Returned by TimerWheel.schedule and used to cancel
+    the timer.
+    """
+
+    __slots__ = ("deadline", "callback", "args", "rounds", "slot")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.rounds = 0
+        self.slot = None
+
+    def __repr__(self):
+        return "<Timer at {:.2f} {}>".format(self.deadline, self.callback)
+
+
+class TimerWheel(object):
+    def __init__(self, tick=0.5, slot_count=512, now=None):
+        """
+        :param tick: Resolution of the wheel in seconds. Timers fire at most
+        one tick late.
+        :param slot_count: Number of slots. One revolution of the wheel takes
+        tick * slot_count seconds.
+        :param now: Current time, time.time() if None
+        """
+        if now is None:
+            now = time.time()
+        self.tick = tick
+        self.slots = [set() for _ in range(slot_count)]
+        self.current_tick = int(now / tick)  # Last tick that has been handled
+        self.count = 0  # Number of scheduled timers
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """
+        Schedules callback(*args) to be called after delay seconds.
+
+        :param delay: Seconds from now
+        :param callback: The function to call
+        :return: Timer that can be cancelled
+        """
+        deadline = time.time() + delay
+        timer = Timer(deadline, callback, args)
+
+        # Rounded up, as a tick is handled once the time passes its start and
+        # the timer must not fire before its deadline
+        target_tick = max(int(math.ceil(deadline / self.tick)),
+                          self.current_tick + 1)
+        ticks = target_tick - self.current_tick
+        timer.rounds = (ticks - 1) // len(self.slots)
+        timer.slot = target_tick % len(self.slots)
+        self.slots[timer.slot].add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancels a timer. Cancelling a timer that has fired or already been
+        cancelled does nothing.
+        """
+        if timer is None or timer.slot is None:
+            return
+        slot = self.slots[timer.slot]
+        if timer in slot:
+            slot.remove(timer)
+            self.count -= 1
+        timer.slot = None
+
+    def advance(self, now=None):
+        """
+        Fires every timer that has expired since the last call.
+
+        :param now: Current time, time.time() if None
+        :return: Number of timers fired
+        """
+        if now is None:
+            now = time.time()
+        target_tick = int(now / self.tick)
+        fired = 0
+
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+            slot = self.slots[self.current_tick % len(self.slots)]
+            if not slot:
+                continue
+
+            for timer in list(slot):
+                if timer.slot is None:
+                    continue  # Cancelled by an earlier callback
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                    continue
+                slot.remove(timer)
+                self.count -= 1
+                timer.slot = None
+                timer.callback(*timer.args)
+                fired += 1
+
+        return fired
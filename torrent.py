@@ -4,14 +4,29 @@ from __future__ import (
     print_function,
     unicode_literals
 )
+import binascii
+import os
 import random
+import socket
 import string
 import sys
 import time
 
-import bencode
+import diskio
+import download
+import extension
+import lazybencode
+import magnet
+import metainfo
+import metrics
+import peerstore
 import peerwire
+import socketthread
+import storage
+import streaming
+import timers
 import tracker
+import webseed
 
 
 if sys.version_info.major == 2:
@@ -46,57 +61,670 @@ def generate_peer_id():
 
 PEER_ID = generate_peer_id()
 
+# Maximum number of peers we keep a connection to at the same time
+MAX_CONNECTIONS = 50
+# Maximum number of messages handled from one peer before moving on to the
+# next, so a fast peer can not starve the others.
+MAX_MESSAGES_PER_STEP = 64
+# Seconds to sleep when a step of the main loop had nothing to do
+IDLE_SLEEP = 0.01
+# Seconds without sending anything after which a keep-alive is sent
+KEEP_ALIVE_INTERVAL = 90
+# Seconds without receiving anything after which a connection is closed. Peers
+# send keep-alives about every two minutes.
+IDLE_TIMEOUT = 180
+# Seconds between DHT lookups for more peers, which also renew our announce,
+# and before a lookup that reached no nodes is retried, such as one made while
+# the DHT node is still bootstrapping
+DHT_INTERVAL = 15 * 60
+DHT_RETRY = 5
+# Seconds before the trackers are asked again when every one of them failed
+ANNOUNCE_RETRY = 60
+
 
 class Torrent(object):
-    def __init__(self, path_to_torrent):
-        with open(path_to_torrent, "rb") as f:
-            file_content = bytes(f.read())
-            self.meta_info = bencode.decode(file_content)
-
-        self.handshake = peerwire.generate_handshake(
-            tracker.calc_info_hash(self.meta_info), PEER_ID)
-        self.peers = []
+    def __init__(self, path_to_torrent, download_dir=".", rate_limiter=None,
+                 dht=None, port=None, cache_dir=None):
+        """
+        :param path_to_torrent: Path of the .torrent file or a magnet link
+        :param download_dir: Directory the files are downloaded to
+        :param rate_limiter: Limits the download rate, see download.Download
+        :param dht: dht.DHTNode to find peers through as well as the
+        trackers, or None. The node is polled by the torrent.
+        :param port: Port we accept peer connections on, announced to the
+        trackers and the DHT
+        :param cache_dir: Directory the metadata of a magnet link is cached
+        in as a .torrent file named after the info hash, download_dir if None
+        """
+        self.download_dir = download_dir
+        self.rate_limiter = rate_limiter
+        self.cache_path = None  # Where the metadata of a magnet link goes
+        file_content = None
+        if magnet.is_magnet_link(path_to_torrent):
+            link = magnet.parse_magnet(path_to_torrent)
+            self.info_hash = link.info_hash
+            self.cache_path = magnet.cache_path(cache_dir or download_dir,
+                                                link.info_hash)
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, "rb") as f:
+                    file_content = f.read()
+            else:
+                self.meta_info = {}
+                if link.trackers:
+                    self.meta_info['announce-list'] = [
+                        [url] for url in link.trackers]
+        else:
+            link = None
+            with open(path_to_torrent, "rb") as f:
+                file_content = f.read()
+
+        # Everything that needs the info dict is None until the metadata of a
+        # magnet link has been downloaded
+        self.metadata = None
+        self.storage = None
+        self.disk = None
+        self.download = None
+        self.web_seeds = []
+        raw_info = None
+        if file_content is not None:
+            # Decoding lazily keeps the large 'pieces' string and 'files' list
+            # in the original buffer and records the raw span of the info
+            # dict.
+            self.meta_info = lazybencode.decode_torrent(file_content)
+            self.metadata = metainfo.Metadata(self.meta_info)
+            self.info_hash = self.metadata.info_hash
+            raw_info = self.meta_info.raw_info
+            if link is not None and self.info_hash != link.info_hash:
+                raise ValueError("{} is not the torrent of {}".format(
+                    self.cache_path, path_to_torrent))
+
+        # Signal support for the extension protocol (BEP 10) and the Fast
+        # extension (BEP 6)
+        reserved = peerwire.set_fast_bit(
+            extension.set_reserved_bit(peerwire.NO_RESERVED))
+        self.handshake = peerwire.generate_handshake(self.info_hash,
+                                                     PEER_ID, reserved)
+        # Every peer we know of, most of which we are not connected to
+        self.known_peers = peerstore.PeerStore()
+        if link is not None:
+            self.known_peers.add_all(link.peers)
+        # The KnownPeers we are connected to mapped to their peerwire.Peer
+        self.connections = {}
         self.bitfield = peerwire.Bitfield()
 
+        # Label of the torrent in metrics
+        if self.metadata is not None:
+            self.label = storage.Storage.decode_path(self.metadata.name)
+        elif link.name:
+            self.label = link.name
+        else:
+            self.label = binascii.hexlify(self.info_hash).decode("ascii")
+
+        # Keep-alives, idle connections and request timeouts
+        self.timer_wheel = timers.TimerWheel()
+        # File priorities set before the metadata of a magnet link is known
+        self.file_priorities = None
+
+        # Downloads the info dict of a magnet link and serves it to peers
+        self.metadata_exchange = magnet.MetadataExchange(
+            self.info_hash, raw_info, self.label)
+
+        self.web_seed_bytes = metrics.REGISTRY.counter(
+            "torrent_web_seed_bytes", "Bytes received from web seeds",
+            torrent=self.label)
+        if self.metadata is not None:
+            self.setup_download()
+
+        self.dht = dht
+        self.port = port
+
+        # wiretrace.TraceRecorder recording every connection, if any
+        self.recorder = None
+
+        metrics.REGISTRY.gauge("torrent_connections", "Open peer connections",
+                               function=lambda: len(self.connections),
+                               torrent=self.label)
+        metrics.REGISTRY.gauge("torrent_known_peers",
+                               "Peers we know the address of",
+                               function=lambda: len(self.known_peers),
+                               torrent=self.label)
+        self.idle_evictions = metrics.REGISTRY.counter(
+            "torrent_idle_evictions",
+            "Connections closed because nothing was received for "
+            "IDLE_TIMEOUT seconds", torrent=self.label)
+
+    def setup_download(self):
+        """
+        Creates the storage, download and web seeds of the torrent once its
+        metadata is known.
+        """
+        self.storage = storage.Storage(self.metadata, self.download_dir)
+        self.disk = diskio.DiskIO(self.storage, self.label)
+        self.download = download.Download(self.metadata, self.disk,
+                                          self.label, self.timer_wheel,
+                                          self.rate_limiter)
+
+        # HTTP mirrors from url-list, used as peers that have every piece
+        self.web_seeds = [webseed.WebSeed(url, self.metadata)
+                          for url in webseed.get_url_list(self.meta_info)]
+
+    def complete_metadata(self):
+        """
+        Called once the info dict of a magnet link has been downloaded and
+        verified. Caches it, allocates the files and starts downloading
+        pieces from the peers we are already connected to.
+        """
+        trackers = tracker.get_announce_urls(self.meta_info)
+        file_content = magnet.encode_torrent(
+            self.metadata_exchange.raw_info, trackers)
+        try:
+            magnet.save_torrent(self.cache_path, file_content)
+        except EnvironmentError as e:
+            print("Could not cache the metadata in {}: {}".format(
+                self.cache_path, e))
+
+        self.meta_info = lazybencode.decode_torrent(file_content)
+        self.metadata = metainfo.Metadata(self.meta_info)
+        print("Got the metadata of {}".format(self.label))
+        self.setup_download()
+        if self.file_priorities is not None:
+            try:
+                self.set_file_priorities(self.file_priorities)
+            except ValueError as e:
+                print("Ignoring the file priorities of {}: {}".format(
+                    self.label, e))
+            self.file_priorities = None
+        self.disk.allocate(self.download.wanted_files())
+
+        for known_peer, peer in list(self.connections.items()):
+            if not peer.has_shook_hands:
+                continue
+            try:
+                peer.set_piece_count(self.metadata.piece_count)
+                self.download.add_peer(peer)
+            except (peerwire.ProtocolError, socket.error) as error:
+                print(error)
+                self.drop_peer(known_peer, failed=True)
+
     def get_peers(self):
-        peers = tracker.get_peers(self.meta_info, PEER_ID)
-        peers = [peerwire.Peer(peer['ip'], peer['port'], peer['peer_id'])
-                 for peer in peers]
+        params = {}
+        if self.port is not None:
+            params["port"] = self.port
+        if self.download is not None:
+            params["downloaded"] = self.download.downloaded
+            params["left"] = self.download.left
+        addresses = tracker.get_peers(self.meta_info, PEER_ID,
+                                      self.info_hash, **params)
+        self.known_peers.add_all(addresses, peerstore.SOURCE_TRACKER)
 
-        # Maybe check for duplicates?
-        self.peers.extend(peers)
+    def announce(self):
+        """
+        Gets peers from the trackers. If every tracker fails the torrent
+        carries on with the DHT and the peers it knows, and the trackers are
+        asked again after ANNOUNCE_RETRY seconds.
+        """
+        try:
+            self.get_peers()
+        except Exception as e:
+            print("Announce of {} failed: {}".format(self.label, e))
+            self.timer_wheel.schedule(ANNOUNCE_RETRY, self.announce)
 
-    def serve_forever(self):
-        self.get_peers()  # We need some peers to talk to
+    def lookup_dht(self):
+        """
+        Looks up peers in the DHT, and announces us if we have a port, every
+        DHT_INTERVAL seconds. Peers are added to known_peers as they are
+        found.
+        """
+        self.dht.get_peers(self.info_hash, self._on_dht_peers,
+                           self.port, self._on_dht_done)
 
-        for peer in self.peers:
+    def _on_dht_peers(self, addresses):
+        self.known_peers.add_all(addresses, peerstore.SOURCE_DHT)
+
+    def _on_dht_done(self, nodes):
+        self.timer_wheel.schedule(DHT_INTERVAL if nodes else DHT_RETRY,
+                                  self.lookup_dht)
+
+    def connect_peers(self):
+        """
+        Opens connections to the best known peers until MAX_CONNECTIONS peers
+        are connected. The heavy peerwire.Peer objects are only created here.
+        """
+        free_slots = MAX_CONNECTIONS - len(self.connections)
+        for known_peer in self.known_peers.candidates(free_slots):
+            peer = peerwire.Peer(known_peer.ip, known_peer.port,
+                                 known_peer.peer_id, self.label,
+                                 piece_count=self.piece_count())
+            if self.recorder is not None:
+                peer.recorder = self.recorder.connection(peer.label)
             print("Connecting to: {}".format(peer))
             peer.connect()
+            self.known_peers.mark_connected(known_peer)
+            self.connections[known_peer] = peer
+
+    def add_incoming(self, sock, address, handshake):
+        """
+        Takes over a connection a peer opened to us whose handshake has
+        already been received, and answers the handshake.
+
+        :param sock: The connected socket
+        :param address: (ip, port) tuple of the peer
+        :param handshake: The handshake received from the peer
+        :return: True if the connection was accepted
+        """
+        ip, port = address
+        known_peer = self.known_peers.add(tracker.PeerAddress(ip, port),
+                                          peerstore.SOURCE_INCOMING)
+        if (known_peer.connected or
+                len(self.connections) >= MAX_CONNECTIONS):
+            sock.close()
+            return False
+
+        peer = peerwire.Peer(ip, port, None, self.label,
+                             socketthread.SocketThread(sock),
+                             self.piece_count())
+        if self.recorder is not None:
+            peer.recorder = self.recorder.connection(peer.label)
+        self.known_peers.mark_connected(known_peer)
+        self.connections[known_peer] = peer
+
+        try:
+            peer.accept_handshake(handshake, self.handshake)
+            print("Accepted connection from {}".format(peer))
+            self.start_timers(known_peer, peer)
+            self.send_pieces(peer)
+            self.start_extensions(peer)
+            if self.download is not None:
+                self.download.add_peer(peer)
+        except (peerwire.HandshakeException, socket.error) as error:
+            print(error)
+            self.drop_peer(known_peer, failed=True)
+            return False
+        return True
+
+    def drop_peer(self, known_peer, failed=False):
+        """
+        Closes the connection to a peer. The peer is still remembered in
+        known_peers and may be connected to again later.
+
+        :param known_peer: The KnownPeer of the connection
+        :param failed: True if the connection failed or misbehaved
+        """
+        peer = self.connections.pop(known_peer)
+        self.timer_wheel.cancel(peer.keep_alive_timer)
+        self.timer_wheel.cancel(peer.idle_timer)
+        self.metadata_exchange.remove_peer(peer)
+        if self.download is not None:
+            self.download.remove_peer(peer)
+        peer.disconnect()
+        self.known_peers.mark_disconnected(known_peer, failed)
+
+    def start_timers(self, known_peer, peer):
+        """
+        Schedules the keep-alive and idle checks of a peer that just shook
+        hands. Sending or receiving a message only updates a timestamp, the
+        checks reschedule themselves for when the peer could next be due.
+        """
+        peer.keep_alive_timer = self.timer_wheel.schedule(
+            KEEP_ALIVE_INTERVAL, self._check_keep_alive, known_peer, peer)
+        peer.idle_timer = self.timer_wheel.schedule(
+            IDLE_TIMEOUT, self._check_idle, known_peer, peer)
+
+    def _check_keep_alive(self, known_peer, peer):
+        if self.connections.get(known_peer) is not peer:
+            return
+        quiet = time.time() - peer.last_sent
+        if quiet >= KEEP_ALIVE_INTERVAL:
+            try:
+                peer.send_keep_alive()
+            except socket.error:
+                pass  # The peer is dropped when its receive fails
+            quiet = 0
+        peer.keep_alive_timer = self.timer_wheel.schedule(
+            KEEP_ALIVE_INTERVAL - quiet, self._check_keep_alive, known_peer,
+            peer)
+
+    def _check_idle(self, known_peer, peer):
+        if self.connections.get(known_peer) is not peer:
+            return
+        idle = time.time() - peer.last_received
+        if idle >= IDLE_TIMEOUT:
+            print("Dropping idle peer {}".format(peer))
+            self.idle_evictions.inc()
+            self.drop_peer(known_peer, failed=True)
+            return
+        peer.idle_timer = self.timer_wheel.schedule(
+            IDLE_TIMEOUT - idle, self._check_idle, known_peer, peer)
+
+    def send_pieces(self, peer):
+        """
+        Tells a peer that just shook hands which pieces we have. With the Fast
+        extension having all or no pieces is sent without a bitfield, without
+        it nothing is sent while we have no pieces, such as while the
+        metadata of a magnet link is downloaded.
+        """
+        if self.download is None:
+            if peer.fast_extension:
+                peer.send_message(peerwire.generate_message(
+                    peerwire.HAVE_NONE))
+            return
+        have_count = self.download.have_count
+        piece_count = self.metadata.piece_count
+        if peer.fast_extension and have_count == piece_count:
+            peer.send_message(peerwire.generate_message(peerwire.HAVE_ALL))
+        elif peer.fast_extension and not have_count:
+            peer.send_message(peerwire.generate_message(peerwire.HAVE_NONE))
+        elif have_count:
+            peer.send_message(peerwire.generate_bitfield(self.bitfield,
+                                                         piece_count))
+
+    def start_extensions(self, peer):
+        """
+        Sends the extended handshake to a peer that just shook hands, if it
+        supports the extension protocol, and handles its ut_metadata messages.
+        """
+        if peer.supports_extensions():
+            peer.register_extended_handler(
+                extension.LOCAL_EXTENSIONS[b"ut_metadata"],
+                self.metadata_exchange.on_message)
+            metadata_size = None
+            if self.metadata_exchange.is_complete():
+                metadata_size = len(self.metadata_exchange.raw_info)
+            peer.send_message(extension.generate_extended_handshake(
+                metadata_size=metadata_size))
+
+    def exchange_peers(self, known_peer, peer):
+        """
+        Adds peers the peer told us about through ut_pex to known_peers and
+        sends it the changes in our own connections at most once every
+        extension.PEX_INTERVAL seconds.
+        """
+        if peer.discovered_peers:
+            self.known_peers.add_all(peer.discovered_peers,
+                                     peerstore.SOURCE_PEX)
+            peer.discovered_peers.clear()
+
+        pex_id = peer.extensions.get(b"ut_pex")
+        now = time.time()
+        if not pex_id or now - peer.last_pex < extension.PEX_INTERVAL:
+            return
+
+        connected = set(other for other, other_peer in self.connections.items()
+                        if other_peer.has_shook_hands and other != known_peer)
+        # Only what is actually sent is recorded, the rest goes out in the
+        # next messages
+        added = list(connected - peer.pex_peers)[:extension.PEX_MAX_PEERS]
+        dropped = list(peer.pex_peers - connected)[:extension.PEX_MAX_PEERS]
+        if added or dropped:
+            peer.send_message(extension.generate_pex(pex_id, added, dropped))
+            peer.pex_peers = (peer.pex_peers | set(added)) - set(dropped)
+        peer.last_pex = now
+
+    def handle_connecting(self, known_peer, peer):
+        """
+        Handles a peer we have not shook hands with yet. Once the connection
+        is established the handshake is made and the download is started.
+        """
+        reply = peer.get_reply(block=False)
+        if reply.status is None:
+            return
+
+        if reply.status == socketthread.SocketReply.ERROR:
+            print("Could not connect to {}: {}".format(peer, reply.payload))
+            self.drop_peer(known_peer, failed=True)
+            return
+
+        print("Attempting handshake with {}".format(peer))
+        try:
+            peer.attempt_handshake(self.handshake)
+            print("shook hands with {}".format(peer))
+            self.start_timers(known_peer, peer)
+            self.send_pieces(peer)
+            self.start_extensions(peer)
+            if self.download is not None:
+                self.download.add_peer(peer)
+        except (peerwire.HandshakeException, socket.error) as error:
+            print(error)
+            self.drop_peer(known_peer, failed=True)
+
+    def handle_messages(self, known_peer, peer):
+        """
+        Handles the messages that have arrived from a peer since the last
+        call and sends it new requests.
+
+        :return: Number of messages handled
+        """
+        # The messages are handled by the handlers the peer itself and the
+        # download have registered with the peer.
+        handled = 0
+        while handled < MAX_MESSAGES_PER_STEP:
+            message = peer.receive_message(block=False)
+            if message is None:
+                break
+            handled += 1
+
+        self.exchange_peers(known_peer, peer)
+        if self.download is None:
+            self.metadata_exchange.fill_requests(peer)
+        else:
+            self.download.fill_requests(peer)
+        return handled
+
+    def handle_web_seed(self, seed):
+        """
+        Feeds the runs a web seed has fetched to the download and gives it a
+        new run to fetch whenever one of its connections is free.
+
+        :return: Number of runs handled
+        """
+        handled = 0
+        now = time.time()
+        reply = seed.get_reply()
+        while reply is not None:
+            indexes, data, error = reply
+            handled += 1
+            if error is not None:
+                print(error)
+                self.download.release_run(indexes)
+                seed.failures += 1
+                seed.retry_at = now + webseed.RETRY_DELAY * seed.failures
+            else:
+                seed.failures = 0
+                self.web_seed_bytes.inc(len(data))
+                self.download.receive_run(seed, indexes, data)
+            reply = seed.get_reply()
+
+        if seed.failures >= webseed.MAX_FAILURES:
+            # Dropped once its last runs are back, so they are released
+            if not seed.in_flight:
+                print("Dropping {}".format(seed))
+                seed.close()
+                self.web_seeds.remove(seed)
+            return handled
+        if now < seed.retry_at:
+            return handled
+        run_pieces = max(1, webseed.RUN_BYTES // self.metadata.piece_length)
+        while (seed.in_flight < len(seed.threads) and
+               not self.disk.is_congested()):
+            indexes = self.download.claim_run(run_pieces)
+            if not indexes:
+                break
+            seed.fetch(indexes)
+        return handled
+
+    def announce_piece(self, index):
+        """
+        Tells every connected peer that we now have the piece.
+        """
+        have = peerwire.generate_have(index)
+        for peer in self.connections.values():
+            if peer.has_shook_hands:
+                try:
+                    peer.send_message(have)
+                except socket.error:
+                    pass  # The peer is dropped when its receive fails
+
+    def piece_count(self):
+        """
+        :return: Number of pieces, None while the metadata is not known
+        """
+        if self.metadata is None:
+            return None
+        return self.metadata.piece_count
+
+    def is_complete(self):
+        return self.download is not None and self.download.is_complete()
+
+    def set_file_priorities(self, priorities):
+        """
+        Sets which files are downloaded and in what order. Skipped files are
+        neither allocated nor requested, and the bytes left to download only
+        count the other files. For a magnet link whose metadata is not known
+        yet the priorities are applied once it has been downloaded.
+
+        :param priorities: One of the download.PRIORITY_* constants per file
+        :raise ValueError: If there is not one priority per file
+        """
+        if self.download is None:
+            self.file_priorities = list(priorities)
+            return
+        newly_wanted = [
+            index for index, priority in enumerate(priorities)
+            if priority != download.PRIORITY_SKIP and
+            self.download.file_priorities[index] == download.PRIORITY_SKIP]
+        self.download.set_file_priorities(priorities)
+        # Pieces straddling a newly wanted file are downloaded again, so they
+        # are no longer offered to peers that shake hands from now on
+        for index in self.bitfield.indexes():
+            if not self.download.have[index]:
+                self.bitfield.remove_index(index)
+        self.storage.skipped = frozenset(
+            index for index, priority in enumerate(priorities)
+            if priority == download.PRIORITY_SKIP)
+        if newly_wanted:
+            self.disk.allocate(newly_wanted)
+
+    def set_playback(self, offset, rate):
+        """
+        Turns on streaming mode, in which the pieces ahead of the playback
+        offset are downloaded first, see download.Download.
+
+        :param offset: Byte offset in the torrent being played. Call again as
+        the playback advances.
+        :param rate: Bytes per second the playback advances at
+        :raise ValueError: If the metadata is not known yet
+        """
+        self._check_metadata()
+        self.download.set_playback(offset, rate)
+
+    def stop_playback(self):
+        if self.download is not None:
+            self.download.set_playback(None)
+
+    def _check_metadata(self):
+        if self.download is None:
+            raise ValueError("The metadata of {} is not known yet".format(
+                self.label))
+
+    def open_stream(self, rate, file_index=None, timeout=None):
+        """
+        Opens a file-like reader that streams the torrent or one of its files
+        while it is being downloaded.
+
+        :param rate: Bytes per second the stream is consumed at
+        :param file_index: Index of the file to stream, the whole torrent if
+        None
+        :param timeout: Most seconds a read waits for a piece
+        :return: streaming.StreamReader
+        :raise ValueError: If the metadata is not known yet
+        """
+        self._check_metadata()
+        if file_index is None:
+            return streaming.StreamReader(self, rate, timeout=timeout)
+        return streaming.StreamReader(
+            self, rate, self.metadata.file_offsets[file_index],
+            self.metadata.files[file_index].length, timeout)
+
+    def start(self):
+        """
+        Allocates the files on disk, gets peers from the trackers and connects
+        to them. Peers found in the DHT are connected to as they arrive. For a
+        magnet link whose metadata is not cached the files are allocated once
+        the metadata has been downloaded from the peers.
+        """
+        if self.disk is not None:
+            self.disk.allocate(self.download.wanted_files())
+        self.announce()  # We need some peers to talk to
+        if self.dht is not None:
+            self.lookup_dht()
+        self.connect_peers()
+
+    def step(self):
+        """
+        Runs a single iteration of the main loop. Sleeps for a short while if
+        there was nothing to do.
+        """
+        if not self.poll():
+            time.sleep(IDLE_SLEEP)
+
+    def poll(self):
+        """
+        Fires expired timers, completes disk operations and handles every
+        connection once without sleeping.
+
+        :return: Number of messages and disk operations handled
+        """
+        self.timer_wheel.advance()
+
+        handled = 0
+        if self.download is None and self.metadata_exchange.is_complete():
+            self.complete_metadata()
+        if self.disk is not None:
+            handled += self.disk.poll()
+        if self.dht is not None:
+            handled += self.dht.poll()
+        if self.download is not None:
+            completed = self.download.completed_pieces
+            while completed:
+                index = completed.pop(0)
+                self.bitfield.add_index(index)
+                self.announce_piece(index)
+
+        for known_peer, peer in list(self.connections.items()):
+            if not peer.has_shook_hands:
+                self.handle_connecting(known_peer, peer)
+                continue
+
+            try:
+                handled += self.handle_messages(known_peer, peer)
+            except Exception as e:
+                # TODO: Limit the Exception
+                print("receive msg error", e)
+                self.drop_peer(known_peer, failed=True)
+
+        for seed in list(self.web_seeds):
+            handled += self.handle_web_seed(seed)
+
+        # Replace peers that have been dropped
+        self.connect_peers()
+        return handled
+
+    def stop(self):
+        """
+        Closes every connection and the files on disk.
+        """
+        for known_peer in list(self.connections):
+            self.drop_peer(known_peer)
+        for seed in self.web_seeds:
+            seed.close()
+        if self.disk is not None:
+            self.disk.close()
+            self.storage.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def serve_forever(self):
+        self.start()
 
         while 1:
-            time.sleep(1)
-
-            for peer in self.peers:
-                if not peer.is_connected():
-                    continue
-
-                replies = peer.get_all_replies(block=False)
-
-                for reply in replies:
-                    if not peer.has_shook_hands:
-                        print("Attempting handshake with {}".format(peer))
-                        try:
-                            peer.attempt_handshake(self.handshake)
-                            print("shook hands with {}".format(peer))
-                        except peerwire.HandshakeException as error:
-                            print(error)
-                            continue
-                    print("{} reply: {}".format(peer, reply.status))
-                    print("{} payload: {}".format(peer, reply.payload))
-
-                if not replies:
-                    try:
-                        peer.receive_message()
-                    except Exception as e:
-                        # TODO: Limit the Exception and disconnect the peer
-                        print("receive msg error", e)
+            self.step()
@@ -1,5 +1,11 @@
 """
 Provides a minimum of functionality to interact with a bit-torrent tracker
+
+Announces and scrapes are made through HTTP_CLIENT, which keeps a pool of
+keep-alive connections per tracker host, accepts gzip compressed responses,
+caches the addresses tracker host names resolve to and limits the number of
+requests in flight at the same time. The trackers of a torrent are announced
+to in parallel.
 """
 
 from __future__ import (
@@ -10,30 +16,248 @@ from __future__ import (
 )
 
 import hashlib
-import urllib
-import urllib2
+import socket
+import struct
 import sys
+import threading
+import time
+import urllib
+import zlib
 
 import bencode
+import lazybencode
 
 
 if sys.version_info.major == 2:
     chr = unichr
     string_type = basestring
+    import httplib as http_client
+    from urlparse import urljoin, urlsplit
 elif sys.version_info.major == 3:
     # chr should assume Unicode
     string_type = str
+    import http.client as http_client
+    from urllib.parse import urljoin, urlsplit
+
+# Idle keep-alive connections kept open per tracker host
+POOL_SIZE = 4
+# Most tracker requests in flight at the same time, over all trackers
+MAX_CONCURRENT_REQUESTS = 8
+# Seconds the address a tracker host name resolved to is used before the name
+# is resolved again
+DNS_TTL = 5 * 60
+# Seconds before a socket operation of a tracker request times out
+HTTP_TIMEOUT = 30
+# Redirects followed per request, as urllib2 did, and the statuses that are
+# followed
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class TrackerError(IOError):
+    """
+    Raised when a tracker can not be reached or answers a request with an
+    error.
+    """
+
+    def __init__(self, url, error_string):
+        self.url = url
+        self.error_string = error_string
+
+    def __str__(self):
+        return "{} failed: {}".format(self.url, self.error_string)
+
+
+class HTTPClient(object):
+    """
+    Makes the HTTP requests to trackers. Can be used from several threads at
+    once.
+
+    Connections are kept open after a request and reused for the next request
+    to the same host, at most pool_size idle ones per host. Plain HTTP
+    connections are made to the cached address of the host, HTTPS connections
+    to the host name as the certificate is checked against it.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE,
+                 max_concurrent=MAX_CONCURRENT_REQUESTS, dns_ttl=DNS_TTL):
+        """
+        :param pool_size: Idle connections kept per host, 0 closes every
+        connection after its request
+        :param max_concurrent: Most requests in flight at the same time
+        :param dns_ttl: Seconds a resolved address is used
+        """
+        self.pool_size = pool_size
+        self.dns_ttl = dns_ttl
+        self.lock = threading.Lock()  # Held while changing pools or dns_cache
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        # (scheme, host, port) mapped to a list of idle connections
+        self.pools = {}
+        # (host, port) mapped to an (address, Unix time it expires) tuple
+        self.dns_cache = {}
+
+        self.requests = 0
+        self.connections_opened = 0
+        self.dns_lookups = 0
+
+    def resolve(self, host, port):
+        """
+        :return: The IP address of host, from the cache if it has not expired
+        """
+        now = time.time()
+        with self.lock:
+            cached = self.dns_cache.get((host, port))
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        address = infos[0][4][0]
+        with self.lock:
+            self.dns_lookups += 1
+            self.dns_cache[(host, port)] = (address, now + self.dns_ttl)
+        return address
+
+    def _checkout(self, key):
+        """
+        :return: (connection, reused) tuple of an idle connection of the pool
+        of key, or a new connection
+        """
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool:
+                return pool.pop(), True
+            self.connections_opened += 1
+
+        scheme, host, port = key
+        if scheme == "https":
+            return http_client.HTTPSConnection(host, port,
+                                               timeout=HTTP_TIMEOUT), False
+        return http_client.HTTPConnection(self.resolve(host, port), port,
+                                          timeout=HTTP_TIMEOUT), False
+
+    def _checkin(self, key, connection):
+        with self.lock:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(connection)
+                return
+        connection.close()
+
+    def _discard(self, key):
+        """
+        Closes the idle connections of a host, after one of them turned out
+        to have been closed by the server.
+        """
+        with self.lock:
+            pool = self.pools.pop(key, [])
+        for connection in pool:
+            connection.close()
+
+    def get(self, url):
+        """
+        Makes a GET request, following up to MAX_REDIRECTS redirects.
+
+        :param url: The http or https URL
+        :return: The body of the response, decompressed if it was gzipped
+        :raise TrackerError: If the request fails or the answer is not 200 OK
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response, data = self._request(url)
+            if response.status not in REDIRECT_STATUSES:
+                break
+            location = response.getheader("location")
+            if not location:
+                raise TrackerError(url, "HTTP {} without a Location".format(
+                    response.status))
+            url = urljoin(url, location)
+        else:
+            raise TrackerError(url, "too many redirects")
+
+        if response.status != 200:
+            raise TrackerError(url, "HTTP {} {}".format(response.status,
+                                                        response.reason))
+        if response.getheader("content-encoding", "").lower() == "gzip":
+            try:
+                # 16 + MAX_WBITS makes zlib expect a gzip header
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            except zlib.error as e:
+                raise TrackerError(url, "bad gzip response: {}".format(e))
+        return data
+
+    def _request(self, url):
+        """
+        Makes a single GET request. A pooled connection the server has closed
+        in the meantime is replaced by a new one once.
+
+        :return: (response, body) tuple
+        :raise TrackerError: If the request fails
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise TrackerError(url, "not a HTTP URL")
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = {
+            "Host": parts.netloc,
+            "Accept-Encoding": "gzip",
+        }
+
+        with self.slots:
+            for attempt in range(2):
+                try:
+                    connection, reused = self._checkout(key)
+                except socket.error as e:
+                    raise TrackerError(url, e)
+                try:
+                    connection.request("GET", path, headers=headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (http_client.HTTPException, socket.error) as e:
+                    connection.close()
+                    if not reused or attempt:
+                        raise TrackerError(url, e)
+                    self._discard(key)
+            with self.lock:
+                self.requests += 1
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+        return response, data
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools = {}
+        for pool in pools:
+            for connection in pool:
+                connection.close()
+
+
+HTTP_CLIENT = HTTPClient()
 
 
 def calc_info_hash(meta_info, url_encode=False):
     """
-    Calculates the info hash from a decoded torrent file (meta info).
+    Calculates the info hash from a decoded torrent file (meta info). If the
+    meta info was decoded with lazybencode the original bytes of the info dict
+    are hashed directly, otherwise the info dict is re-encoded.
 
     :param meta_info: The meta info to generate info hash from.
     :param url_encode: If true the resulting info hash will be url encoded.
     :return: sha1 info hash
     """
-    info_key = bencode.encode(meta_info['info'])
+    info_key = getattr(meta_info, 'raw_info', None)
+    if info_key is None:
+        info_key = bencode.encode(meta_info['info'])
     info_hash = hashlib.sha1(info_key).digest()
 
     if url_encode:
@@ -44,28 +268,106 @@ def calc_info_hash(meta_info, url_encode=False):
     return info_hash
 
 
+# Compact peer formats: IPv4 address + port and IPv6 address + port, all in
+# network (big endian) notation.
+COMPACT_PEER = struct.Struct(b"!4sH")
+COMPACT_PEER6 = struct.Struct(b"!16sH")
+
+
+class PeerAddress(object):
+    """
+    Lightweight address of a peer as received from a tracker. Two addresses
+    are equal if ip and port are equal, no matter the peer_id, so addresses can
+    be deduplicated in a set.
+    """
+
+    __slots__ = ("ip", "port", "peer_id")
+
+    def __init__(self, ip, port, peer_id=None):
+        self.ip = ip
+        self.port = port
+        self.peer_id = peer_id
+
+    def __eq__(self, other):
+        if not isinstance(other, PeerAddress):
+            return NotImplemented
+        return self.ip == other.ip and self.port == other.port
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self.ip, self.port))
+
+    def __repr__(self):
+        return "PeerAddress({}, {})".format(repr(self.ip), self.port)
+
+
+def _iter_unpack(compact_struct, data):
+    """
+    struct.Struct.iter_unpack with a fallback for Python 2. Trailing bytes that
+    do not make up a whole entry are ignored.
+    """
+    data = memoryview(data)
+    data = data[:len(data) - len(data) % compact_struct.size]
+    if hasattr(compact_struct, "iter_unpack"):
+        return compact_struct.iter_unpack(data)
+    return (compact_struct.unpack_from(data, offset)
+            for offset in range(0, len(data), compact_struct.size))
+
+
 def binary_peer_extract(peers):
     """
     A tracker may choose to send the list of peers as a binary string consisting
     of multiples of 6 bytes where the first 4 bytes are the IP address and the
     last 2 bytes are the port number. All in network (big endian) notation. This
-    function extracts the ip and port from the binary data and stores it in a
-    dict.
+    function extracts the ip and port from the binary data.
 
     :param peers: Binary string of peers.
-    :return: A dict with the keys 'ip' and 'port'
+    :return: A list of PeerAddress
     """
-    peers = [ord(c) for c in peers]  # Peers is in binary form
+    inet_ntoa = socket.inet_ntoa
+    return [PeerAddress(inet_ntoa(ip), port)
+            for ip, port in _iter_unpack(COMPACT_PEER, peers)]
+
 
-    # Split the peers up in multiples of 6 bytes
-    peer_list = [peers[i:i + 6] for i in range(0, len(peers), 6)]
+def binary_peer6_extract(peers):
+    """
+    Same as binary_peer_extract but for the 'peers6' key where each peer is
+    18 bytes, a 16 byte IPv6 address followed by a 2 byte port number.
 
-    peer_list = [dict(peer_id=None,
-                      ip="{0}.{1}.{2}.{3}".format(p[0], p[1], p[2], p[3]),
-                      port=(256 * p[4]) + p[5])  # Convert to an int
-                 for p in peer_list]
+    :param peers: Binary string of IPv6 peers.
+    :return: A list of PeerAddress
+    """
+    inet_ntop = socket.inet_ntop
+    af_inet6 = socket.AF_INET6
+    return [PeerAddress(inet_ntop(af_inet6, ip), port)
+            for ip, port in _iter_unpack(COMPACT_PEER6, peers)]
 
-    return peer_list
+
+def extract_peers(response):
+    """
+    Extracts the peers of a tracker response no matter if they are in dict or
+    compact form, including compact IPv6 peers.
+
+    :param response: A decoded tracker response
+    :return: A set of PeerAddress
+    """
+    peers = response.get('peers', [])
+    if isinstance(peers, list):
+        peer_set = set(PeerAddress(peer['ip'], peer['port'],
+                                   peer.get('peer id'))
+                       for peer in peers)
+    else:
+        peer_set = set(binary_peer_extract(peers))
+
+    if 'peers6' in response:
+        peer_set.update(binary_peer6_extract(response['peers6']))
+
+    return peer_set
 
 
 def query_announcer(announce_url, info_hash, peer_id, port="8080", uploaded=0,
@@ -158,33 +460,79 @@ def query_announcer(announce_url, info_hash, peer_id, port="8080", uploaded=0,
 
     url = announce_url + "/?" + payload
 
-    response = urllib2.urlopen(url).read()
-    decoded_response = bencode.decode(bytes(response))
+    response = HTTP_CLIENT.get(url)
+    decoded_response = lazybencode.decode(response)
+    if not isinstance(decoded_response, dict):
+        raise TrackerError(url, "response is not a dictionary")
     return decoded_response
 
 
-def get_peers(meta_info, peer_id):
+def get_announce_urls(meta_info):
+    """
+    :param meta_info: A bdecoded torrent file
+    :return: The tracker URLs of announce-list, or of announce if there is no
+    announce-list (BEP 12). Empty for a trackerless torrent.
+    """
+    if 'announce-list' in meta_info:
+        return [announcer for announce_list in meta_info['announce-list']
+                for announcer in announce_list]
+    if meta_info.get('announce'):
+        return [meta_info['announce']]
+    return []
+
+
+def get_peers(meta_info, peer_id, info_hash=None, **params):
     """
     Query all trackers in the meta info for peers. Currently do not query udp
-    trackers as that is more complicated.
+    trackers as that is more complicated. The trackers are queried in
+    parallel, the number of requests in flight is limited by HTTP_CLIENT.
 
     :param meta_info: A bdecoded torrent file
     :param peer_id: The client generated peer_id
-    :return: List of peers.
+    :param info_hash: The raw info hash of the torrent. Calculated from
+    meta_info if not given.
+    :param params: Passed on to query_announcer, such as port and left
+    :return: Set of PeerAddress, each address only occurs once.
+    :raise TrackerError: If every tracker failed
     """
-    peer_list = []
-    info_hash = calc_info_hash(meta_info)
-    for announce_list in meta_info['announce-list']:
-        for announcer in announce_list:
-            if not announcer.startswith("udp"):
-                response = query_announcer(announcer, info_hash, peer_id)
-
-                peers = response['peers']
-                if isinstance(peers, string_type):
-                    peers = binary_peer_extract(peers)
-
-                peer_list.extend(peers)
-    return peer_list
+    if info_hash is None:
+        info_hash = calc_info_hash(meta_info)
+    announcers = [announcer for announcer in get_announce_urls(meta_info)
+                  if not announcer.startswith("udp")]
+
+    results = [None] * len(announcers)
+
+    def announce(index):
+        try:
+            response = query_announcer(announcers[index], info_hash, peer_id,
+                                       **params)
+            results[index] = extract_peers(response)
+        except Exception as e:
+            # Such as a malformed peer list, which must not hide the peers
+            # of the other trackers
+            results[index] = e
+
+    if len(announcers) == 1:
+        announce(0)
+    else:
+        threads = [threading.Thread(target=announce, args=(index,))
+                   for index in range(len(announcers))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    peer_set = set()
+    errors = []
+    for result in results:
+        if isinstance(result, Exception):
+            errors.append(result)
+        else:
+            peer_set.update(result)
+    if errors and len(errors) == len(results):
+        raise errors[0]
+    return peer_set
 
 
 def scrape(announce_url, info_hashes=None):
@@ -247,8 +595,8 @@ def scrape(announce_url, info_hashes=None):
             raise TypeError("info_hash must either be a String or List")
 
     if not scrape_url.startswith("udp"):
-        response = urllib2.urlopen(scrape_url).read()
-        decoded_response = bencode.decode(response)
+        response = HTTP_CLIENT.get(scrape_url)
+        decoded_response = lazybencode.decode(response)
 
         return decoded_response
 
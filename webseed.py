@@ -0,0 +1,258 @@
+"""
+HTTP web seeds (BEP 19).
+
+A torrent may list HTTP mirrors of its files under the url-list key of the meta
+info. Each mirror is used as a virtual peer that has every piece. Runs of
+consecutive pieces are claimed from the download and fetched with HTTP Range
+requests over persistent keep-alive connections, one request per file the run
+overlaps. The fetched data is fed to the download block by block, so it goes
+through the same verification as data from peers.
+
+The HTTP requests are blocking and made by a small pool of threads per web
+seed. Like socketthread.SocketThread the threads take commands from a queue
+and put their results in a reply queue that the owner polls.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import socket
+import sys
+import threading
+
+import extension
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+    import httplib as http_client
+    import Queue as queue
+    from urllib import quote
+    from urlparse import urlsplit
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+    import http.client as http_client
+    import queue
+    from urllib.parse import quote, urlsplit
+
+# Threads, and so keep-alive connections and runs in flight, per web seed
+CONNECTIONS = 2
+# Bytes fetched per run, rounded to whole pieces but at least one piece
+RUN_BYTES = 4 * 2 ** 20
+# Seconds before a socket operation of a request times out
+HTTP_TIMEOUT = 30
+# Seconds to wait before using a web seed again after a failure, multiplied by
+# the number of failures in a row, and the failures after which it is dropped
+RETRY_DELAY = 30
+MAX_FAILURES = 5
+
+
+class WebSeedError(Exception):
+    """
+    Raised when a web seed answers a request with an error or wrong data.
+    """
+
+    def __init__(self, seed, error_string):
+        self.seed = seed
+        self.error_string = error_string
+
+    def __str__(self):
+        return "{} failed: {}".format(self.seed, self.error_string)
+
+
+def get_url_list(meta_info):
+    """
+    :param meta_info: A decoded torrent file
+    :return: List of the web seed URLs as text, empty if there are none
+    """
+    urls = meta_info.get('url-list', [])
+    if not isinstance(urls, list):
+        urls = [urls]
+    return [url.decode("utf-8") if isinstance(url, bytes) else url
+            for url in urls if url]
+
+
+def file_urls(url, metadata):
+    """
+    Maps every file of a torrent to its URL on a web seed. For a single file
+    torrent the URL is the file itself unless it ends with a slash. Otherwise
+    the name of the torrent and the path of the file are appended.
+
+    :param url: The web seed URL from url-list
+    :param metadata: metainfo.Metadata of the torrent
+    :return: List of URLs indexed like metadata.files
+    """
+    single_file = len(metadata.files[0].path) == 1
+    if single_file and not url.endswith("/"):
+        return [url]
+
+    if not url.endswith("/"):
+        url += "/"
+    urls = []
+    for entry in metadata.files:
+        parts = [part if isinstance(part, bytes) else part.encode("utf-8")
+                 for part in entry.path]
+        urls.append(url + "/".join(quote(part) for part in parts))
+    return urls
+
+
+class WebSeed(object):
+    def __init__(self, url, metadata, connections=CONNECTIONS):
+        """
+        :param url: The web seed URL from url-list
+        :param metadata: metainfo.Metadata of the torrent
+        :param connections: Number of threads, each with its own keep-alive
+        connections
+        """
+        self.url = url
+        self.metadata = metadata
+        self.file_urls = file_urls(url, metadata)
+
+        self.command_queue = queue.Queue()
+        self.reply_queue = queue.Queue()
+        self.threads = [threading.Thread(target=self._run)
+                        for _ in range(connections)]
+        for thread in self.threads:
+            thread.daemon = True
+        self.started = False
+
+        # Only used by the owner
+        self.in_flight = 0  # Runs being fetched
+        self.failures = 0  # Failed runs in a row
+        self.retry_at = 0  # Unix time before which no run is fetched
+
+    def __str__(self):
+        return "WebSeed: {}".format(self.url)
+
+    def start(self):
+        """
+        Starts the threads. Called by the first fetch.
+        """
+        if not self.started:
+            self.started = True
+            for thread in self.threads:
+                thread.start()
+
+    def close(self):
+        """
+        Stops the threads once they have finished their current run.
+        """
+        if self.started:
+            for _ in self.threads:
+                self.command_queue.put(None)
+
+    def fetch(self, indexes):
+        """
+        Fetches a run of consecutive pieces in the background. The result is
+        returned by a later call to get_reply.
+
+        :param indexes: Consecutive piece indexes
+        """
+        self.start()
+        self.in_flight += 1
+        self.command_queue.put(indexes)
+
+    def get_reply(self):
+        """
+        :return: (indexes, data, error) of a finished run or None. Either data
+        is the content of the pieces or error the exception that occurred.
+        """
+        try:
+            reply = self.reply_queue.get(block=False)
+        except queue.Empty:
+            return None
+        self.in_flight -= 1
+        return reply
+
+    def _run(self):
+        connections = {}  # (scheme, host) mapped to a HTTPConnection
+        while True:
+            indexes = self.command_queue.get()
+            if indexes is None:
+                break
+            try:
+                data = self.fetch_run(indexes, connections)
+                self.reply_queue.put((indexes, data, None))
+            except Exception as e:
+                # Every run must get a reply, or in_flight never drops and
+                # the seed stalls
+                self.reply_queue.put((indexes, None, e))
+        for connection in connections.values():
+            connection.close()
+
+    def fetch_run(self, indexes, connections):
+        """
+        Fetches the data of a run of consecutive pieces, with one Range
+        request for every file the run overlaps.
+
+        :param indexes: Consecutive piece indexes
+        :param connections: Dict of the keep-alive connections of the thread
+        :return: The data of the pieces
+        """
+        metadata = self.metadata
+        offset = indexes[0] * metadata.piece_length
+        length = sum(metadata.piece_size(index) for index in indexes)
+        parts = []
+        for file_index, file_offset, span in metadata.file_spans(offset,
+                                                                 length):
+            parts.append(self.get_range(self.file_urls[file_index],
+                                        file_offset, span, connections))
+        return b"".join(parts)
+
+    def get_range(self, url, offset, length, connections):
+        """
+        Gets length bytes at offset of a file. A keep-alive connection that
+        the server has closed in the meantime is reopened once.
+
+        :return: The bytes
+        :raise WebSeedError: If the server answers with an error
+        """
+        scheme, host, path, query, _ = urlsplit(url)
+        if query:
+            path += "?" + query
+        headers = {
+            "Range": "bytes={}-{}".format(offset, offset + length - 1),
+            "User-Agent": extension.CLIENT_NAME,
+        }
+
+        key = (scheme, host)
+        for attempt in range(2):
+            connection = connections.get(key)
+            reused = connection is not None
+            if connection is None:
+                if scheme == "https":
+                    connection = http_client.HTTPSConnection(
+                        host, timeout=HTTP_TIMEOUT)
+                else:
+                    connection = http_client.HTTPConnection(
+                        host, timeout=HTTP_TIMEOUT)
+                connections[key] = connection
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                del connections[key]
+                if not reused or attempt:
+                    raise
+
+        if response.getheader("connection", "").lower() == "close":
+            connection.close()
+            del connections[key]
+
+        if response.status == 200:
+            data = data[offset:offset + length]  # The Range was ignored
+        elif response.status != 206:
+            raise WebSeedError(self, "HTTP {} {} for {}".format(
+                response.status, response.reason, url))
+        if len(data) != length:
+            raise WebSeedError(self, "Expected {} bytes of {} but got {}"
+                               .format(length, url, len(data)))
+        return data
@@ -0,0 +1,345 @@
+"""
+Recording and replay of peer wire traffic.
+
+A TraceRecorder writes every frame received from every connection (the
+handshake and each length prefixed message) to a compact binary log together
+with a timestamp. replay() feeds such a log back through peerwire.Peer and the
+download pipeline of a Torrent, either as fast as possible or at the recorded
+pace, so the parsing and dispatch paths can be profiled without a live swarm.
+
+The log starts with MAGIC followed by records of the form:
+
+<connection id><timestamp><kind><length><data>
+
+connection id: 4 byte unsigned integer
+timestamp: 8 byte double, seconds since the recording started
+kind: 1 byte, one of OPEN, HANDSHAKE or MESSAGE
+length: 4 byte unsigned integer, the length of data
+data: the label of the connection for OPEN, otherwise the raw frame
+
+Usage:
+
+    python wiretrace.py TRACE TORRENT [--paced] [--profile FILE]
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals
+)
+
+import argparse
+import collections
+import cProfile
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import peerwire
+import socketthread
+import torrent
+import tracker
+
+if sys.version_info.major == 2:
+    chr = unichr
+    string_type = basestring
+    import Queue as queue
+elif sys.version_info.major == 3:
+    # chr should assume Unicode
+    string_type = str
+    import queue
+
+MAGIC = b"PYTRACE2"
+RECORD_HEADER = struct.Struct(b">IdBI")
+
+# Record kinds
+OPEN = 0
+HANDSHAKE = 1
+MESSAGE = 2
+
+Record = collections.namedtuple("Record", ["connection", "timestamp", "kind",
+                                           "data"])
+
+
+class TraceRecorder(object):
+    """
+    Writes the frames of any number of connections to a single log file.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.connection_count = 0
+
+    def write(self, connection, kind, data):
+        header = RECORD_HEADER.pack(connection, time.time() - self.start, kind,
+                                    len(data))
+        with self.lock:
+            self.file.write(header)
+            self.file.write(data)
+
+    def connection(self, label):
+        """
+        Starts recording a new connection.
+
+        :param label: Label of the connection such as "ip:port"
+        :return: ConnectionRecorder for the connection
+        """
+        with self.lock:
+            connection = self.connection_count
+            self.connection_count += 1
+        self.write(connection, OPEN, label.encode("utf-8"))
+        return ConnectionRecorder(self, connection)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ConnectionRecorder(object):
+    """
+    Records the received frames of a single connection.
+    """
+
+    def __init__(self, recorder, connection):
+        self.recorder = recorder
+        self.connection = connection
+
+    def record_handshake(self, handshake):
+        self.recorder.write(self.connection, HANDSHAKE, handshake)
+
+    def record_message(self, frame):
+        """
+        :param frame: The complete message including its length prefix
+        """
+        self.recorder.write(self.connection, MESSAGE, frame)
+
+
+def read_trace(path):
+    """
+    Reads the records of a trace log in the order they were written.
+
+    :param path: Path of the log
+    :return: Generator of Record
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a trace log".format(path))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            connection, timestamp, kind, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return  # Truncated log, the recording was cut short
+            yield Record(connection, timestamp, kind, data)
+
+
+class ReplaySocket(object):
+    """
+    Stands in for socketthread.SocketThread during replay. Received data is
+    fed in by the replay driver and the receive commands are answered from it
+    exactly like SocketThread would, without any threads or sockets. Anything
+    sent is discarded.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.command_queue = queue.Queue()
+        self.reply_queue = queue.Queue()
+        self.pending = collections.deque()  # Receive commands not answered yet
+        self.connected = True
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+    def _take(self, n):
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def _answer(self):
+        """
+        Answers the oldest pending receive command if enough data has been
+        fed.
+        """
+        if not self.pending:
+            return
+        command, size, max_length = self.pending[0]
+        if command == socketthread.SocketCommand.RECEIVE:
+            if len(self.buffer) < size:
+                return
+            payload = self._take(size)
+        else:
+            if len(self.buffer) < size:
+                return
+            prefix = bytes(self.buffer[:size])
+            length = socketthread.unpack_prefix(prefix)
+            if max_length is not None and length > max_length:
+                self.pending.popleft()
+                self.reply_queue.put(socketthread.SocketReply(
+                    socketthread.SocketReply.ERROR,
+                    socketthread.MessageTooLargeError(
+                        "Message of {} bytes exceeds the maximum of {}".format(
+                            length, max_length))))
+                return
+            if len(self.buffer) < size + length:
+                return
+            self._take(size)
+            payload = (prefix, self._take(length))
+        self.pending.popleft()
+        self.reply_queue.put(socketthread.SocketReply(
+            socketthread.SocketReply.SUCCESS, payload))
+
+    def is_connected(self):
+        return self.connected
+
+    def start(self):
+        pass
+
+    def join(self, timeout=None):
+        pass
+
+    def connect(self, address):
+        pass
+
+    def close(self):
+        self.connected = False
+
+    def send(self, payload):
+        self.reply_queue.put(socketthread.SocketReply(
+            socketthread.SocketReply.SUCCESS))
+
+    def sendall(self, payload):
+        pass
+
+    def receive(self, n):
+        self.pending.append((socketthread.SocketCommand.RECEIVE, n, None))
+
+    def receive_with_prefix(self, prefix_size, max_length=None):
+        self.pending.append((socketthread.SocketCommand.RECEIVE_WITH_PREFIX,
+                             prefix_size, max_length))
+
+    def get_reply(self, block=True, timeout=None):
+        self._answer()
+        try:
+            return self.reply_queue.get(block=False)
+        except queue.Empty:
+            return socketthread.SocketReply(socketthread.SocketReply.NONE)
+
+
+def replay(trace_path, torrent_path, paced=False, profile_path=None,
+           profile_hook=None):
+    """
+    Feeds a recorded trace through the peers and download pipeline of a fresh
+    Torrent. Blocks are written to a temporary directory that is removed
+    afterwards.
+
+    :param trace_path: Path of a log written by TraceRecorder
+    :param torrent_path: The .torrent file the trace was recorded for
+    :param paced: If True sleep between records to keep the recorded pace,
+    otherwise replay as fast as possible.
+    :param profile_path: If given the replay is run under cProfile and the
+    stats are dumped to this path.
+    :param profile_hook: If given installed with sys.setprofile during the
+    replay.
+    :return: Dict with the number of messages replayed, the elapsed time and
+    the number of pieces completed.
+    """
+    directory = tempfile.mkdtemp(prefix="pytorrent-replay-")
+    client = torrent.Torrent(torrent_path, directory)
+    client.disk.allocate()
+
+    connections = {}  # Connection id mapped to (KnownPeer, Peer, socket)
+    messages = 0
+
+    profiler = cProfile.Profile() if profile_path is not None else None
+    if profiler is not None:
+        profiler.enable()
+    if profile_hook is not None:
+        sys.setprofile(profile_hook)
+
+    start = time.time()
+    try:
+        for record in read_trace(trace_path):
+            if paced:
+                delay = start + record.timestamp - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if record.kind == OPEN:
+                ip, _, port = record.data.decode("utf-8").rpartition(":")
+                address = tracker.PeerAddress(ip, int(port))
+                known_peer = client.known_peers.add(address)
+                replay_socket = ReplaySocket()
+                peer = peerwire.Peer(ip, int(port), None, client.label,
+                                     replay_socket,
+                                     client.metadata.piece_count)
+                client.known_peers.mark_connected(known_peer)
+                client.connections[known_peer] = peer
+                connections[record.connection] = (known_peer, peer,
+                                                   replay_socket)
+                continue
+
+            known_peer, peer, replay_socket = connections[record.connection]
+            replay_socket.feed(record.data)
+
+            if record.kind == HANDSHAKE:
+                peer.receive_handshake()
+                peer.reserved = peerwire.decode_handshake(
+                    peer.handshake)['reserved']
+                peer.negotiate_extensions(client.handshake)
+                peer.has_shook_hands = True
+                client.download.add_peer(peer)
+            else:
+                messages += 1
+                message_id = bytearray(record.data[4:5])
+                if message_id and message_id[0] == peerwire.PIECE:
+                    # The requests were decided by the recorded run, so make
+                    # the download expect the block.
+                    index, begin = peerwire.BLOCK_HEADER.unpack_from(
+                        record.data, 5)
+                    client.download.expect_block(peer, index, begin)
+                client.handle_messages(known_peer, peer)
+        client.disk.drain()
+    finally:
+        elapsed = time.time() - start
+        if profile_hook is not None:
+            sys.setprofile(None)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        client.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return dict(messages=messages, elapsed=elapsed,
+                pieces=client.download.have_count)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay a peer wire trace")
+    parser.add_argument("trace", help="Trace log written with --record-trace")
+    parser.add_argument("torrent", help="The .torrent file of the trace")
+    parser.add_argument("--paced", action="store_true",
+                        help="Replay at the recorded pace")
+    parser.add_argument("--profile", default=None,
+                        help="Run under cProfile and dump the stats here")
+    args = parser.parse_args(argv[1:])
+
+    result = replay(args.trace, args.torrent, args.paced, args.profile)
+    print("{messages} messages in {elapsed:.3f} s, {pieces} pieces "
+          "completed".format(**result))
+    if result['messages']:
+        print("{:.1f} us per message".format(
+            result['elapsed'] / result['messages'] * 1e6))
+
+
+if __name__ == "__main__":
+    main(sys.argv)